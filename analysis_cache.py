@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import zlib
+from profiler import count_file_read, profiled
+from progress import report_progress
+
+# Format of the cache files themselves (the analyses stored in them carry their own version)
+CACHE_FORMAT_VERSION = 1
+
+# Limits before the least recently used entries are evicted
+CACHE_MAX_ENTRIES = 64
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def analysis_cache_dir():
+    # AMS_SWAPPER_CACHE_DIR overrides the location, AMS_SWAPPER_CACHE=0 turns the cache off
+    if os.environ.get("AMS_SWAPPER_CACHE", "1") == "0":
+        return None
+    cache_dir = os.environ.get("AMS_SWAPPER_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "ams_filament_swapper")
+
+
+@profiled
+def file_content_hash(input_file_path):
+    # BLAKE2b of the whole file, read in large blocks
+    content_hash = hashlib.blake2b(digest_size=16)
+    file_size = os.path.getsize(input_file_path)
+    done = 0
+    report_progress(done, file_size, "Hashing file")
+    with open(input_file_path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(HASH_BLOCK_SIZE), b""):
+            content_hash.update(block)
+            done += len(block)
+            report_progress(done, file_size)
+    count_file_read(bytes_read=done)
+    return content_hash.hexdigest()
+
+
+def cache_entry_path(cache_dir, input_file_path, kind):
+    # One entry per input file and kind of analysis
+    path_hash = hashlib.blake2b(os.path.abspath(input_file_path).encode(), digest_size=16).hexdigest()
+    return os.path.join(cache_dir, f"{path_hash}_{kind}.json.z")
+
+
+def read_cache_entry(entry_path):
+    try:
+        with open(entry_path, "rb") as entry_file:
+            compressed = entry_file.read()
+        count_file_read(bytes_read=len(compressed))
+        return json.loads(zlib.decompress(compressed))
+    except (OSError, ValueError, zlib.error):
+        return None
+
+
+def write_cache_entry(entry_path, entry):
+    # Write to a temporary file first so a reader never sees a half written entry
+    temp_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as entry_file:
+        entry_file.write(zlib.compress(json.dumps(entry, separators=(",", ":")).encode(), 1))
+    os.replace(temp_path, entry_path)
+
+
+@profiled
+def load_cached_analysis(input_file_path, kind, version, content_hash=file_content_hash):
+    # Return the cached analysis data for an unchanged file, None on any miss. content_hash(input_file_path) is the
+    # hash the entry was stored with
+    cache_dir = analysis_cache_dir()
+    if cache_dir is None:
+        return None
+
+    entry_path = cache_entry_path(cache_dir, input_file_path, kind)
+    entry = read_cache_entry(entry_path)
+    if entry is None or entry.get("format") != CACHE_FORMAT_VERSION or entry.get("version") != version:
+        return None
+
+    stat = os.stat(input_file_path)
+    if entry["size"] != stat.st_size:
+        return None
+
+    # Same size and mtime is trusted, otherwise the content hash decides (e.g. a file copied or touched)
+    if entry["mtime_ns"] != stat.st_mtime_ns:
+        if entry["content_hash"] != content_hash(input_file_path):
+            return None
+        entry["mtime_ns"] = stat.st_mtime_ns
+        try:
+            write_cache_entry(entry_path, entry)
+        except OSError:
+            pass
+    else:
+        # Mark the entry as recently used for eviction
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+    return entry["data"]
+
+
+def load_previous_analysis(input_file_path, kind, version):
+    # Return the cached analysis data of a file even if it has changed since, for analyses that can update it.
+    # None if there is none
+    cache_dir = analysis_cache_dir()
+    if cache_dir is None:
+        return None
+    entry = read_cache_entry(cache_entry_path(cache_dir, input_file_path, kind))
+    if entry is None or entry.get("format") != CACHE_FORMAT_VERSION or entry.get("version") != version:
+        return None
+    return entry["data"]
+
+
+@profiled
+def store_cached_analysis(input_file_path, kind, version, data, content_hash=None):
+    # Save the analysis data for the file, silently giving up if the cache can't be written. Analyses that have
+    # already hashed the file pass its content_hash, so it isn't read again
+    cache_dir = analysis_cache_dir()
+    if cache_dir is None:
+        return
+
+    stat = os.stat(input_file_path)
+    entry = {
+        "format": CACHE_FORMAT_VERSION,
+        "version": version,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "content_hash": content_hash if content_hash is not None else file_content_hash(input_file_path),
+        "data": data,
+    }
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_cache_entry(cache_entry_path(cache_dir, input_file_path, kind), entry)
+        evict_cache_entries(cache_dir)
+    except OSError:
+        pass
+
+
+def forget_cached_analysis(input_file_path, kind):
+    # Remove the cached analysis of a file, if there is one
+    cache_dir = analysis_cache_dir()
+    if cache_dir is None:
+        return
+    try:
+        os.remove(cache_entry_path(cache_dir, input_file_path, kind))
+    except OSError:
+        pass
+
+
+def evict_cache_entries(cache_dir):
+    # Remove the least recently used entries until the cache is within its limits
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".json.z"):
+            entry_path = os.path.join(cache_dir, name)
+            stat = os.stat(entry_path)
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+    entries.sort()
+
+    total_size = sum(size for _, size, _ in entries)
+    while entries and (len(entries) > CACHE_MAX_ENTRIES or total_size > CACHE_MAX_BYTES):
+        _, size, entry_path = entries.pop(0)
+        os.remove(entry_path)
+        total_size -= size
+
+
+def clear_analysis_cache():
+    cache_dir = analysis_cache_dir()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return
+    for name in os.listdir(cache_dir):
+        if name.endswith(".json.z"):
+            os.remove(os.path.join(cache_dir, name))
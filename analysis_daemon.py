@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import functools
+import hmac
+import io
+import json
+import multiprocessing
+import os
+import secrets
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import gcode_3mf
+import main
+from gcode_index import cached_gcode_index_paths, get_gcode_index, set_gcode_index_cache_size
+from progress import AnalysisCancelled, report_progress
+
+# Where clients find the daemon: AMS_SWAPPER_DAEMON is a Unix socket path or a localhost port number, and 0 turns
+# the daemon off for the clients. By default a socket in the temporary directory, or a port where there are none
+DEFAULT_PORT = 47652
+DAEMON_CONNECT_TIMEOUT = 0.5
+
+# Anyone on the machine can connect to a port, so there every request must carry the secret token the daemon writes to
+# a file only this user can read. A Unix socket is only open to this user already
+TOKEN_FILE_NAME = ".ams_swapper_daemon_{port}.token"
+
+# JSON object keys are strings, so dicts with other keys travel as {PAIRS_KEY: [[key, value], ...]}
+PAIRS_KEY = "__pairs__"
+
+# Indexes kept warm in memory, and requests run at the same time
+DEFAULT_CACHE_SIZE = 16
+DEFAULT_WORKERS = 4
+
+# Query results kept for files that haven't changed
+RESULT_CACHE_SIZE = 256
+
+# Progress of a request is sent at most this often (a new phase is always sent)
+PROGRESS_INTERVAL = 0.1
+
+# What clients can call, by name. Queries only read their file and run side by side. Jobs write files next to
+# their first argument, so the jobs on one file run one after another
+QUERIES = {function.__name__: function for function in [
+    main.get_t_commands, main.get_layers, main.layer_filament_order, main.swap_finder, main.swap_finder_fixer,
+    main.feature_locator_wformat, main.find_wipe_start_end, main.feature_identifier, main.get_layer_filament_sequences,
+    main.estimate_purge_costs, main.estimate_print_time, main.compare_print_times,
+    gcode_3mf.working_gcode_path, gcode_3mf.archive_t_commands,
+]}
+JOBS = {function.__name__: function for function in [
+    main.generate_swapped_gcode, main.generate_reordered_gcode, main.apply_swap_plan, main.calibration_off,
+    main.copy_features, main.generate_instructions, main.comment_feat_wipe, main.optimize_filament_order,
+    main.write_to_output_file_debug, main.apply_patch_files, main.upload_to_printer,
+    gcode_3mf.swap_first_plate, gcode_3mf.reorder_first_plate, gcode_3mf.process_archive, gcode_3mf.export_plate_file,
+]}
+
+
+class DaemonError(Exception):
+    # A request the daemon could not carry out, with the message of the error it raised
+    pass
+
+
+def daemon_address():
+    # The socket path (str) or localhost port (int) of the daemon, None if AMS_SWAPPER_DAEMON is 0
+    address = os.environ.get("AMS_SWAPPER_DAEMON")
+    if address == "0":
+        return None
+    if address:
+        return int(address) if address.isdigit() else address
+    if not hasattr(socket, "AF_UNIX"):
+        return DEFAULT_PORT
+    user = os.getuid() if hasattr(os, "getuid") else os.getlogin()
+    return os.path.join(tempfile.gettempdir(), f"ams_swapper_{user}.sock")
+
+
+def daemon_token_path(port):
+    return os.path.join(os.path.expanduser("~"), TOKEN_FILE_NAME.format(port=port))
+
+
+def write_daemon_token(port):
+    # A new token for the daemon on this port, in a file only this user can read
+    token_path = daemon_token_path(port)
+    if os.path.exists(token_path):
+        os.remove(token_path)
+    descriptor = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    token = secrets.token_hex(32)
+    with os.fdopen(descriptor, "w") as token_file:
+        token_file.write(token)
+    return token
+
+
+def read_daemon_token(port):
+    # The token of the daemon on this port, None if there is none
+    try:
+        with open(daemon_token_path(port)) as token_file:
+            return token_file.read().strip()
+    except OSError:
+        return None
+
+
+def to_json_data(value):
+    # Dicts with keys that aren't strings become pairs, so they come back the same from from_json_data
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: to_json_data(item) for key, item in value.items()}
+        return {PAIRS_KEY: [[to_json_data(key), to_json_data(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [to_json_data(item) for item in value]
+    return value
+
+
+def _from_json_object(value):
+    if len(value) == 1 and PAIRS_KEY in value:
+        return {tuple(key) if isinstance(key, list) else key: item for key, item in value[PAIRS_KEY]}
+    return value
+
+
+def from_json_data(text):
+    return json.loads(text, object_hook=_from_json_object)
+
+
+class _ThreadOutput(io.TextIOBase):
+    # sys.stdout of the daemon: what a request prints is collected for its reply, everything else goes on
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class AnalysisDaemon:
+    def __init__(self, workers=DEFAULT_WORKERS):
+        # Set when listening on a port, then every request must carry it
+        self.token = None
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.output = _ThreadOutput(sys.stdout)
+
+        # The first request on a file scans it while the others on that file wait, then they all share the index
+        self.scan_locks = {}
+        self.job_locks = {}
+
+        # Results of recent queries, least recently used first: {key: (result as JSON text, printed lines)}
+        self.results = {}
+
+    def _run(self, function, args, kwargs, progress):
+        # Call the function on a worker thread, returning (result as JSON text, printed lines)
+        messages = io.StringIO()
+        self.output.local.buffer = messages
+        try:
+            result = main.run_with_progress(functools.partial(function, *args, **kwargs), progress=progress)
+            return json.dumps(to_json_data(result)), messages.getvalue().splitlines()
+        except Exception as error:
+            error.messages = messages.getvalue().splitlines()
+            raise
+        finally:
+            self.output.local.buffer = None
+
+    def _result_key(self, name, args, kwargs):
+        # Query results are reused while the files among the arguments don't change, None if there are no files
+        signatures = []
+        for arg in args:
+            if isinstance(arg, str) and os.path.isfile(arg):
+                stat = os.stat(arg)
+                signatures.append((os.path.abspath(arg), stat.st_size, stat.st_mtime_ns))
+        if not signatures:
+            return None
+        return name, json.dumps([args, kwargs], sort_keys=True), tuple(signatures)
+
+    async def _warm_up(self, loop, file_path, progress):
+        # Index a G-code file once, before its requests run (if that request is cancelled, the next one does it)
+        if not isinstance(file_path, str) or not file_path.endswith(".gcode") or not os.path.isfile(file_path):
+            return
+        lock = self.scan_locks.setdefault(os.path.abspath(file_path), asyncio.Lock())
+        async with lock:
+            await loop.run_in_executor(self.executor, functools.partial(main.run_with_progress, get_gcode_index, file_path,
+                                                                        progress=progress))
+
+    def status(self):
+        return {"pid": os.getpid(), "indexes": cached_gcode_index_paths(),
+                "calls": {"queries": sorted(QUERIES), "jobs": sorted(JOBS)}}
+
+    async def handle_request(self, request, send, cancelled):
+        loop = asyncio.get_running_loop()
+        request_id = request.get("id")
+        name = request.get("call")
+        args = request.get("args", [])
+        kwargs = request.get("kwargs", {})
+        if name == "status":
+            send({"id": request_id, "messages": []}, json.dumps(self.status()))
+            return
+        if name not in QUERIES and name not in JOBS:
+            send({"id": request_id, "error": f"Unknown call '{name}'", "messages": []})
+            return
+
+        last_progress = ["", 0.0]
+
+        def progress(phase, done, total):
+            # Called on the worker thread, the reply is written by the event loop
+            if cancelled.is_set():
+                raise AnalysisCancelled()
+            now = time.monotonic()
+            if phase != last_progress[0] or now - last_progress[1] >= PROGRESS_INTERVAL:
+                last_progress[:] = [phase, now]
+                loop.call_soon_threadsafe(send, {"id": request_id, "progress": [phase, done, total]})
+
+        try:
+            if args:
+                await self._warm_up(loop, args[0], progress)
+            if name in JOBS:
+                lock = self.job_locks.setdefault(os.path.abspath(str(args[0])) if args else None, asyncio.Lock())
+                async with lock:
+                    result, messages = await loop.run_in_executor(self.executor, self._run, JOBS[name], args, kwargs, progress)
+            else:
+                key = self._result_key(name, args, kwargs)
+                if key in self.results:
+                    self.results[key] = self.results.pop(key)
+                    result, messages = self.results[key]
+                else:
+                    result, messages = await loop.run_in_executor(self.executor, self._run, QUERIES[name], args, kwargs, progress)
+                    if key is not None:
+                        self.results[key] = (result, messages)
+                        while len(self.results) > RESULT_CACHE_SIZE:
+                            self.results.pop(next(iter(self.results)))
+        except AnalysisCancelled:
+            send({"id": request_id, "error": "Cancelled", "cancelled": True, "messages": []})
+        except Exception as error:
+            send({"id": request_id, "error": f"{type(error).__name__}: {error}", "messages": getattr(error, "messages", [])})
+        else:
+            send({"id": request_id, "messages": messages}, result)
+
+    async def handle_connection(self, reader, writer):
+        # Requests are JSON lines {"id", "call", "args", "kwargs"} (and "token" on a port), answered by JSON lines with the same id as they
+        # finish: {"id", "progress": [phase, done, total]} while it runs, then {"id", "result", "messages"} or
+        # {"id", "error", "messages"}. {"cancel": id} stops a request, closing the connection stops all of them
+        cancel_events = {}
+        tasks = set()
+
+        def send(message, result=None):
+            # The result comes as JSON text already, encoded on the worker thread
+            if writer.is_closing():
+                return
+            line = json.dumps(message)
+            if result is not None:
+                line = line[:-1] + ', "result": ' + result + "}"
+            writer.write(line.encode() + b"\n")
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = from_json_data(line)
+                except ValueError:
+                    send({"id": None, "error": "Requests must be JSON lines", "messages": []})
+                    continue
+                if self.token is not None and not hmac.compare_digest(str(request.get("token")), self.token):
+                    send({"id": request.get("id"), "error": "Wrong or missing daemon token", "messages": []})
+                    break
+                if "cancel" in request:
+                    if request["cancel"] in cancel_events:
+                        cancel_events[request["cancel"]].set()
+                    continue
+                cancelled = cancel_events[request.get("id")] = threading.Event()
+                task = asyncio.create_task(self.handle_request(request, send, cancelled))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except ConnectionError:
+            pass
+        finally:
+            for cancelled in cancel_events.values():
+                cancelled.set()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    async def serve(self, address):
+        if isinstance(address, int):
+            self.token = write_daemon_token(address)
+            server = await asyncio.start_server(self.handle_connection, "127.0.0.1", address)
+        else:
+            # Only this user may connect: the daemon writes files as this user
+            if os.path.exists(address):
+                os.remove(address)
+            previous_umask = os.umask(0o077)
+            try:
+                server = await asyncio.start_unix_server(self.handle_connection, address)
+            finally:
+                os.umask(previous_umask)
+        print(f"Analysis daemon listening on {address if isinstance(address, str) else f'127.0.0.1:{address}'}.")
+        sys.stdout = self.output
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sys.stdout = self.output.stream
+            if isinstance(address, str) and os.path.exists(address):
+                os.remove(address)
+            elif isinstance(address, int) and read_daemon_token(address) == self.token:
+                os.remove(daemon_token_path(address))
+
+
+def connect(address=None):
+    # Open a connection to the running daemon, None if there is none
+    address = daemon_address() if address is None else address
+    if address is None:
+        return None
+    try:
+        if isinstance(address, int):
+            return socket.create_connection(("127.0.0.1", address), timeout=DAEMON_CONNECT_TIMEOUT)
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(DAEMON_CONNECT_TIMEOUT)
+        try:
+            connection.connect(address)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+    except OSError:
+        return None
+
+
+def daemon_running(address=None):
+    connection = connect(address)
+    if connection is None:
+        return False
+    connection.close()
+    return True
+
+
+def call_daemon(connection, name, *args, **kwargs):
+    # Make one request on an open connection: progress goes to this thread's progress callback, what the daemon
+    # printed is printed here. Results come back as JSON (tuples become lists, dict keys keep their type). Raises
+    # DaemonError if it failed
+    connection.settimeout(None)
+    request = {"id": 1, "call": name, "args": to_json_data(args), "kwargs": to_json_data(kwargs)}
+    if connection.family != getattr(socket, "AF_UNIX", None):
+        request["token"] = read_daemon_token(connection.getpeername()[1])
+    connection.sendall(json.dumps(request).encode() + b"\n")
+    with connection.makefile("rb") as replies:
+        for line in replies:
+            reply = from_json_data(line)
+            if "progress" in reply:
+                # A cancelled progress callback raises here, closing the connection cancels the request
+                report_progress(reply["progress"][1], reply["progress"][2], reply["progress"][0])
+                continue
+            for message in reply["messages"]:
+                print(message)
+            if reply.get("cancelled"):
+                raise AnalysisCancelled()
+            if "error" in reply:
+                raise DaemonError(reply["error"])
+            return reply["result"]
+    raise DaemonError("The analysis daemon closed the connection")
+
+
+def run_local(name, *args, **kwargs):
+    # Run one of the QUERIES or JOBS in this process
+    return (QUERIES.get(name) or JOBS[name])(*args, **kwargs)
+
+
+def call(name, *args, **kwargs):
+    # Run one of the QUERIES or JOBS on the daemon when one is running, otherwise in this process. File paths
+    # must be absolute, the daemon runs in its own directory
+    connection = connect()
+    if connection is None:
+        return run_local(name, *args, **kwargs)
+    with connection:
+        return call_daemon(connection, name, *args, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the analysis of recently used G-code files in memory and serve "
+                                                 "the GUI and command line from it.")
+    parser.add_argument("--socket", help="Unix socket to listen on (default: AMS_SWAPPER_DAEMON or a socket in the temporary directory)")
+    parser.add_argument("--port", type=int, help="listen on this localhost port instead of a Unix socket")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help=f"files kept in memory (default: {DEFAULT_CACHE_SIZE})")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help=f"requests run at the same time (default: {DEFAULT_WORKERS})")
+    args = parser.parse_args()
+
+    address = args.port or args.socket or daemon_address()
+    if address is None:
+        parser.error("AMS_SWAPPER_DAEMON is 0, give --socket or --port")
+    set_gcode_index_cache_size(args.cache_size)
+
+    # Worker processes (scans of big files, project plates) must not be forked from a process running threads
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("forkserver")
+    try:
+        asyncio.run(AnalysisDaemon(args.workers).serve(address))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,127 @@
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import main
+from gcode_index import get_gcode_index
+from profiler import start_profiling, stop_profiling, write_profile
+
+# Files written by this tool, skipped when a directory or glob is processed again
+OUTPUT_SUFFIXES = ["_swapped.gcode", "_cal_off_output.gcode", "_features.gcode", "_feature_comments.gcode"]
+
+
+def is_output_file(file_path):
+    return any(file_path.endswith(suffix) for suffix in OUTPUT_SUFFIXES)
+
+
+def expand_inputs(patterns):
+    # Turn files, directories (their .gcode files) and glob patterns into a sorted list of input files,
+    # leaving out the outputs of earlier runs
+    input_file_paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = glob.glob(os.path.join(pattern, "*.gcode"))
+        else:
+            matches = glob.glob(pattern) or ([pattern] if os.path.exists(pattern) else [])
+        for file_path in sorted(matches):
+            file_path = os.path.abspath(file_path)
+            if file_path.endswith(".gcode") and not is_output_file(file_path) and file_path not in input_file_paths:
+                input_file_paths.append(file_path)
+    return input_file_paths
+
+
+def process_file(input_file_path, swaps=(), calibration_off=False, profile=False):
+    # Analyze one file, apply the swaps and/or turn calibration off, and summarize what happened.
+    # Messages printed by main.py are collected instead of going to the console, the profile (if asked for)
+    # is written next to the file
+    summary = {
+        "input": input_file_path,
+        "ok": True,
+        "timings": {},
+        "toolchanges": None,
+        "layers": None,
+        "t_commands": None,
+        "outputs": [],
+        "failures": [],
+        "messages": []
+    }
+    messages = io.StringIO()
+    file_start = time.perf_counter()
+    if profile:
+        start_profiling()
+
+    def timed(step, function, *args):
+        step_start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            summary["timings"][step] = round(time.perf_counter() - step_start, 6)
+
+    try:
+        with contextlib.redirect_stdout(messages):
+            index = timed("analyze", get_gcode_index, input_file_path)
+            summary["toolchanges"] = len(index.comments[index.profile["comments"]["toolchange_start"]])
+            summary["layers"] = index.layer_count()
+            summary["t_commands"] = timed("t_commands", main.get_t_commands, input_file_path)
+
+            # The calibration is turned off in the swapped file when there is one
+            calibration_input_path = input_file_path
+            if swaps:
+                output_file_path = timed("swap", main.apply_swap_plan, input_file_path, swaps)
+                if output_file_path is None:
+                    summary["failures"].append("swap plan " + ", ".join(f"{t1} <-> {t2}" for t1, t2 in swaps) + " could not be applied")
+                else:
+                    summary["outputs"].append(output_file_path)
+                    calibration_input_path = output_file_path
+
+            if calibration_off:
+                output_file_path = timed("calibration_off", main.calibration_off, calibration_input_path)
+                if output_file_path is None:
+                    summary["failures"].append("calibration could not be turned off")
+                else:
+                    summary["outputs"].append(output_file_path)
+    except Exception as error:
+        summary["failures"].append(f"{type(error).__name__}: {error}")
+
+    if profile:
+        stop_profiling()
+        summary["profile"] = write_profile(input_file_path)
+
+    summary["ok"] = not summary["failures"]
+    summary["messages"] = messages.getvalue().splitlines()
+    summary["timings"]["total"] = round(time.perf_counter() - file_start, 6)
+    return summary
+
+
+def run_batch(input_file_paths, swaps=(), calibration_off=False, workers=None, profile=False):
+    # Process the files in a pool of worker processes (one per CPU by default) and summarize the run.
+    # Finished files are reported on stderr as they complete
+    workers = workers or os.cpu_count() or 1
+    batch_start = time.perf_counter()
+    summaries = {}
+
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(input_file_paths), 1))) as executor:
+        futures = {executor.submit(process_file, file_path, swaps, calibration_off, profile): file_path for file_path in input_file_paths}
+        for finished, future in enumerate(as_completed(futures), start=1):
+            file_path = futures[future]
+            try:
+                summaries[file_path] = future.result()
+            except Exception as error:
+                # The worker process itself failed (e.g. it was killed)
+                summaries[file_path] = {"input": file_path, "ok": False, "failures": [f"{type(error).__name__}: {error}"]}
+            status = "ok" if summaries[file_path]["ok"] else "failed"
+            print(f"[{finished}/{len(input_file_paths)}] {status}: {file_path}", file=sys.stderr)
+
+    files = [summaries[file_path] for file_path in input_file_paths]
+    return {
+        "workers": workers,
+        "swaps": [list(swap) for swap in swaps],
+        "calibration_off": calibration_off,
+        "seconds": round(time.perf_counter() - batch_start, 6),
+        "succeeded": sum(1 for summary in files if summary["ok"]),
+        "failed": sum(1 for summary in files if not summary["ok"]),
+        "files": files
+    }
@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import gcode_index
+import main
+
+TOOLCHANGE_COUNTS = [1000, 5000, 10000, 20000]
+
+def write_toolchange_file(output_file_path, toolchange_count, filaments=4):
+    # Write a minimal file made of Bambu Studio style M620/T/M621 toolchange blocks
+    with open(output_file_path, "w") as output_file:
+        output_file.write("; HEADER_BLOCK_START\n; HEADER_BLOCK_END\n")
+        for i in range(toolchange_count):
+            filament_number = i % filaments
+            output_file.write("; CP TOOLCHANGE START\n")
+            output_file.write(f"M620 S{filament_number}A\n")
+            output_file.write("M620.1 E F523 T240\n")
+            output_file.write(f"T{filament_number}\n")
+            output_file.write("M620.1 E F523 T240\n")
+            output_file.write(f"M621 S{filament_number}A\n")
+            output_file.write("; CP TOOLCHANGE END\n")
+            for j in range(5):
+                output_file.write(f"G1 X{j} Y{i % 250} E.1\n")
+
+def benchmark(toolchange_count, directory):
+    input_file_path = os.path.join(directory, f"toolchanges_{toolchange_count}.gcode")
+    write_toolchange_file(input_file_path, toolchange_count)
+
+    # Build the index first so only the pairing is timed
+    gcode_index.clear_gcode_index_cache()
+    start = time.perf_counter()
+    gcode_index.get_gcode_index(input_file_path)
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    m620_swaps, m621_swaps, t_swaps = main.swap_finder(input_file_path)
+    swap_finder_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    main.swap_finder_fixer(input_file_path, m620_swaps)
+    swap_finder_fixer_time = time.perf_counter() - start
+
+    return scan_time, swap_finder_time, swap_finder_fixer_time
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or TOOLCHANGE_COUNTS
+
+    print(f"{'toolchanges':>12} {'scan (s)':>10} {'swap_finder (s)':>16} {'fixer (s)':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for toolchange_count in counts:
+            scan_time, swap_finder_time, swap_finder_fixer_time = benchmark(toolchange_count, directory)
+            print(f"{toolchange_count:>12} {scan_time:>10.3f} {swap_finder_time:>16.3f} {swap_finder_fixer_time:>10.3f}")
@@ -0,0 +1,240 @@
+import argparse
+import math
+import random
+import re
+
+# Slicer version written in the header, the layout below follows its output
+SLICER_VERSION = "01.07.02.51"
+
+FLUSH_VOLUMES = [100, 150, 200, 280, 350, 420, 500, 600]
+FEATURES = ["Outer wall", "Inner wall", "Sparse infill", "Internal solid infill", "Top surface"]
+
+# The file is streamed in blocks of about this many lines (roughly 30 bytes each)
+WRITE_BLOCK_LINES = 128 * 1024
+
+SIZE_RE = re.compile(r"^(\d+(?:\.\d+)?)([kmg]?)b?$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_size(text):
+    # "500M", "2G", "64k" or a number of bytes
+    size_match = SIZE_RE.match(text.strip())
+    if not size_match:
+        raise argparse.ArgumentTypeError(f"invalid size '{text}'")
+    return int(float(size_match.group(1)) * SIZE_UNITS[size_match.group(2).lower()])
+
+
+def header_lines(layers, filaments, rng, layer_height=0.2, first_layer_height=0.2):
+    # Header (with the fields Bambu Studio writes), config block (with the settings the analysis reads) and the
+    # start of the executable block
+    filament_volume = math.pi * (1.75 / 2) ** 2 * 1000 / 1000
+    max_z_height = first_layer_height + (layers - 1) * layer_height
+    flush_volumes = [0 if i == j else rng.choice(FLUSH_VOLUMES) for i in range(filaments) for j in range(filaments)]
+    lines = [
+        "; HEADER_BLOCK_START",
+        f"; BambuStudio {SLICER_VERSION}",
+        "; model printing time: 1h 0m 0s; total estimated time: 1h 10m 0s",
+        f"; total layer number: {layers}",
+        "; total filament length [mm] : " + ",".join(["1000.00"] * filaments),
+        "; total filament volume [cm^3] : " + ",".join([f"{filament_volume:.2f}"] * filaments),
+        "; total filament weight [g] : " + ",".join([f"{filament_volume * 1.24:.2f}"] * filaments),
+        "; filament_density: " + ",".join(["1.24"] * filaments),
+        "; filament_diameter: " + ",".join(["1.75"] * filaments),
+        f"; max_z_height: {max_z_height:.2f}",
+        "; HEADER_BLOCK_END",
+        "",
+        "; CONFIG_BLOCK_START",
+        "; filament_colour = " + ";".join(f"#{rng.randrange(1 << 24):06X}" for _ in range(filaments)),
+        "; filament_density = " + ",".join(["1.24"] * filaments),
+        "; filament_diameter = " + ",".join(["1.75"] * filaments),
+        "; filament_type = " + ";".join(["PLA"] * filaments),
+        "; flush_multiplier = 1",
+        "; flush_volumes_matrix = " + ",".join(str(volume) for volume in flush_volumes),
+        "; layer_height = 0.2",
+        "; machine_load_filament_time = 29",
+        "; machine_unload_filament_time = 28",
+        "; nozzle_diameter = 0.4",
+        "; printer_model = Bambu Lab X1 Carbon",
+        "; CONFIG_BLOCK_END",
+        "",
+        "; EXECUTABLE_BLOCK_START",
+        "M73 P0 R70",
+        "M201 X20000 Y20000 Z500 E5000",
+        "M203 X500 Y500 Z20 E30",
+        "M204 S10000",
+        "M205 X9.00 Y9.00 Z3.00 E2.50",
+        ";===== machine: X1 =========================",
+        ";===== date: 20230630 ==================",
+        "M620 S0A",
+        "M620.1 E F523 T240",
+        "T0",
+        "M620.1 E F523 T240",
+        "M621 S0A",
+        "M109 S220",
+        ";===== extrinsic para cali paint =====",
+        "M1002 judge_flag extrude_cali_flag",
+        "M622 J1",
+        "M1002 gcode_claim_action : 8",
+    ]
+    for i in range(12):
+        lines.append(f"G1 X{68 + i * 2} Y-1 E{0.3 + i * 0.05:.2f} F1200")
+    lines += [
+        "M623",
+        ";===== turn off light and wait extrude temperature =====",
+        "M1002 gcode_claim_action : 0",
+        "M106 S0",
+        "M106 P2 S0",
+        "M960 S4 P0",
+        "M960 S5 P0",
+        "M109 S220",
+        "G1 X100 F20000",
+        "G1 Y100",
+        "M400",
+        "G29.1 Z0",
+        "M975 S1",
+        "G90",
+        "M83",
+        "M211 X0 Y0 Z0",
+        "M1007 S1",
+    ]
+    return lines
+
+
+def toolchange_lines(lines, toolchange_number, tool, z, rng):
+    # A Bambu Studio prime tower toolchange: filament end, the M620/T/M621 block, the wipe on the tower
+    # and the travel back to the print
+    append = lines.append
+    append("; CP TOOLCHANGE START")
+    append(f"; toolchange #{toolchange_number}")
+    append("; material : PLA -> PLA")
+    append(";--------------------")
+    append("M220 B")
+    append("M220 S100")
+    append("; WIPE_START")
+    append("G1 F24000")
+    append(f"G1 X{rng.uniform(20, 230):.3f} Y{rng.uniform(20, 230):.3f} E-.76")
+    append("; WIPE_END")
+    append("G1 E-.8 F1800")
+    append("; filament end gcode ")
+    append("M106 P3 S0")
+    append(f"M620 S{tool}A")
+    append("M204 S9000")
+    append(f"G1 Z{z + 3:.1f} F1200")
+    append("G1 Y295 F30000")
+    append("M620.1 E F523 T240")
+    append(f"T{tool}")
+    append("M620.1 E F523 T240")
+    append("M400")
+    for i in range(4):
+        append(f"G1 E{rng.uniform(5, 20):.3f} F523")
+    append(f"M621 S{tool}A")
+    append("G1 X165 Y245 F30000")
+    append(f"G1 Z{z:.2g}")
+    append("; CP TOOLCHANGE WIPE")
+    for i in range(8):
+        append(f"G1 X{165 + i * 2:.3f} Y{245 + (i % 2) * 3:.3f} E{rng.uniform(.1, .5):.5f}")
+    append("; CP TOOLCHANGE END")
+    append(";------------------")
+    append("G1 E-.04 F1800")
+    append(f"G1 X{rng.uniform(20, 230):.3f} Y{rng.uniform(20, 230):.3f} F30000")
+    append(f"G1 Z{z:.2g}")
+    append("G1 E.8 F1800")
+
+
+def feature_lines(lines, feature, moves, rng):
+    # One extrusion feature followed by its wipe and the travel to the next one
+    append = lines.append
+    uniform = rng.uniform
+    append(f"; FEATURE: {feature}")
+    append("; LINE_WIDTH: 0.45")
+    append("G1 F3000")
+    for i in range(moves):
+        append(f"G1 X{uniform(20, 230):.3f} Y{uniform(20, 230):.3f} E{uniform(.01, 1):.5f}")
+    append("; WIPE_START")
+    append("G1 F24000")
+    append(f"G1 X{uniform(20, 230):.3f} Y{uniform(20, 230):.3f} E-.76")
+    append("; WIPE_END")
+    append("G1 E-.04 F1800")
+    append(f"G1 X{uniform(20, 230):.3f} Y{uniform(20, 230):.3f} F30000")
+    append("G1 E.8 F1800")
+
+
+def layer_lines(layer_number, layers, filaments, moves, state, rng, layer_height=0.2, first_layer_height=0.2):
+    # One layer: every filament prints one feature, in a random order that starts with the loaded filament
+    z = first_layer_height + (layer_number - 1) * layer_height
+    order = list(range(filaments))
+    rng.shuffle(order)
+    if state["tool"] in order:
+        order.remove(state["tool"])
+        order.insert(0, state["tool"])
+
+    lines = []
+    append = lines.append
+    append("; CHANGE_LAYER")
+    append(f"; Z_HEIGHT: {z:.2g}")
+    append(f"; LAYER_HEIGHT: {first_layer_height if layer_number == 1 else layer_height:g}")
+    append("G1 E-.8 F1800")
+    append(f"; layer num/total_layer_count: {layer_number}/{layers}")
+    append("M622.1 S1")
+    append("M1002 judge_flag g39_detection_flag")
+    append(f"M73 L{layer_number}")
+    append(f"M991 S0 P{layer_number - 1} ;notify layer change")
+    for position, tool in enumerate(order):
+        if position > 0 or state["tool"] != tool:
+            state["toolchanges"] += 1
+            toolchange_lines(lines, state["toolchanges"], tool, z, rng)
+            state["tool"] = tool
+        feature_lines(lines, FEATURES[(layer_number + position) % len(FEATURES)], moves, rng)
+    append("M625")
+    return lines
+
+
+def footer_lines():
+    return ["M400", "M104 S0", "M140 S0", "M106 S0", "M73 P100 R0", "; EXECUTABLE_BLOCK_END", ""]
+
+
+def estimate_layer_count(target_size, filaments, moves, seed):
+    # Layers needed for a file of about target_size bytes, measured on a few sample layers
+    rng = random.Random(seed)
+    header_size = len("\n".join(header_lines(1, filaments, rng))) + 1
+    state = {"tool": 0, "toolchanges": 0}
+    sample_layers = 3
+    sample_size = sum(len("\n".join(layer_lines(layer_number, 999999, filaments, moves, state, rng))) + 1
+                      for layer_number in range(2, 2 + sample_layers))
+    return max(1, math.ceil((target_size - header_size) / (sample_size / sample_layers)))
+
+
+def write_gcode(output_file_path, layers=20, filaments=4, moves=40, seed=1, target_size=None):
+    # Write a synthetic Bambu Studio 1.7.2 style file, layer by layer so multi-GB files never sit in memory.
+    # With target_size (bytes) the number of layers is chosen to reach about that size.
+    # Returns the number of layers and toolchanges written
+    if target_size is not None:
+        layers = estimate_layer_count(target_size, filaments, moves, seed)
+
+    rng = random.Random(seed)
+    state = {"tool": 0, "toolchanges": 0}
+    with open(output_file_path, "w", newline="\n") as output_file:
+        block = header_lines(layers, filaments, rng)
+        for layer_number in range(1, layers + 1):
+            block += layer_lines(layer_number, layers, filaments, moves, state, rng)
+            if len(block) >= WRITE_BLOCK_LINES:
+                output_file.write("\n".join(block) + "\n")
+                block = []
+        block += footer_lines()
+        output_file.write("\n".join(block))
+    return layers, state["toolchanges"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic Bambu Studio 1.7.2 style G-code file.")
+    parser.add_argument("output_file_path")
+    parser.add_argument("--layers", type=int, default=20)
+    parser.add_argument("--filaments", type=int, default=4)
+    parser.add_argument("--moves", type=int, default=40, help="extrusion moves per feature")
+    parser.add_argument("--size", type=parse_size, default=None,
+                        help="approximate file size (e.g. 500M, 2G), overrides --layers")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    layers, toolchanges = write_gcode(args.output_file_path, args.layers, args.filaments, args.moves, args.seed, args.size)
+    print(f"Wrote {layers} layers and {toolchanges} toolchanges to '{args.output_file_path}'.")
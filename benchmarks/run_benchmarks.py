@@ -0,0 +1,279 @@
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The peak resident memory of the run is only recorded where there is a resource module (not on Windows)
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARK_DIR, "..")
+sys.path.insert(0, REPO_DIR)
+
+# The disk cache would turn every scan after the first into a cache load
+os.environ.setdefault("AMS_SWAPPER_CACHE", "0")
+
+import gcode_index
+import main
+from generate_gcode import parse_size, write_gcode
+
+# The tokenizer needs NumPy, it is only benchmarked when NumPy is installed
+try:
+    import gcode_tokens
+except ImportError:
+    gcode_tokens = None
+
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+
+# Layer count written in the header of the generated files
+HEADER_LAYERS_RE = re.compile(rb"^; total layer number: (\d+)", re.MULTILINE)
+
+# Generator settings of each scale (layers of 4 filaments, 3 toolchanges and about 9 kB per layer)
+SCALES = {
+    "small": {"layers": 20},
+    "medium": {"layers": 500},
+    "large": {"layers": 5000},
+}
+DEFAULT_SCALES = ["small", "medium"]
+
+# Results that are this much slower than the compared run are flagged, unless the difference is too small
+# to tell from timer noise
+REGRESSION_RATIO = 1.10
+REGRESSION_MIN_SECONDS = 0.005
+
+
+def output_file_paths(input_file_path):
+    # Every file the entry points can write next to the input
+    base = os.path.splitext(input_file_path)[0]
+    return [base + suffix for suffix in ["_swapped.gcode", "_cal_off_output.gcode", "_features.gcode",
+                                         "_feature_comments.gcode", "_instructions.txt", "_filament_plan.txt",
+                                         "_debug.txt"]]
+
+
+def swap_pair(input_file_path):
+    # Two layer 1 filaments that both have a feature to swap
+    t_commands = [info["t_command"] for info in main.feature_locator_wformat(input_file_path)]
+    t_commands = list(dict.fromkeys(t_commands))
+    if len(t_commands) < 2:
+        raise ValueError(f"'{input_file_path}' has less than two layer 1 features to swap")
+    return t_commands[0], t_commands[1]
+
+
+def check_layers(input_file_path):
+    # The layer table must have as many layers as the header says, header comments such as "; max_z_height: 1.00"
+    # must not be taken for layer comments
+    with open(input_file_path, "rb") as input_file:
+        header_match = HEADER_LAYERS_RE.search(input_file.read(4096))
+    layer_count = gcode_index.get_gcode_index(input_file_path).layer_count()
+    if header_match is not None and layer_count != int(header_match.group(1)):
+        raise ValueError(f"'{input_file_path}' has {header_match.group(1)} layers but {layer_count} were found")
+
+
+def entry_points(input_file_path):
+    # (name, function) of every public entry point, called with the index of the file already in memory
+    # except for "scan", which always builds it from scratch
+    t_command1, t_command2 = swap_pair(input_file_path)
+    m620_swaps = main.swap_finder(input_file_path)[0]
+    debug_file_path = os.path.splitext(input_file_path)[0] + "_debug.txt"
+
+    def scan():
+        gcode_index.clear_gcode_index_cache()
+        gcode_index.get_gcode_index(input_file_path)
+
+    points = [
+        ("scan", scan),
+        ("get_t_commands", lambda: main.get_t_commands(input_file_path)),
+        ("get_layers", lambda: main.get_layers(input_file_path)),
+        ("swap_finder", lambda: main.swap_finder(input_file_path)),
+        ("swap_finder_fixer", lambda: main.swap_finder_fixer(input_file_path, m620_swaps)),
+        ("feature_locator_wformat", lambda: main.feature_locator_wformat(input_file_path)),
+        ("find_wipe_start_end", lambda: main.find_wipe_start_end(input_file_path)),
+        ("feature_identifier", lambda: main.feature_identifier(input_file_path)),
+        ("modify_gcode_cal", lambda: main.calibration_off(input_file_path)),
+        ("copy_features", lambda: main.copy_features(input_file_path, t_command1, t_command2)),
+        ("generate_instructions", lambda: main.generate_instructions(input_file_path, t_command1, t_command2)),
+        ("generate_swapped_gcode", lambda: main.generate_swapped_gcode(input_file_path, t_command1, t_command2)),
+        ("comment_feat_wipe", lambda: main.comment_feat_wipe(input_file_path, t_command1, t_command2)),
+        ("estimate_purge_costs", lambda: main.estimate_purge_costs(input_file_path)),
+        ("optimize_filament_order", lambda: main.optimize_filament_order(input_file_path)),
+        ("write_to_output_file_debug", lambda: main.write_to_output_file_debug(debug_file_path, input_file_path)),
+    ]
+    if gcode_tokens is not None:
+        points.append(("tokenize", lambda: gcode_tokens.tokenize_file(input_file_path)))
+        points.append(("estimate_print_time", lambda: main.estimate_print_time(input_file_path)))
+    return points
+
+
+def time_call(function, repeat):
+    # Best wall clock time of 'repeat' calls
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory(function):
+    # Largest amount of memory allocated by Python during one call (mapped file pages are not included)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_file(input_file_path, repeat, selected=None, measure_memory=True):
+    # Time (and memory profile) every entry point on one file, printing the messages of main.py as usual
+    gcode_index.clear_gcode_index_cache()
+    check_layers(input_file_path)
+
+    results = {}
+    for name, function in entry_points(input_file_path):
+        if selected and name not in selected:
+            continue
+        seconds = time_call(function, repeat)
+        results[name] = {"seconds": seconds}
+        if measure_memory:
+            results[name]["peak_bytes"] = peak_memory(function)
+        print(f"  {name:<28} {seconds:>10.4f} s" + (f" {results[name]['peak_bytes'] / 1024 ** 2:>10.1f} MB" if measure_memory else ""),
+              file=sys.stderr)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": numpy_version,
+        "commit": git_commit(),
+    }
+
+
+def latest_results_file(exclude=None):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    names = sorted(name for name in os.listdir(RESULTS_DIR) if name.endswith(".json"))
+    paths = [os.path.join(RESULTS_DIR, name) for name in names]
+    paths = [path for path in paths if path != exclude]
+    return paths[-1] if paths else None
+
+
+def compare_results(previous, current):
+    # Print the time and memory of every benchmark relative to an earlier run. Returns the regressions found
+    regressions = []
+    print(f"Compared with {previous.get('date')} (commit {previous['environment'].get('commit')}):")
+    print(f"{'scale':<10} {'entry point':<28} {'before (s)':>11} {'after (s)':>11} {'ratio':>7} {'memory':>7}")
+    for scale, scale_results in current["scales"].items():
+        previous_results = previous["scales"].get(scale)
+        if previous_results is None or previous_results["file_size"] != scale_results["file_size"]:
+            continue
+        for name, result in scale_results["entry_points"].items():
+            before = previous_results["entry_points"].get(name)
+            if before is None:
+                continue
+            ratio = result["seconds"] / before["seconds"] if before["seconds"] else float("inf")
+            memory_ratio = ""
+            if "peak_bytes" in result and before.get("peak_bytes"):
+                memory_ratio = f"{result['peak_bytes'] / before['peak_bytes']:.2f}"
+            flag = ""
+            if ratio >= REGRESSION_RATIO and result["seconds"] - before["seconds"] >= REGRESSION_MIN_SECONDS:
+                flag = "  slower"
+                regressions.append((scale, name, ratio))
+            print(f"{scale:<10} {name:<28} {before['seconds']:>11.4f} {result['seconds']:>11.4f} {ratio:>7.2f} {memory_ratio:>7}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory profile the entry points of main.py on generated G-code files.")
+    parser.add_argument("--scales", nargs="+", default=DEFAULT_SCALES,
+                        help=f"scales to run: {', '.join(SCALES)} or a file size such as 200M or 2G (default: {' '.join(DEFAULT_SCALES)})")
+    parser.add_argument("--filaments", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="calls per entry point, the best time is kept")
+    parser.add_argument("--only", nargs="+", help="entry points to run (default: all)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory profile, which is slow on large files")
+    parser.add_argument("--files-dir", help="keep the generated files in this directory and reuse them on later runs")
+    parser.add_argument("--output", help=f"results file (default: a new file in {RESULTS_DIR})")
+    parser.add_argument("--compare", nargs="?", const="latest",
+                        help="compare with a results file (default: the latest one in the results directory)")
+    args = parser.parse_args()
+
+    results = {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "environment": environment(),
+        "repeat": args.repeat,
+        "scales": {}
+    }
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        files_dir = args.files_dir or temporary_dir
+        os.makedirs(files_dir, exist_ok=True)
+        for scale in args.scales:
+            settings = dict(SCALES[scale]) if scale in SCALES else {"target_size": parse_size(scale)}
+            input_file_path = os.path.join(files_dir, f"bench_{scale}_{args.filaments}f.gcode")
+            if not os.path.exists(input_file_path):
+                print(f"Generating {scale} file...", file=sys.stderr)
+                write_gcode(input_file_path, filaments=args.filaments, **settings)
+
+            print(f"{scale}: {os.path.getsize(input_file_path) / 1024 ** 2:.1f} MB", file=sys.stderr)
+            results["scales"][scale] = {
+                "file_size": os.path.getsize(input_file_path),
+                "settings": settings,
+                "filaments": args.filaments,
+                "entry_points": benchmark_file(input_file_path, args.repeat, args.only, not args.no_memory)
+            }
+            for output_file_path in output_file_paths(input_file_path):
+                if os.path.exists(output_file_path):
+                    os.remove(output_file_path)
+            gcode_index.clear_gcode_index_cache()
+
+    if resource is not None:
+        results["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    output_path = args.output
+    if output_path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output_path = os.path.join(RESULTS_DIR, f"{stamp}-{results['environment']['commit'] or 'unknown'}.json")
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print(f"Results written to '{output_path}'.", file=sys.stderr)
+
+    if args.compare:
+        previous_path = latest_results_file(exclude=os.path.abspath(output_path)) if args.compare == "latest" else args.compare
+        if previous_path is None:
+            print("No earlier results to compare with.", file=sys.stderr)
+        else:
+            with open(previous_path) as previous_file:
+                regressions = compare_results(json.load(previous_file), results)
+            if regressions:
+                sys.exit(1)
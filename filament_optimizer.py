@@ -0,0 +1,274 @@
+import math
+
+# Layers with more filaments than this are ordered with a heuristic instead of the exact search
+EXACT_FILAMENT_LIMIT = 8
+
+# Added to the flush volume of every toolchange, so equal volumes are broken by fewer toolchanges
+TOOLCHANGE_WEIGHT = 1.0
+
+# Estimates used when the config block doesn't have the setting
+DEFAULT_FILAMENT_DENSITY = 1.24
+DEFAULT_LOAD_FILAMENT_TIME = 29.0
+DEFAULT_UNLOAD_FILAMENT_TIME = 28.0
+FLUSH_VOLUMETRIC_SPEED = 10.0
+
+
+def config_floats(config, key):
+    # Parse a comma separated config setting into floats, [] if it is missing
+    value = config.get(key, "")
+    try:
+        return [float(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        return []
+
+
+def parse_flush_volumes(config):
+    # Read the from/to flush volume matrix (mm3) from the config block, scaled by the flush multiplier
+    values = config_floats(config, "flush_volumes_matrix")
+    filament_count = math.isqrt(len(values))
+    if not values or filament_count * filament_count != len(values):
+        raise ValueError("The config block has no usable flush_volumes_matrix")
+
+    multiplier = (config_floats(config, "flush_multiplier") or [1.0])[0]
+    return [[values[i * filament_count + j] * multiplier for j in range(filament_count)] for i in range(filament_count)]
+
+
+def flush_volume(flush_volumes, from_filament, to_filament):
+    # Flush volume of a toolchange, 0 for the first load or no change at all
+    if from_filament is None or from_filament == to_filament:
+        return 0.0
+    try:
+        return flush_volumes[from_filament][to_filament]
+    except IndexError:
+        raise ValueError(f"Filament T{max(from_filament, to_filament)} is not in the flush_volumes_matrix")
+
+
+def transition_cost(flush_volumes, from_filament, to_filament, toolchange_weight):
+    if from_filament is None or from_filament == to_filament:
+        return 0.0
+    return flush_volume(flush_volumes, from_filament, to_filament) + toolchange_weight
+
+
+def sequence_cost(sequence, flush_volumes, start=None):
+    # Total flush volume and number of toolchanges to print the filaments in order, starting from 'start'
+    volume = 0.0
+    toolchanges = 0
+    previous = start
+    for filament in sequence:
+        if previous is not None and filament != previous:
+            volume += flush_volume(flush_volumes, previous, filament)
+            toolchanges += 1
+        previous = filament
+    return volume, toolchanges
+
+
+def exact_paths(start, filaments, flush_volumes, toolchange_weight):
+    # Held-Karp bitmask dynamic program: the cheapest order of 'filaments' starting from 'start',
+    # for every possible last filament. Returns {last filament: (cost, order)}
+    count = len(filaments)
+    full_mask = (1 << count) - 1
+    cost = [[math.inf] * count for _ in range(1 << count)]
+    parent = [[-1] * count for _ in range(1 << count)]
+
+    # The filament that is already loaded is printed first for free
+    if start in filaments:
+        j = filaments.index(start)
+        cost[1 << j][j] = 0.0
+    else:
+        for j in range(count):
+            cost[1 << j][j] = transition_cost(flush_volumes, start, filaments[j], toolchange_weight)
+
+    step = [[transition_cost(flush_volumes, filaments[j], filaments[k], toolchange_weight) for k in range(count)]
+            for j in range(count)]
+
+    for mask in range(1, full_mask + 1):
+        mask_cost = cost[mask]
+        for j in range(count):
+            current = mask_cost[j]
+            if current == math.inf:
+                continue
+            step_j = step[j]
+            for k in range(count):
+                if mask & (1 << k):
+                    continue
+                next_mask = mask | (1 << k)
+                if current + step_j[k] < cost[next_mask][k]:
+                    cost[next_mask][k] = current + step_j[k]
+                    parent[next_mask][k] = j
+
+    paths = {}
+    for j in range(count):
+        if cost[full_mask][j] == math.inf:
+            continue
+        order = []
+        mask = full_mask
+        k = j
+        while k != -1:
+            order.append(filaments[k])
+            previous = parent[mask][k]
+            mask &= ~(1 << k)
+            k = previous
+        paths[filaments[j]] = (cost[full_mask][j], order[::-1])
+    return paths
+
+
+def heuristic_paths(start, filaments, flush_volumes, toolchange_weight):
+    # Nearest neighbour order improved with 2-opt moves, for layers too large for the exact search.
+    # Only returns the order it ends up with, as {last filament: (cost, order)}
+    remaining = list(filaments)
+    order = []
+    previous = start
+    if start in remaining:
+        remaining.remove(start)
+        order.append(start)
+    while remaining:
+        nearest = min(remaining, key=lambda filament: transition_cost(flush_volumes, previous, filament, toolchange_weight))
+        remaining.remove(nearest)
+        order.append(nearest)
+        previous = nearest
+
+    def order_cost(candidate):
+        total = 0.0
+        previous = start
+        for filament in candidate:
+            total += transition_cost(flush_volumes, previous, filament, toolchange_weight)
+            previous = filament
+        return total
+
+    # Reverse sections of the order while that makes it cheaper (the loaded filament stays first)
+    first_movable = 1 if start in filaments else 0
+    best_cost = order_cost(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(first_movable, len(order) - 1):
+            for j in range(i + 1, len(order)):
+                candidate = order[:i] + order[i:j + 1][::-1] + order[j + 1:]
+                candidate_cost = order_cost(candidate)
+                if candidate_cost < best_cost:
+                    order, best_cost, improved = candidate, candidate_cost, True
+
+    return {order[-1]: (best_cost, order)}
+
+
+def optimize_layer_orders(layer_sequences, flush_volumes, toolchange_weight=TOOLCHANGE_WEIGHT):
+    # Find the filament order of every layer that minimizes flush volume and toolchanges over the whole
+    # print. The loaded filament carries over to the next layer, so the layers are chained with a dynamic
+    # program over the last filament of each layer
+    path_cache = {}
+
+    def layer_paths(start, filaments):
+        key = (start, filaments)
+        if key not in path_cache:
+            if len(filaments) <= EXACT_FILAMENT_LIMIT:
+                path_cache[key] = exact_paths(start, list(filaments), flush_volumes, toolchange_weight)
+            else:
+                path_cache[key] = heuristic_paths(start, list(filaments), flush_volumes, toolchange_weight)
+        return path_cache[key]
+
+    # states: {loaded filament: (cost so far, index into history)}; history holds the chosen orders
+    states = {None: (0.0, -1)}
+    history = []
+    for sequence in layer_sequences:
+        filaments = tuple(sorted(set(sequence)))
+        new_states = {}
+        for start, (start_cost, history_index) in states.items():
+            if not filaments:
+                # Nothing to print, the loaded filament stays loaded
+                new_states[start] = (start_cost, (history_index, []))
+                continue
+            for last, (path_cost, order) in layer_paths(start, filaments).items():
+                total = start_cost + path_cost
+                if last not in new_states or total < new_states[last][0]:
+                    new_states[last] = (total, (history_index, order))
+
+        states = {}
+        for last, (total, entry) in new_states.items():
+            history.append(entry)
+            states[last] = (total, len(history) - 1)
+
+    # Walk back from the cheapest final state to collect the order of each layer
+    history_index = min(states.values())[1]
+    orders = []
+    while history_index != -1:
+        previous_index, order = history[history_index]
+        orders.append(order)
+        history_index = previous_index
+    return orders[::-1]
+
+
+def layer_transpositions(current_order, target_order):
+    # Pairs of filaments to swap, one after another, to turn the current order into the target order
+    order = list(current_order)
+    swaps = []
+    for i, filament in enumerate(target_order):
+        if order[i] != filament:
+            j = order.index(filament, i + 1)
+            swaps.append((order[i], order[j]))
+            order[i], order[j] = order[j], order[i]
+    return swaps
+
+
+def filament_plan(layer_sequences, config, toolchange_weight=TOOLCHANGE_WEIGHT):
+    # Optimize every layer and estimate the filament and time saved compared to the slicer's order
+    flush_volumes = parse_flush_volumes(config)
+    optimized_sequences = optimize_layer_orders(layer_sequences, flush_volumes, toolchange_weight)
+
+    densities = config_floats(config, "filament_density")
+    toolchange_seconds = ((config_floats(config, "machine_load_filament_time") or [DEFAULT_LOAD_FILAMENT_TIME])[0]
+                          + (config_floats(config, "machine_unload_filament_time") or [DEFAULT_UNLOAD_FILAMENT_TIME])[0])
+
+    def totals(sequences):
+        # Flush volume, grams (using the density of the filament being loaded) and toolchanges
+        volume = grams = 0.0
+        toolchanges = 0
+        previous = None
+        for sequence in sequences:
+            for filament in sequence:
+                if previous is not None and filament != previous:
+                    change_volume = flush_volume(flush_volumes, previous, filament)
+                    density = densities[filament] if filament < len(densities) else DEFAULT_FILAMENT_DENSITY
+                    volume += change_volume
+                    grams += change_volume * density / 1000
+                    toolchanges += 1
+                previous = filament
+        return volume, grams, toolchanges
+
+    layers = []
+    previous_current = previous_optimized = None
+    for layer_number, (current, optimized) in enumerate(zip(layer_sequences, optimized_sequences), start=1):
+        current_volume, current_toolchanges = sequence_cost(current, flush_volumes, previous_current)
+        optimized_volume, optimized_toolchanges = sequence_cost(optimized, flush_volumes, previous_optimized)
+        layers.append({
+            "layer": layer_number,
+            "current_order": [f"T{filament}" for filament in current],
+            "optimized_order": [f"T{filament}" for filament in optimized],
+            "current_flush_volume": current_volume,
+            "optimized_flush_volume": optimized_volume,
+            "current_toolchanges": current_toolchanges,
+            "optimized_toolchanges": optimized_toolchanges
+        })
+        previous_current = current[-1] if current else previous_current
+        previous_optimized = optimized[-1] if optimized else previous_optimized
+
+    current_volume, current_grams, current_toolchanges = totals(layer_sequences)
+    optimized_volume, optimized_grams, optimized_toolchanges = totals(optimized_sequences)
+    toolchanges_saved = current_toolchanges - optimized_toolchanges
+    volume_saved = current_volume - optimized_volume
+
+    # Swaps for layer 1, in the form generate_swapped_gcode applies them
+    first_layer_swaps = []
+    if layer_sequences and sorted(layer_sequences[0]) == sorted(optimized_sequences[0]):
+        first_layer_swaps = [(f"T{a}", f"T{b}") for a, b in layer_transpositions(layer_sequences[0], optimized_sequences[0])]
+
+    return {
+        "layers": layers,
+        "first_layer_swaps": first_layer_swaps,
+        "current_flush_volume": current_volume,
+        "optimized_flush_volume": optimized_volume,
+        "current_toolchanges": current_toolchanges,
+        "optimized_toolchanges": optimized_toolchanges,
+        "flush_volume_saved": volume_saved,
+        "grams_saved": current_grams - optimized_grams,
+        "minutes_saved": (toolchanges_saved * toolchange_seconds + volume_saved / FLUSH_VOLUMETRIC_SPEED) / 60
+    }
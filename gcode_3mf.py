@@ -0,0 +1,252 @@
+import copy
+import hashlib
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import batch
+from gcode_index import forget_gcode_index
+import main
+
+# Bambu Studio project archives with sliced plates
+ARCHIVE_SUFFIX = ".gcode.3mf"
+
+# The G-code of every plate, and the MD5 sidecar written next to it
+PLATE_RE = re.compile(r"^Metadata/plate_(\d+)\.gcode$")
+PLATE_MD5_SUFFIX = ".md5"
+
+# What the outputs of main.py add to a plate's file name
+PLATE_OUTPUT_RE = re.compile(r"^plate_\d+(.*)\.gcode$")
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Fixed part of a zip local file header, and the id of the Zip64 extra field
+LOCAL_HEADER_SIZE = 30
+ZIP64_EXTRA_ID = 0x0001
+DATA_DESCRIPTOR_FLAG = 0x08
+
+# Plates extracted for the GUI, by archive path: (size and mtime of the archive, temporary directory, plate path)
+_extracted_plates = {}
+
+
+def is_archive(file_path):
+    return file_path.lower().endswith(ARCHIVE_SUFFIX)
+
+
+def plate_number(member):
+    return int(PLATE_RE.match(member).group(1))
+
+
+def plate_members(archive):
+    # Names of the plate G-code members, by plate number
+    return sorted((name for name in archive.namelist() if PLATE_RE.match(name)), key=plate_number)
+
+
+def extract_plate(archive, member, directory):
+    # Stream a plate out of the archive into a file in 'directory', a block at a time. The analysis memory-maps
+    # its input, so the plate needs a real file, but it never sits in memory as a whole
+    plate_path = os.path.join(directory, os.path.basename(member))
+    with archive.open(member) as source, open(plate_path, "wb") as target:
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+    return plate_path
+
+
+def file_md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as input_file:
+        for block in iter(lambda: input_file.read(COPY_BUFFER_SIZE), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _strip_zip64_extra(extra):
+    # Remove the Zip64 field from a member's extra data, ZipInfo.FileHeader adds a new one when it is needed
+    stripped = b""
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_size = struct.unpack("<HH", extra[position:position + 4])
+        if field_id != ZIP64_EXTRA_ID:
+            stripped += extra[position:position + 4 + field_size]
+        position += 4 + field_size
+    return stripped
+
+
+def copy_member_raw(source, info, destination):
+    # Copy a member's compressed data as it is, without decompressing and compressing it again. zipfile has no
+    # public way to do this, so the member is registered with the destination the way ZipFile.write does it
+    source.fp.seek(info.header_offset)
+    name_length, extra_length = struct.unpack("<HH", source.fp.read(LOCAL_HEADER_SIZE)[26:30])
+    source.fp.seek(info.header_offset + LOCAL_HEADER_SIZE + name_length + extra_length)
+
+    # The sizes and CRC are known, so they go in the local header instead of a data descriptor
+    copied_info = copy.copy(info)
+    copied_info.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+    copied_info.extra = _strip_zip64_extra(info.extra)
+    copied_info.header_offset = destination.fp.tell()
+    destination.fp.write(copied_info.FileHeader())
+
+    remaining = info.compress_size
+    while remaining > 0:
+        block = source.fp.read(min(COPY_BUFFER_SIZE, remaining))
+        if not block:
+            raise zipfile.BadZipFile(f"'{info.filename}' is truncated")
+        destination.fp.write(block)
+        remaining -= len(block)
+
+    destination.filelist.append(copied_info)
+    destination.NameToInfo[copied_info.filename] = copied_info
+    destination.start_dir = destination.fp.tell()
+    destination._didModify = True
+
+
+def write_member_file(destination, info, file_path):
+    # Compress a file into the archive in place of the member described by 'info'
+    new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.external_attr = info.external_attr
+    new_info.file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as source, destination.open(new_info, "w") as target:
+        shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+
+
+def write_archive(archive_path, output_archive_path, replacements):
+    # Write a copy of the archive with the plates in 'replacements' ({member: G-code file path}) replaced and
+    # their MD5 sidecars updated. Every other member is copied without recompression
+    md5_members = {member + PLATE_MD5_SUFFIX: member for member in replacements}
+    temp_path = f"{output_archive_path}.{os.getpid()}.tmp"
+    try:
+        with zipfile.ZipFile(archive_path) as source, zipfile.ZipFile(temp_path, "w") as destination:
+            for info in source.infolist():
+                if info.filename in replacements:
+                    write_member_file(destination, info, replacements[info.filename])
+                elif info.filename in md5_members:
+                    # Keep the letter case the slicer used for the digest
+                    old_md5 = source.read(info).decode("ascii", "replace").strip()
+                    new_md5 = file_md5(replacements[md5_members[info.filename]])
+                    destination.writestr(info, new_md5.upper() if old_md5.isupper() else new_md5)
+                else:
+                    copy_member_raw(source, info, destination)
+        os.replace(temp_path, output_archive_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def output_archive_path(archive_path, plate_output_path):
+    # Name the new archive after the plate's output, e.g. "plate_1_swapped.gcode" gives "project_swapped.gcode.3mf"
+    suffix = PLATE_OUTPUT_RE.match(os.path.basename(plate_output_path)).group(1)
+    return archive_path[:-len(ARCHIVE_SUFFIX)] + suffix + ARCHIVE_SUFFIX
+
+
+def process_archive(archive_path, swaps=(), calibration_off=False, workers=None, plates=None):
+    # Apply the swaps and/or turn calibration off on the plates of an archive (all of them, or the plate numbers
+    # in 'plates'), processing the plates concurrently, and write the result to a new archive.
+    # Returns a summary like batch.run_batch's, with the new archive as "output" (None if nothing changed)
+    summary = {"input": archive_path, "output": None, "plates": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        with zipfile.ZipFile(archive_path) as archive:
+            members = [member for member in plate_members(archive) if plates is None or plate_number(member) in plates]
+            plate_paths = [extract_plate(archive, member, directory) for member in members]
+        if not members:
+            summary["failures"] = ["no sliced plates found"]
+            return summary
+
+        # One worker process per plate (up to one per CPU), a single plate is processed right here
+        workers = min(workers or os.cpu_count() or 1, len(members))
+        if workers == 1:
+            plate_summaries = [batch.process_file(plate_path, swaps, calibration_off) for plate_path in plate_paths]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                plate_summaries = list(executor.map(batch.process_file, plate_paths, repeat(swaps), repeat(calibration_off)))
+
+        # The last output of each plate replaces it
+        replacements = {}
+        for member, plate_summary in zip(members, plate_summaries):
+            if plate_summary["outputs"]:
+                replacements[member] = plate_summary["outputs"][-1]
+            plate_summary["input"] = member
+            plate_summary["outputs"] = [os.path.basename(output) for output in plate_summary["outputs"]]
+            summary["plates"][member] = plate_summary
+
+        if replacements:
+            summary["output"] = output_archive_path(archive_path, next(iter(replacements.values())))
+            write_archive(archive_path, summary["output"], replacements)
+
+        # The temporary files won't be seen again, drop their cached analysis
+        for plate_path in plate_paths + list(replacements.values()):
+            forget_gcode_index(plate_path)
+
+    summary["failures"] = [f"{member}: {failure}" for member, plate_summary in summary["plates"].items()
+                           for failure in plate_summary["failures"]]
+    return summary
+
+
+def archive_t_commands(archive_path):
+    # The layer 1 T commands of every plate, as {member: [T commands]}
+    t_commands = {}
+    with tempfile.TemporaryDirectory() as directory, zipfile.ZipFile(archive_path) as archive:
+        for member in plate_members(archive):
+            plate_path = extract_plate(archive, member, directory)
+            t_commands[member] = main.get_t_commands(plate_path)
+            forget_gcode_index(plate_path)
+    return t_commands
+
+
+def working_gcode_path(input_file_path):
+    # The G-code file the analysis works on: the file itself, or the first plate of an archive extracted to a
+    # temporary directory (extracted again only when the archive changes)
+    if not is_archive(input_file_path):
+        return input_file_path
+    stat = os.stat(input_file_path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    extracted = _extracted_plates.get(input_file_path)
+    if extracted is None or extracted[0] != signature:
+        directory = tempfile.TemporaryDirectory()
+        with zipfile.ZipFile(input_file_path) as archive:
+            members = plate_members(archive)
+            if not members:
+                raise ValueError(f"No sliced plates found in '{input_file_path}'")
+            plate_path = extract_plate(archive, members[0], directory.name)
+        extracted = _extracted_plates[input_file_path] = (signature, directory, plate_path)
+    return extracted[2]
+
+
+def swap_first_plate(archive_path, t_command1, t_command2):
+    # The GUI's "Generate Swap" for an archive: the instructions and features files of the first plate go next to
+    # the archive, the swapped plate into a new archive. Returns the summary of process_archive
+    plate_path = working_gcode_path(archive_path)
+    main.generate_instructions(plate_path, t_command1, t_command2)
+    features_path = main.copy_features(plate_path, t_command1, t_command2)
+    export_plate_file(archive_path, os.path.splitext(plate_path)[0] + "_instructions.txt")
+    if features_path is not None:
+        export_plate_file(archive_path, features_path)
+    plate = plate_number("Metadata/" + os.path.basename(plate_path))
+    return process_archive(archive_path, [(t_command1, t_command2)], plates=[plate])
+
+
+def reorder_first_plate(archive_path, t_command_order):
+    # The GUI's "Generate Reorder" for an archive: the new layer 1 order of the first plate is applied as the swap
+    # plan that leads to it, in one pass. Returns the summary of process_archive
+    plate_path = working_gcode_path(archive_path)
+    current_order = main.layer_filament_order(plate_path)
+    if sorted(t_command_order) != sorted(current_order):
+        failure = f"the new order must list each T command of layer 1 once: {' '.join(current_order)}"
+        return {"input": archive_path, "output": None, "plates": {}, "failures": [failure]}
+    swaps = main.order_swaps(current_order, t_command_order)
+    if not swaps:
+        return {"input": archive_path, "output": None, "plates": {}, "failures": ["the plate is already in this order"]}
+    plate = plate_number("Metadata/" + os.path.basename(plate_path))
+    return process_archive(archive_path, swaps, plates=[plate])
+
+
+def export_plate_file(archive_path, plate_file_path):
+    # Move a text file written for an extracted plate (instructions, debug, plan) next to the archive,
+    # e.g. "plate_1_instructions.txt" becomes "project_plate_1_instructions.txt". Returns the new path
+    export_path = archive_path[:-len(ARCHIVE_SUFFIX)] + "_" + os.path.basename(plate_file_path)
+    shutil.move(plate_file_path, export_path)
+    return export_path
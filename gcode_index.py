@@ -0,0 +1,609 @@
+import hashlib
+import multiprocessing
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from analysis_cache import forget_cached_analysis, load_cached_analysis, load_previous_analysis, store_cached_analysis
+from gcode_scanner import (CHUNK_MAX_SIZE, chunk_bounds, chunk_record, compile_term_matcher, content_chunks, count_lines,
+                           count_newlines, find_first_command_line, find_first_matches, find_term_groups_in_map,
+                           find_terms_in_map, line_offset_table, line_start_offsets, map_gcode_file,
+                           pack_line_table, unpack_line_table)
+from profiler import count_file_read, profiled
+from progress import report_progress
+from slicer_profiles import DEFAULT_PROFILE, file_profile, get_profile
+
+# Commands recorded on non-comment lines (case insensitive, same as gcode_command_locator)
+INDEX_COMMANDS = ["M620", "M621", "M620 S", "T"]
+
+# Comments (case insensitive, same as gcode_comments_locator), markers (case sensitive) and the layer comment come
+# from the slicer profile of the file (see slicer_profiles). Every layer starts with a layer comment, the previous
+# layer ends a few lines above it
+
+M620_FILAMENT_RE = re.compile(r"S(\d+)A")
+
+TOOL_REFERENCE_RE = re.compile(rb"T(\d+)")
+
+# Files this big are scanned by one process per CPU (AMS_SWAPPER_SCAN_WORKERS sets how many, 1 turns it off).
+# Each process scans parts of whole chunks, of up to PARALLEL_SCAN_PART_SIZE bytes
+PARALLEL_SCAN_MIN_SIZE = 64 * 1024 * 1024
+PARALLEL_SCAN_PART_SIZE = 64 * 1024 * 1024
+
+# "; key = value" settings in the slicer's config block
+CONFIG_LINE_RE = re.compile(r"^;\s*([A-Za-z0-9_]+)\s*=\s*(.*)$")
+
+# Bump whenever the fields recorded by GcodeIndex change, so stale cached indexes are rebuilt
+INDEX_VERSION = 9
+
+# Indexes kept in memory, keyed by absolute path. The lock lets threads share them (the analysis daemon)
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+_index_cache_size = {"entries": 4}
+
+# Patterns compiled for each slicer profile, keyed by profile name
+_profile_patterns = {}
+
+
+class GcodeIndex:
+    def __init__(self, input_file_path, scan=True, previous=None, profile=None):
+        self.input_file_path = input_file_path
+        self.line_count = 0
+        self.first_command_line = None
+
+        # Markers and offsets of the slicer version that wrote the file, picked from its header
+        if profile is None:
+            profile = file_profile(input_file_path) if scan else DEFAULT_PROFILE
+        self.profile = profile
+
+        # Line numbers for each command, and each comment and marker of the profile
+        self.commands = {command: [] for command in INDEX_COMMANDS}
+        self.comments = {comment: [] for comment in profile["comments"].values()}
+        self.markers = {marker: [] for marker in profile["markers"].values()}
+
+        # Stripped text of every line holding one of the indexed commands
+        self.command_text = {}
+
+        # Byte offset where each line holding one of the indexed comments or markers starts
+        self.line_offsets = {}
+
+        # Filament number of each "M620 SiA" line
+        self.m620_filaments = {}
+
+        # Line numbers and text of the bare "Ti" tool change lines
+        self.tool_lines = []
+        self.tool_commands = {}
+
+        # Line numbers and numbers of every "T<digits>" reference, for swap_finder_fixer
+        self.tool_reference_lines = []
+        self.tool_reference_numbers = []
+
+        # Layer table: layer comment line and offset, Z height, first and last line and byte range of every layer,
+        # in print order
+        self.layer_comment_lines = []
+        self.layer_comment_offsets = []
+        self.layer_z = []
+        self.layer_start_lines = []
+        self.layer_end_lines = []
+        self.layer_start_offsets = []
+        self.layer_end_offsets = []
+
+        # Settings from the slicer's config block, as strings
+        self.config = {}
+
+        # Start offset of every line (see line_offset_table), built the first time it is needed. It is cached apart
+        # from the rest of the index, so only the analyses that read lines load it
+        self._line_table = None
+
+        # Hash, newline count and size of every chunk of the file (see content_chunks), so the next analysis of a
+        # re-exported file only has to scan the chunks that changed
+        self.chunks = []
+
+        # A scan reuses what it can of 'previous', the index of an earlier version of the file written by the same
+        # slicer version
+        if scan and previous is not None and previous.chunks and previous.profile["name"] == profile["name"]:
+            self._rescan(previous)
+        elif scan:
+            self._scan()
+
+    @profiled
+    def _scan(self):
+        # Search the memory-mapped file for every marker instead of looping over lines in Python
+        with open(self.input_file_path, "rb") as input_file:
+            data = map_gcode_file(input_file)
+            if data is None:
+                count_file_read()
+                return
+            with data:
+                workers = scan_workers(len(data))
+                if workers > 1:
+                    self._scan_parallel(data, workers)
+                else:
+                    self._scan_map(data)
+                count_file_read(bytes_read=len(data), lines_scanned=self.line_count)
+
+    def _scan_map(self, data):
+        size = len(data)
+        report_progress(0, size, "Counting lines")
+        self.line_count = count_lines(data)
+        self.first_command_line = find_first_command_line(data)
+        self._scan_lines(data)
+
+        report_progress(0, size, "Finding layers")
+        self._scan_layers(data)
+        self._scan_config(data)
+
+        report_progress(0, size, "Hashing chunks")
+        chunks = content_chunks(data, profile_patterns(self.profile)["chunk_anchor"])
+        self.chunks = [[chunk_hash, newlines, end - start] for start, end, newlines, chunk_hash in chunks]
+
+    def _scan_parallel(self, data, workers):
+        # Split the file into parts of whole chunks and scan them in worker processes, each mapping the file
+        # itself. The parts are numbered with the lines and offsets where they start in the file, and their records
+        # are joined in file order, so the START/END comments of a toolchange are paired the same way whatever
+        # part they are in
+        size = len(data)
+        report_progress(0, size, "Splitting the file")
+        part_size = min(PARALLEL_SCAN_PART_SIZE, max(size // (workers * 4), CHUNK_MAX_SIZE))
+        parts = scan_parts(chunk_bounds(data, profile_patterns(self.profile)["chunk_anchor"]), part_size)
+        first_lines = [1]
+        for part in parts:
+            first_lines.append(first_lines[-1] + count_newlines(data, part[0][0], part[-1][1]))
+
+        report_progress(0, size, "Scanning in parallel")
+        with ProcessPoolExecutor(max_workers=min(workers, len(parts))) as executor:
+            futures = [executor.submit(_scan_part, self.input_file_path, part, first_line, self.profile["name"])
+                       for part, first_line in zip(parts, first_lines)]
+            try:
+                for part, future in zip(parts, futures):
+                    part_index, part_chunks = future.result()
+                    self._append_lines(part_index)
+                    self.chunks.extend(part_chunks)
+                    report_progress(part[-1][1], size)
+            except BaseException:
+                # Don't start the parts that are left when the scan is cancelled or fails
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        self.line_count = first_lines[-1] - 1 if data[size - 1:size] == b"\n" else first_lines[-1]
+        self.first_command_line = find_first_command_line(data)
+        report_progress(0, size, "Finding layers")
+        self._scan_layers(data)
+        self._scan_config(data)
+
+    def _append_lines(self, part_index):
+        # Append the records of a part of the file scanned after the ones already recorded
+        for found, recorded in ((part_index.commands, self.commands), (part_index.comments, self.comments),
+                                (part_index.markers, self.markers)):
+            for term, lines in found.items():
+                recorded[term].extend(lines)
+        self.command_text.update(part_index.command_text)
+        self.line_offsets.update(part_index.line_offsets)
+        self.m620_filaments.update(part_index.m620_filaments)
+        self.tool_lines.extend(part_index.tool_lines)
+        self.tool_commands.update(part_index.tool_commands)
+        self.tool_reference_lines.extend(part_index.tool_reference_lines)
+        self.tool_reference_numbers.extend(part_index.tool_reference_numbers)
+        self.layer_comment_lines.extend(part_index.layer_comment_lines)
+        self.layer_comment_offsets.extend(part_index.layer_comment_offsets)
+        self.layer_z.extend(part_index.layer_z)
+
+    def _scan_lines(self, data, first_line=1, first_offset=0):
+        # Record the indexed lines of a buffer of whole lines, which starts at line 'first_line' and byte
+        # 'first_offset' of the file. Records are appended, so buffers must be scanned in file order
+        size = len(data)
+        line_shift = first_line - 1
+        command_text = {}
+
+        report_progress(0, size, "Finding commands")
+        commands = find_terms_in_map(data, INDEX_COMMANDS, comments=False, line_texts=command_text)
+
+        # The comments, markers and layer comments of the profile are found together, in one pass
+        report_progress(0, size, "Finding comments and markers")
+        patterns = profile_patterns(self.profile)
+        (comments, markers, layer_comments), found_offsets = find_term_groups_in_map(data, patterns["matcher"])
+
+        for found, recorded in ((commands, self.commands), (comments, self.comments), (markers, self.markers)):
+            for term, lines in found.items():
+                recorded[term].extend(line + line_shift for line in lines)
+        for line_number, text in command_text.items():
+            self.command_text[line_number + line_shift] = text
+        for found in (comments, markers):
+            for lines in found.values():
+                for line_number in lines:
+                    self.line_offsets[line_number + line_shift] = found_offsets[line_number] + first_offset
+
+        for line_number in commands["M620"]:
+            filament_number_match = M620_FILAMENT_RE.search(command_text[line_number])
+            if filament_number_match:
+                self.m620_filaments[line_number + line_shift] = int(filament_number_match.group(1))
+
+        # The first "T<digits>" of each line, and the lines holding nothing but a "Ti" command
+        report_progress(0, size, "Finding tool changes")
+        for line_number, groups, line in find_first_matches(data, TOOL_REFERENCE_RE):
+            self.tool_reference_lines.append(line_number + line_shift)
+            self.tool_reference_numbers.append(int(groups[0]))
+            if line.startswith("T") and line[1:].isdigit():
+                self.tool_lines.append(line_number + line_shift)
+                self.tool_commands[line_number + line_shift] = line
+
+        # Every layer starts at a layer comment, which holds its Z height
+        for z_height_line in layer_comments[self.profile["layer_comment"]]:
+            line_start = found_offsets[z_height_line]
+            line_stop = data.find(b"\n", line_start)
+            z_height_text = data[line_start:line_stop if line_stop != -1 else size].decode("utf-8", "replace")
+            z_height_match = patterns["z_height"].match(z_height_text)
+            if z_height_match is None:
+                continue
+            self.layer_comment_lines.append(z_height_line + line_shift)
+            self.layer_comment_offsets.append(line_start + first_offset)
+            self.layer_z.append(float(z_height_match.group(1)) if z_height_match.group(1) else None)
+
+    def _copy_lines(self, previous, first_line, last_line, line_shift, offset_shift):
+        # Append the records of lines first_line to last_line of 'previous', moved by line_shift lines and
+        # offset_shift bytes
+        def between(lines):
+            return lines[bisect_left(lines, first_line):bisect_right(lines, last_line)]
+
+        for found, recorded in ((previous.commands, self.commands), (previous.comments, self.comments),
+                                (previous.markers, self.markers)):
+            for term, lines in found.items():
+                recorded[term].extend(line + line_shift for line in between(lines))
+        for term in INDEX_COMMANDS:
+            for line_number in between(previous.commands[term]):
+                self.command_text[line_number + line_shift] = previous.command_text[line_number]
+        for line_number in between(previous.commands["M620"]):
+            if line_number in previous.m620_filaments:
+                self.m620_filaments[line_number + line_shift] = previous.m620_filaments[line_number]
+        for found in (previous.comments, previous.markers):
+            for lines in found.values():
+                for line_number in between(lines):
+                    self.line_offsets[line_number + line_shift] = previous.line_offsets[line_number] + offset_shift
+
+        for line_number in between(previous.tool_lines):
+            self.tool_lines.append(line_number + line_shift)
+            self.tool_commands[line_number + line_shift] = previous.tool_commands[line_number]
+        first = bisect_left(previous.tool_reference_lines, first_line)
+        last = bisect_right(previous.tool_reference_lines, last_line)
+        self.tool_reference_lines.extend(line + line_shift for line in previous.tool_reference_lines[first:last])
+        self.tool_reference_numbers.extend(previous.tool_reference_numbers[first:last])
+        first = bisect_left(previous.layer_comment_lines, first_line)
+        last = bisect_right(previous.layer_comment_lines, last_line)
+        self.layer_comment_lines.extend(line + line_shift for line in previous.layer_comment_lines[first:last])
+        self.layer_comment_offsets.extend(offset + offset_shift for offset in previous.layer_comment_offsets[first:last])
+        self.layer_z.extend(previous.layer_z[first:last])
+
+    @profiled
+    def _rescan(self, previous):
+        # Hash the chunks of the file and scan only those that aren't in 'previous', copying the records of the
+        # others from it (moved to their new lines and offsets)
+        with open(self.input_file_path, "rb") as input_file:
+            data = map_gcode_file(input_file)
+            if data is None:
+                count_file_read()
+                return
+            with data:
+                size = len(data)
+                report_progress(0, size, "Hashing chunks")
+                chunks = content_chunks(data, profile_patterns(self.profile)["chunk_anchor"])
+
+                # First line and offset of every chunk of the previous version
+                previous_chunks = {}
+                line_number, offset = 1, 0
+                for chunk_hash, newlines, chunk_size in previous.chunks:
+                    previous_chunks.setdefault(chunk_hash, (line_number, offset))
+                    line_number += newlines
+                    offset += chunk_size
+
+                line_number = 1
+                lines_scanned = 0
+                for start, end, newlines, chunk_hash in chunks:
+                    last_line = line_number + newlines - (1 if data[end - 1:end] == b"\n" else 0)
+                    if chunk_hash in previous_chunks:
+                        previous_line, previous_offset = previous_chunks[chunk_hash]
+                        self._copy_lines(previous, previous_line, previous_line + last_line - line_number,
+                                         line_number - previous_line, start - previous_offset)
+                    else:
+                        report_progress(start, size, "Scanning changed chunks")
+                        self._scan_lines(data[start:end], line_number, start)
+                        lines_scanned += last_line - line_number + 1
+                    line_number += newlines
+
+                self.chunks = [[chunk_hash, newlines, end - start] for start, end, newlines, chunk_hash in chunks]
+                self.line_count = line_number - 1 if data[size - 1:size] == b"\n" else line_number
+                self.first_command_line = find_first_command_line(data)
+                report_progress(0, size, "Finding layers")
+                self._scan_layers(data)
+                self._scan_config(data)
+                count_file_read(bytes_read=size, lines_scanned=lines_scanned)
+
+    def _scan_layers(self, data):
+        # Layer 1 starts at the first command, the others at the line above their layer comment
+        z_height_lines = self.layer_comment_lines
+        if not z_height_lines:
+            return
+        layer_end_offset = self.profile["offsets"]["layer_end"]
+
+        for i, z_height_line in enumerate(z_height_lines):
+            self.layer_start_lines.append((self.first_command_line or 1) if i == 0 else z_height_line - layer_end_offset + 1)
+            if i + 1 < len(z_height_lines):
+                self.layer_end_lines.append(z_height_lines[i + 1] - layer_end_offset)
+            else:
+                self.layer_end_lines.append(self.line_count)
+
+        # Byte ranges, so a layer can be copied or mapped without counting lines again. The layers after the first
+        # start a few lines above their comment, found by looking back from where the comment starts
+        next_layer_offsets = []
+        for comment_offset in self.layer_comment_offsets[1:]:
+            line_start = comment_offset
+            for _ in range(layer_end_offset - 1):
+                line_start = data.rfind(b"\n", 0, line_start - 1) + 1
+            next_layer_offsets.append(line_start)
+        first_layer_offset = line_start_offsets(data, [self.layer_start_lines[0]]).get(self.layer_start_lines[0], len(data))
+        self.layer_start_offsets = [first_layer_offset] + next_layer_offsets
+        self.layer_end_offsets = next_layer_offsets + [len(data)]
+
+    def _scan_config(self, data):
+        # Parse the "; key = value" lines between the config block markers
+        start_lines = self.comments[self.profile["comments"]["config_start"]]
+        end_lines = [line for line in self.comments[self.profile["comments"]["config_end"]]
+                     if start_lines and line > start_lines[0]]
+        if not start_lines or not end_lines:
+            return
+
+        line_offsets = line_start_offsets(data, [start_lines[0] + 1, end_lines[0]])
+        config_text = data[line_offsets.get(start_lines[0] + 1, 0):line_offsets.get(end_lines[0], 0)].decode("utf-8", "replace")
+        for line in config_text.splitlines():
+            config_match = CONFIG_LINE_RE.match(line.strip())
+            if config_match:
+                self.config[config_match.group(1)] = config_match.group(2).strip()
+
+    def layer_count(self):
+        return len(self.layer_start_lines)
+
+    def layer_bounds(self, layer_number):
+        # First and last line of a layer (numbered from 1), (None, None) if there is no such layer
+        if not 1 <= layer_number <= len(self.layer_start_lines):
+            return None, None
+        return self.layer_start_lines[layer_number - 1], self.layer_end_lines[layer_number - 1]
+
+    def layer_of_line(self, line_number):
+        # Number of the layer holding the line, None for the header before layer 1
+        i = bisect_right(self.layer_start_lines, line_number) - 1
+        if i < 0 or line_number > self.layer_end_lines[i]:
+            return None
+        return i + 1
+
+    def layer_tool_lines(self, layer_number):
+        # Line numbers of the "Ti" tool changes inside a layer
+        start_line, end_line = self.layer_bounds(layer_number)
+        if start_line is None:
+            return []
+        return self.tool_lines[bisect_left(self.tool_lines, start_line):bisect_right(self.tool_lines, end_line)]
+
+    def active_tool_line(self, line_number):
+        # Line of the "Ti" tool change in effect at a line (the last one at or before it), None before the first
+        i = bisect_right(self.tool_lines, line_number) - 1
+        return self.tool_lines[i] if i >= 0 else None
+
+    def active_tool(self, line_number):
+        # The "Ti" command in effect at a line, None before the first tool change
+        tool_line = self.active_tool_line(line_number)
+        return self.tool_commands[tool_line] if tool_line is not None else None
+
+    def line_table(self):
+        # Table of line start offsets, for reading any line or range of lines straight from the file
+        if self._line_table is None:
+            cached_data = load_cached_analysis(self.input_file_path, "line_table", INDEX_VERSION, file_chunks_hash)
+            if cached_data is not None:
+                self._line_table = unpack_line_table(cached_data)
+                return self._line_table
+
+            report_progress(0, 0, "Finding lines")
+            with open(self.input_file_path, "rb") as input_file:
+                data = map_gcode_file(input_file)
+                if data is None:
+                    self._line_table = line_offset_table(None)
+                else:
+                    with data:
+                        self._line_table = line_offset_table(data)
+                        count_file_read(bytes_read=len(data), lines_scanned=len(self._line_table) - 1)
+            store_cached_analysis(self.input_file_path, "line_table", INDEX_VERSION, pack_line_table(self._line_table),
+                                  chunks_content_hash(self.chunks))
+        return self._line_table
+
+    def to_cache_data(self):
+        # Plain JSON data for the analysis cache (JSON object keys must be strings, so dicts become pairs)
+        return {
+            "profile": self.profile["name"],
+            "line_count": self.line_count,
+            "first_command_line": self.first_command_line,
+            "commands": self.commands,
+            "comments": self.comments,
+            "markers": self.markers,
+            "command_text": list(self.command_text.items()),
+            "line_offsets": list(self.line_offsets.items()),
+            "m620_filaments": list(self.m620_filaments.items()),
+            "tool_commands": list(self.tool_commands.items()),
+            "tool_reference_lines": self.tool_reference_lines,
+            "tool_reference_numbers": self.tool_reference_numbers,
+            "layer_comment_lines": self.layer_comment_lines,
+            "layer_comment_offsets": self.layer_comment_offsets,
+            "layer_z": self.layer_z,
+            "layer_start_lines": self.layer_start_lines,
+            "layer_end_lines": self.layer_end_lines,
+            "layer_start_offsets": self.layer_start_offsets,
+            "layer_end_offsets": self.layer_end_offsets,
+            "config": self.config,
+            "chunks": self.chunks,
+        }
+
+    @classmethod
+    def from_cache_data(cls, input_file_path, data):
+        index = cls(input_file_path, scan=False, profile=get_profile(data["profile"]))
+        index.line_count = data["line_count"]
+        index.first_command_line = data["first_command_line"]
+        index.commands = data["commands"]
+        index.comments = data["comments"]
+        index.markers = data["markers"]
+        index.command_text = dict(data["command_text"])
+        index.line_offsets = dict(data["line_offsets"])
+        index.m620_filaments = dict(data["m620_filaments"])
+        index.tool_commands = dict(data["tool_commands"])
+        index.tool_lines = sorted(index.tool_commands)
+        index.tool_reference_lines = data["tool_reference_lines"]
+        index.tool_reference_numbers = data["tool_reference_numbers"]
+        index.layer_comment_lines = data["layer_comment_lines"]
+        index.layer_comment_offsets = data["layer_comment_offsets"]
+        index.layer_z = data["layer_z"]
+        index.layer_start_lines = data["layer_start_lines"]
+        index.layer_end_lines = data["layer_end_lines"]
+        index.layer_start_offsets = data["layer_start_offsets"]
+        index.layer_end_offsets = data["layer_end_offsets"]
+        index.config = data["config"]
+        index.chunks = data["chunks"]
+        return index
+
+
+def profile_patterns(profile):
+    # The term matcher of a profile's comments, markers and layer comment, the pattern of a layer comment line with
+    # its Z height and the anchor its chunks are cut at, compiled the first time they are needed. Layer comments are
+    # matched case sensitively at the start of the line, so header lines such as "; max_z_height: 1.00" aren't layers
+    patterns = _profile_patterns.get(profile["name"])
+    if patterns is None:
+        term_groups = [(list(profile["comments"].values()), True, True),
+                       (list(profile["markers"].values()), None, False),
+                       ([profile["layer_comment"]], True, False)]
+        patterns = _profile_patterns[profile["name"]] = {
+            "matcher": compile_term_matcher(term_groups),
+            "z_height": re.compile(r"\s*;\s*" + re.escape(profile["layer_comment"]) + r"(?:\s*([-+]?[\d.]+))?"),
+            "chunk_anchor": b"; " + profile["layer_comment"].encode(),
+        }
+    return patterns
+
+
+def scan_workers(size):
+    # Number of processes scanning a file of 'size' bytes. Small files, and files analyzed inside a worker
+    # process (batch mode and project plates, which already use every CPU), are scanned by one
+    if size < PARALLEL_SCAN_MIN_SIZE or multiprocessing.parent_process() is not None:
+        return 1
+    workers = os.environ.get("AMS_SWAPPER_SCAN_WORKERS")
+    return int(workers) if workers else os.cpu_count() or 1
+
+
+def scan_parts(bounds, part_size):
+    # Group consecutive chunks (start, end) into parts of about part_size bytes
+    parts = [[]]
+    for start, end in bounds:
+        if parts[-1] and end - parts[-1][0][0] > part_size:
+            parts.append([])
+        parts[-1].append((start, end))
+    return parts
+
+
+def _scan_part(input_file_path, bounds, first_line, profile_name):
+    # Worker process of a parallel scan: index consecutive chunks of the file, which start at line 'first_line',
+    # with the named slicer profile and hash them. Returns the index of the part and its [hash, newlines, size] chunks
+    start, end = bounds[0][0], bounds[-1][1]
+    with open(input_file_path, "rb") as input_file, map_gcode_file(input_file) as data:
+        part_data = data[start:end]
+    part_index = GcodeIndex(input_file_path, scan=False, profile=get_profile(profile_name))
+    part_index._scan_lines(part_data, first_line, start)
+    part_chunks = []
+    for chunk_start, chunk_end in bounds:
+        _, _, newlines, chunk_hash = chunk_record(part_data, chunk_start - start, chunk_end - start)
+        part_chunks.append([chunk_hash, newlines, chunk_end - chunk_start])
+    return part_index, part_chunks
+
+
+def chunks_content_hash(chunks):
+    # Hash of a file made from the [hash, newlines, size] of its chunks, so it costs nothing once the file is indexed
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk_hash, newlines, chunk_size in chunks:
+        digest.update(f"{chunk_hash}:{chunk_size}\n".encode())
+    return digest.hexdigest()
+
+
+@profiled
+def file_chunks_hash(input_file_path):
+    # The same hash for a file that isn't indexed, from its chunks cut at the layer comments of its profile
+    with open(input_file_path, "rb") as input_file:
+        data = map_gcode_file(input_file)
+        if data is None:
+            return chunks_content_hash([])
+        with data:
+            anchor = profile_patterns(file_profile(input_file_path))["chunk_anchor"]
+            chunks = [[chunk_hash, newlines, end - start] for start, end, newlines, chunk_hash in content_chunks(data, anchor)]
+            count_file_read(bytes_read=len(data))
+    return chunks_content_hash(chunks)
+
+
+def _file_signature(input_file_path):
+    stat = os.stat(input_file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+@profiled
+def get_gcode_index(input_file_path):
+    # Return the index for the file, scanning it only if it is new or has changed on disk
+    key = os.path.abspath(input_file_path)
+    signature = _file_signature(input_file_path)
+
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+        if cached is not None and cached[0] == signature:
+            # Move the entry to the back so it is evicted last
+            _index_cache[key] = _index_cache.pop(key, cached)
+            return cached[1]
+
+    # Reuse the analysis from the on-disk cache if the file hasn't changed, otherwise scan and store it
+    cached_data = load_cached_analysis(input_file_path, "gcode_index", INDEX_VERSION, file_chunks_hash)
+    if cached_data is not None:
+        index = GcodeIndex.from_cache_data(input_file_path, cached_data)
+    else:
+        # A re-exported file is mostly the same as before, so the index of its previous version (in memory or
+        # on disk) saves scanning the parts that didn't change
+        previous = cached[1] if cached is not None else None
+        if previous is None:
+            previous_data = load_previous_analysis(input_file_path, "gcode_index", INDEX_VERSION)
+            if previous_data is not None:
+                previous = GcodeIndex.from_cache_data(input_file_path, previous_data)
+        index = GcodeIndex(input_file_path, previous=previous)
+        store_cached_analysis(input_file_path, "gcode_index", INDEX_VERSION, index.to_cache_data(),
+                              chunks_content_hash(index.chunks))
+
+    # Keep only the most recently used files
+    with _index_cache_lock:
+        _index_cache.pop(key, None)
+        while _index_cache and len(_index_cache) >= _index_cache_size["entries"]:
+            _index_cache.pop(next(iter(_index_cache)))
+        _index_cache[key] = (signature, index)
+
+    return index
+
+
+def forget_gcode_index(input_file_path):
+    # Drop the index of a file that is about to be replaced or removed, from memory and from the disk cache
+    with _index_cache_lock:
+        _index_cache.pop(os.path.abspath(input_file_path), None)
+    forget_cached_analysis(input_file_path, "gcode_index")
+    forget_cached_analysis(input_file_path, "line_table")
+
+
+def clear_gcode_index_cache():
+    with _index_cache_lock:
+        _index_cache.clear()
+
+
+def set_gcode_index_cache_size(entries):
+    # Number of indexes kept in memory, the least recently used ones are dropped first
+    with _index_cache_lock:
+        _index_cache_size["entries"] = max(1, entries)
+        while len(_index_cache) > _index_cache_size["entries"]:
+            _index_cache.pop(next(iter(_index_cache)))
+
+
+def cached_gcode_index_paths():
+    # Files whose index is in memory, least recently used first
+    with _index_cache_lock:
+        return list(_index_cache)
@@ -0,0 +1,204 @@
+import json
+import os
+from bisect import bisect_right
+from gcode_index import chunks_content_hash, get_gcode_index, profile_patterns
+from gcode_scanner import stream_chunks
+from gcode_writer import iter_segment_blocks, replacement_segments, splice_segments
+from slicer_profiles import HEADER_SIZE, detect_profile
+
+# Patches stand in for an output file: the byte ranges of the source that change, and what replaces them
+PATCH_SUFFIX = ".gcpatch"
+PATCH_FORMAT_VERSION = 2
+
+# Operations, each on a byte range of the source, sorted by where they start:
+#   ["replace", start, end, text]              the range is replaced by text
+#   ["insert", offset, text]                   text is inserted before the byte at offset
+#   ["move", start, end, from_start, from_end]  the range is replaced by another range of the source
+# Text is stored as str, bytes that aren't UTF-8 are kept with surrogateescape
+
+
+def _encode_text(data):
+    return data.decode("utf-8", "surrogateescape")
+
+
+def _decode_text(text):
+    return text.encode("utf-8", "surrogateescape")
+
+
+def _segment_size(segment):
+    return len(segment) if isinstance(segment, bytes) else segment[1] - segment[0]
+
+
+def source_hash(input_file_path):
+    # Hash of the file made from the chunk hashes of its index, so it costs nothing once the file is analyzed
+    return chunks_content_hash(get_gcode_index(input_file_path).chunks)
+
+
+def segments_hash(input_file_path, segments):
+    # The source hash the file made of the segments will have, computed while reading them, so the patch that
+    # makes a file can be checked against the patches made for that file
+    header = b""
+    for block in iter_segment_blocks(input_file_path, segments, 0, HEADER_SIZE):
+        header += block
+        if len(header) >= HEADER_SIZE:
+            break
+    anchor = profile_patterns(detect_profile(header[:HEADER_SIZE]))["chunk_anchor"]
+    return chunks_content_hash(stream_chunks(iter_segment_blocks(input_file_path, segments), anchor))
+
+
+def replacement_ops(replacements):
+    # Operations of sorted (start, end, segment) replacements, as used by gcode_writer.replacement_segments
+    ops = []
+    for start, end, segment in replacements:
+        if not isinstance(segment, bytes):
+            ops.append(["move", start, end, segment[0], segment[1]])
+        elif start == end:
+            ops.append(["insert", start, _encode_text(segment)])
+        else:
+            ops.append(["replace", start, end, _encode_text(segment)])
+    return ops
+
+
+def patch_replacements(patch):
+    # The (start, end, segment) replacements of a patch's operations
+    replacements = []
+    for op in patch["ops"]:
+        if op[0] == "move":
+            replacements.append((op[1], op[2], (op[3], op[4])))
+        elif op[0] == "insert":
+            replacements.append((op[1], op[1], _decode_text(op[2])))
+        elif op[0] == "replace":
+            replacements.append((op[1], op[2], _decode_text(op[3])))
+        else:
+            raise ValueError(f"Unknown patch operation '{op[0]}'")
+    return replacements
+
+
+def patch_segments(patch):
+    # Segments of the patched file (see gcode_writer.splice_segments), over the patch's source
+    return replacement_segments(patch["source"]["size"], patch_replacements(patch))
+
+
+def make_patch(input_file_path, output_file_path, file_size, replacements):
+    # A patch turning the input file into the output file, from sorted, non-overlapping replacements
+    replacements = sorted(replacements, key=lambda replacement: replacement[0])
+    segments = replacement_segments(file_size, replacements)
+    output_size = sum(_segment_size(segment) for segment in segments)
+    return {
+        "format": PATCH_FORMAT_VERSION,
+        "source": {"name": os.path.basename(input_file_path), "size": file_size, "hash": source_hash(input_file_path)},
+        "output": {"name": os.path.basename(output_file_path), "size": output_size,
+                   "hash": segments_hash(input_file_path, segments)},
+        "ops": replacement_ops(replacements),
+    }
+
+
+def write_patch(patch, patch_file_path):
+    # One operation per line, so patches of the same file can be compared with diff
+    with open(patch_file_path, "w") as patch_file:
+        patch_file.write("{\n")
+        for key in ["format", "source", "output"]:
+            patch_file.write(f"{json.dumps(key)}: {json.dumps(patch[key])},\n")
+        patch_file.write('"ops": [')
+        patch_file.write(",".join("\n" + json.dumps(op) for op in patch["ops"]))
+        patch_file.write("\n]\n}\n")
+    return patch_file_path
+
+
+def read_patch(patch_file_path):
+    with open(patch_file_path) as patch_file:
+        patch = json.load(patch_file)
+    if patch.get("format") != PATCH_FORMAT_VERSION:
+        raise ValueError(f"'{patch_file_path}' is not a patch this version can read")
+    return patch
+
+
+def check_source(input_file_path, patch):
+    # Refuse a patch made for another file, or for another version of this one
+    if os.path.getsize(input_file_path) != patch["source"]["size"] or source_hash(input_file_path) != patch["source"]["hash"]:
+        raise ValueError(f"The patch is for '{patch['source']['name']}', which is not the same as '{input_file_path}'")
+
+
+def compose_segments(first_segments, second_segments):
+    # Segments over the source of a first patch, from segments over its output
+    offsets = [0]
+    for segment in first_segments:
+        offsets.append(offsets[-1] + _segment_size(segment))
+
+    composed = []
+    for segment in second_segments:
+        if isinstance(segment, bytes):
+            composed.append(segment)
+            continue
+        start, end = segment
+        if end > offsets[-1]:
+            raise ValueError(f"The patch reads byte {end} of a file of {offsets[-1]} bytes")
+
+        # Split the range over the segments of the first patch it covers
+        piece_index = bisect_right(offsets, start) - 1
+        while start < end:
+            piece = first_segments[piece_index]
+            piece_start = offsets[piece_index]
+            piece_end = min(end, offsets[piece_index + 1])
+            if isinstance(piece, bytes):
+                composed.append(piece[start - piece_start:piece_end - piece_start])
+            else:
+                composed.append((piece[0] + start - piece_start, piece[0] + piece_end - piece_start))
+            start = piece_end
+            piece_index += 1
+    return composed
+
+
+def segment_replacements(file_size, segments):
+    # Turn segments over a file back into sorted replacements: ranges that come after everything copied so far
+    # are copied in place, anything else is inserted where the output has got to
+    replacements = []
+    position = 0
+    pending = []
+    for segment in [segment for segment in segments if _segment_size(segment)] + [(file_size, file_size)]:
+        if isinstance(segment, bytes) or segment[0] < position:
+            pending.append(segment)
+            continue
+        for pending_segment in pending[:-1]:
+            replacements.append((position, position, pending_segment))
+        if pending or segment[0] > position:
+            replacements.append((position, segment[0], pending[-1] if pending else b""))
+        pending = []
+        position = segment[1]
+    return replacements
+
+
+def check_chained(first, second):
+    # Refuse a patch that wasn't made for the output of the patch applied before it
+    if second["source"]["size"] != first["output"]["size"] or second["source"]["hash"] != first["output"]["hash"]:
+        raise ValueError(f"The patch for '{second['source']['name']}' doesn't apply to the output of the one for "
+                         f"'{first['source']['name']}'")
+
+
+def compose_patches(first, second):
+    # One patch of the first patch's source doing what applying both in turn does
+    check_chained(first, second)
+    segments = compose_segments(patch_segments(first), patch_segments(second))
+    return {
+        "format": PATCH_FORMAT_VERSION,
+        "source": first["source"],
+        "output": second["output"],
+        "ops": replacement_ops(segment_replacements(first["source"]["size"], segments)),
+    }
+
+
+def patched_segments(input_file_path, patches):
+    # Segments of the file the patches make of the input, each patch applying to the output of the one before
+    check_source(input_file_path, patches[0])
+    segments = patch_segments(patches[0])
+    for previous, patch in zip(patches, patches[1:]):
+        check_chained(previous, patch)
+        segments = compose_segments(segments, patch_segments(patch))
+    return segments
+
+
+def apply_patches(input_file_path, patches, output_file_path):
+    # Write the file the patches make of the input. The patches are composed first, so the output is written in one
+    # pass copying ranges of the input
+    splice_segments(input_file_path, output_file_path, patched_segments(input_file_path, patches))
+    return output_file_path
@@ -0,0 +1,461 @@
+import base64
+import hashlib
+import mmap
+import os
+import re
+import zlib
+from array import array
+from itertools import accumulate, chain, repeat
+from operator import add, sub
+from profiler import count_file_read, profiled
+from progress import report_progress
+
+# NumPy is optional, without it the line table is built with bytes.split
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Whitespace removed by str.strip() before a line is checked for a leading ";"
+LINE_SPACE = rb"[ \t\r\f\v]"
+
+# Largest slice copied out of the map at once
+BLOCK_SIZE = 16 * 1024 * 1024
+SUB_BLOCK_SIZE = 64 * 1024
+
+# Chunk sizes skipped over when looking for the start of a line
+SKIP_CHUNK_SIZES = [SUB_BLOCK_SIZE, 4096, 256]
+
+# Chunks hashed for incremental re-analysis are cut at anchor lines, but are never shorter than the minimum
+# and are cut at the next line after the maximum
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+
+FIRST_COMMAND_RE = re.compile(rb"(?m)^(?!" + LINE_SPACE + rb"*;)" + LINE_SPACE + rb"*[^ \t\r\f\v\n]")
+COMMENT_START_RE = re.compile(LINE_SPACE + rb"*;")
+
+
+def map_gcode_file(input_file):
+    # Memory-map an open binary file, None if it is empty (empty files can't be mapped)
+    if os.fstat(input_file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def count_newlines(data, start, end):
+    # Count the newlines in data[start:end] without copying more than one block at a time
+    count = 0
+    for block_start in range(start, end, BLOCK_SIZE):
+        count += data[block_start:min(block_start + BLOCK_SIZE, end)].count(b"\n")
+    return count
+
+
+@profiled
+def count_lines(data):
+    # Count lines the way enumerate(file) does, including a last line without a newline
+    size = len(data)
+    if size == 0:
+        return 0
+    line_count = count_newlines(data, 0, size)
+    if data[size - 1:size] != b"\n":
+        line_count += 1
+    return line_count
+
+
+def offsets_to_line_numbers(data, offsets):
+    # Convert sorted byte offsets to 1-based line numbers in one forward sweep
+    line_numbers = []
+    line_number = 1
+    last_offset = 0
+    for offset in offsets:
+        line_number += count_newlines(data, last_offset, offset)
+        last_offset = offset
+        line_numbers.append(line_number)
+    return line_numbers
+
+
+@profiled
+def line_start_offsets(data, line_numbers):
+    # Find the byte offset where each requested line starts, in one forward sweep.
+    # Lines past the end of the file are left out of the result
+    offsets = {}
+    if data is None:
+        return offsets
+
+    size = len(data)
+    line_number = 1
+    position = 0
+
+    # Line number at the end of the last chunk counted at each chunk size, so targets inside
+    # that chunk go straight to the smaller sizes instead of counting it again
+    chunk_end_lines = [0] * len(SKIP_CHUNK_SIZES)
+
+    for target_line in sorted(set(line_numbers)):
+        if target_line < 1:
+            continue
+
+        # Skip whole chunks while the target line is further on, from large chunks down to small ones
+        for level, chunk_size in enumerate(SKIP_CHUNK_SIZES):
+            if target_line <= chunk_end_lines[level]:
+                continue
+            while line_number < target_line and position < size:
+                chunk = data[position:position + chunk_size]
+                newlines = chunk.count(b"\n")
+                if line_number + newlines >= target_line:
+                    chunk_end_lines[level] = line_number + newlines
+                    break
+                line_number += newlines
+                position += len(chunk)
+
+        # Then step through the remaining newlines one by one
+        while line_number < target_line and position < size:
+            newline = data.find(b"\n", position)
+            if newline == -1:
+                position = size
+                break
+            line_number += 1
+            position = newline + 1
+
+        if line_number == target_line and position < size:
+            offsets[target_line] = position
+
+    return offsets
+
+
+def _newline_ends(data, start, end):
+    # Offsets just past every newline in data[start:end]
+    if np is not None:
+        block = np.frombuffer(data, dtype=np.uint8, count=end - start, offset=start)
+        return (np.flatnonzero(block == ord("\n")) + (start + 1)).astype(np.uint64).tobytes()
+    lines = data[start:end].split(b"\n")
+    lines.pop()
+    line_ends = accumulate(map(add, map(len, lines), repeat(1)), initial=start)
+    next(line_ends)
+    return array("Q", line_ends).tobytes()
+
+
+@profiled
+def line_offset_table(data):
+    # Start offset of every line followed by the file size, 8 bytes per line in an array('Q'):
+    # line n is data[table[n - 1]:table[n]]. Lines are counted like count_lines does
+    table = array("Q", [0])
+    size = len(data) if data is not None else 0
+    for block_start in range(0, size, BLOCK_SIZE):
+        block_end = min(block_start + BLOCK_SIZE, size)
+        table.frombytes(_newline_ends(data, block_start, block_end))
+        report_progress(block_end, size)
+
+    # A last line without a newline
+    if table[-1] != size:
+        table.append(size)
+    return table
+
+
+def pack_line_table(table):
+    # A line offset table as JSON data for the analysis cache: the compressed line lengths, in the smallest array
+    # type that holds the longest line
+    if np is not None:
+        lengths = np.diff(np.frombuffer(table, dtype=np.uint64))
+        typecode = "H" if not len(lengths) or lengths.max() < 1 << 16 else "Q"
+        lengths = lengths.astype(np.uint16 if typecode == "H" else np.uint64).tobytes()
+    else:
+        lengths = array("Q", map(sub, table[1:], table[:-1]))
+        typecode = "H" if not lengths or max(lengths) < 1 << 16 else "Q"
+        lengths = array(typecode, lengths).tobytes()
+    return {"typecode": typecode, "lengths": base64.b64encode(zlib.compress(lengths, 1)).decode("ascii")}
+
+
+def unpack_line_table(packed):
+    # The table packed by pack_line_table
+    lengths = array(packed["typecode"], zlib.decompress(base64.b64decode(packed["lengths"])))
+    if np is not None:
+        offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+        np.cumsum(np.frombuffer(lengths, dtype=np.uint16 if packed["typecode"] == "H" else np.uint64), out=offsets[1:])
+        return array("Q", offsets.tobytes())
+    return array("Q", accumulate(lengths, initial=0))
+
+
+def line_range_bytes(data, table, first_line, last_line):
+    # Lines first_line to last_line (1-based, inclusive) with their newlines, clipped to the file
+    first_line = max(first_line, 1)
+    last_line = min(last_line, len(table) - 1)
+    if first_line > last_line:
+        return b""
+    return data[table[first_line - 1]:table[last_line]]
+
+
+def iter_blocks(data, block_size=BLOCK_SIZE):
+    # Yield (offset, bytes) blocks of the map that always end on a line boundary, reporting progress after each
+    size = len(data)
+    block_start = 0
+    while block_start < size:
+        block_end = data.find(b"\n", min(block_start + block_size, size) - 1)
+        block_end = size if block_end == -1 else block_end + 1
+        yield block_start, data[block_start:block_end]
+        report_progress(block_end, size)
+        block_start = block_end
+
+
+def chunk_bounds(data, anchor):
+    # Split a mapped file into chunks of whole lines, cut at the lines starting with 'anchor'. The cuts depend on
+    # the content around them and not on their position, so an edit only changes the chunks it falls in.
+    # Returns (start, end) of every chunk
+    bounds = []
+    size = len(data)
+    start = 0
+    # The anchor is searched for with the newline before it, so cuts always fall on a line start
+    anchor = b"\n" + anchor
+    anchor_position = data.find(anchor)
+    while start < size:
+        while anchor_position != -1 and anchor_position + 1 - start < CHUNK_MIN_SIZE:
+            anchor_position = data.find(anchor, anchor_position + 1)
+        end = size if anchor_position == -1 else anchor_position + 1
+        if end - start > CHUNK_MAX_SIZE:
+            newline = data.find(b"\n", start + CHUNK_MAX_SIZE - 1)
+            end = size if newline == -1 else newline + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def chunk_record(data, start, end):
+    # (start, end, newline count, hash) of a chunk
+    chunk = data[start:end]
+    return start, end, chunk.count(b"\n"), hashlib.blake2b(chunk, digest_size=16).hexdigest()
+
+
+@profiled
+def content_chunks(data, anchor):
+    # Hash the chunks of a mapped file (see chunk_bounds), returning (start, end, newline count, hash) of each
+    chunks = []
+    size = len(data)
+    for start, end in chunk_bounds(data, anchor):
+        chunks.append(chunk_record(data, start, end))
+        report_progress(end, size)
+    return chunks
+
+
+def _stream_chunk_end(pending, anchor, searched, final):
+    # Where chunk_bounds would end a chunk starting at the front of 'pending', None if that depends on bytes that
+    # haven't come yet. Anchors before 'searched' were already looked for
+    anchor_position = pending.find(anchor, max(CHUNK_MIN_SIZE - 1, searched - len(anchor)))
+    if anchor_position != -1 and anchor_position + 1 <= CHUNK_MAX_SIZE:
+        return anchor_position + 1
+    if anchor_position == -1 and len(pending) <= CHUNK_MAX_SIZE:
+        return len(pending) if final else None
+
+    # Too long: cut at the next line after the maximum, once no anchor can come before it
+    if anchor_position == -1 and not final and len(pending) < CHUNK_MAX_SIZE + len(anchor):
+        return None
+    newline = pending.find(b"\n", CHUNK_MAX_SIZE - 1)
+    if newline != -1:
+        return newline + 1
+    return len(pending) if final else None
+
+
+def stream_chunks(blocks, anchor):
+    # [hash, newlines, size] of the chunks content_chunks cuts a file into, for a file given as blocks of bytes
+    # (such as the output of a patch, see gcode_writer.iter_segment_blocks), holding about one chunk in memory
+    anchor = b"\n" + anchor
+    pending = bytearray()
+    searched = 0
+    # None marks the end of the file
+    for block in chain(blocks, [None]):
+        final = block is None
+        if not final:
+            pending += block
+        while pending:
+            end = _stream_chunk_end(pending, anchor, searched, final)
+            if end is None:
+                searched = len(pending)
+                break
+            chunk = pending[:end]
+            yield [hashlib.blake2b(chunk, digest_size=16).hexdigest(), chunk.count(b"\n"), end]
+            del pending[:end]
+            searched = 0
+
+
+def ordered_term_lines(term_lines, terms):
+    # Keep only the terms that were found, ordered by their first line like the line by line locators
+    found = [term for term in terms if term_lines.get(term)]
+    found.sort(key=lambda term: term_lines[term][0])
+    return {term: term_lines[term] for term in found}
+
+
+@profiled
+def find_terms_in_map(data, terms, comments=None, ignore_case=True, line_texts=None, line_offsets=None):
+    # Find the line numbers of every term in a mapped file.
+    # comments=True only looks at comment lines, False only at other lines, None at every line.
+    # If 'line_texts' is given, the stripped text of each matching line is stored in it,
+    # if 'line_offsets' is given, the byte offset where each matching line starts
+    term_lines = {term: [] for term in terms}
+    if data is None or not terms:
+        return term_lines
+
+    encoded_terms = [(term, term.lower().encode() if ignore_case else term.encode()) for term in terms]
+
+    # Each block is lowered once and searched for every term with bytes.find, so the only
+    # Python work is per match, never per line
+    line_terms = {}
+    for block_start, block in iter_blocks(data):
+        searched_block = block.lower() if ignore_case else block
+        for term, encoded_term in encoded_terms:
+            position = searched_block.find(encoded_term)
+            while position != -1:
+                line_start = searched_block.rfind(b"\n", 0, position) + 1
+                line_stop = searched_block.find(b"\n", position)
+                if line_stop == -1:
+                    line_stop = len(searched_block)
+
+                if comments is None or (COMMENT_START_RE.match(block, line_start) is not None) == comments:
+                    found = line_terms.get(block_start + line_start)
+                    if found is None:
+                        found = line_terms[block_start + line_start] = ([], block[line_start:line_stop])
+                    found[0].append(term)
+
+                # A term is only recorded once per line
+                position = searched_block.find(encoded_term, line_stop)
+
+    # Number all the matching lines in one sweep
+    line_starts = sorted(line_terms)
+    for line_number, line_start in zip(offsets_to_line_numbers(data, line_starts), line_starts):
+        found_terms, line = line_terms[line_start]
+        for term in found_terms:
+            term_lines[term].append(line_number)
+        if line_texts is not None:
+            line_texts[line_number] = line.decode("utf-8", "replace").strip()
+        if line_offsets is not None:
+            line_offsets[line_number] = line_start
+
+    return term_lines
+
+
+def compile_term_matcher(term_groups):
+    # Compile groups of terms, each a (terms, comments, ignore_case) like the arguments of find_terms_in_map, into
+    # one pattern, so any number of terms is found in a single pass. The pattern runs on lowered text and tries the
+    # longest terms first, so each match also stands for the shorter terms found inside it
+    entries = {}
+    for group_number, (terms, comments, ignore_case) in enumerate(term_groups):
+        for term in terms:
+            entries.setdefault(term.lower().encode(), []).append(
+                (group_number, term, comments, None if ignore_case else term.encode()))
+    keys = sorted(entries, key=len, reverse=True)
+
+    # (position in the match, group number, term, comments, case sensitive text) of every term a match holds
+    matched_terms = {key: [(key.find(inner),) + entry for inner in keys if inner in key for entry in entries[inner]]
+                     for key in keys}
+
+    # A term starting inside another one and ending after it would be hidden by the match of the first, so the
+    # search goes on inside such matches
+    overlapping = {key for key in keys
+                   if any(key[start:] == other[:len(key) - start] for other in keys for start in range(1, len(key)))}
+    return {
+        "pattern": re.compile(b"|".join(re.escape(key) for key in keys)) if keys else None,
+        "group_terms": [list(terms) for terms, _, _ in term_groups],
+        "matched_terms": matched_terms,
+        "overlapping": overlapping,
+    }
+
+
+@profiled
+def find_term_groups_in_map(data, matcher):
+    # Find the line numbers of the terms of every group of a compiled matcher (see compile_term_matcher), in one
+    # pass over a mapped file. Returns the term lines of each group, same as find_terms_in_map, and the byte offset
+    # where each matching line starts
+    group_lines = [{term: [] for term in terms} for terms in matcher["group_terms"]]
+    found_offsets = {}
+    if data is None or matcher["pattern"] is None:
+        return group_lines, found_offsets
+
+    search = matcher["pattern"].search
+    matched_terms = matcher["matched_terms"]
+    overlapping = matcher["overlapping"]
+
+    line_terms = {}
+    for block_start, block in iter_blocks(data):
+        searched_block = block.lower()
+        line_start = line_stop = -1
+        is_comment = None
+        match = search(searched_block)
+        while match is not None:
+            position = match.start()
+            if position > line_stop:
+                line_start = searched_block.rfind(b"\n", 0, position) + 1
+                line_stop = searched_block.find(b"\n", position)
+                if line_stop == -1:
+                    line_stop = len(searched_block)
+                is_comment = None
+
+            key = match.group()
+            for offset, group_number, term, comments, case_text in matched_terms[key]:
+                if case_text is not None and not block.startswith(case_text, position + offset):
+                    continue
+                if comments is not None:
+                    if is_comment is None:
+                        is_comment = COMMENT_START_RE.match(block, line_start) is not None
+                    if is_comment != comments:
+                        continue
+                found = line_terms.get(block_start + line_start)
+                if found is None:
+                    found = line_terms[block_start + line_start] = []
+                found.append((group_number, term))
+
+            match = search(searched_block, position + 1 if key in overlapping else match.end())
+
+    # Number all the matching lines in one sweep, recording each term once per line
+    line_starts = sorted(line_terms)
+    for line_number, line_start in zip(offsets_to_line_numbers(data, line_starts), line_starts):
+        for group_number, term in line_terms[line_start]:
+            term_lines = group_lines[group_number][term]
+            if not term_lines or term_lines[-1] != line_number:
+                term_lines.append(line_number)
+        found_offsets[line_number] = line_start
+
+    return group_lines, found_offsets
+
+
+def find_first_matches(data, pattern):
+    # Find the first match of a compiled pattern on each line, as (line number, match groups, line text)
+    if data is None:
+        return []
+
+    line_starts = []
+    found = []
+    for block_start, block in iter_blocks(data):
+        last_line_start = -1
+        for match in pattern.finditer(block):
+            line_start = block.rfind(b"\n", 0, match.start()) + 1
+            if line_start == last_line_start:
+                continue
+            last_line_start = line_start
+            line_stop = block.find(b"\n", match.start())
+            if line_stop == -1:
+                line_stop = len(block)
+            line_starts.append(block_start + line_start)
+            found.append((match.groups(), block[line_start:line_stop].decode("utf-8", "replace").strip()))
+
+    line_numbers = offsets_to_line_numbers(data, line_starts)
+    return [(line_number, groups, line) for line_number, (groups, line) in zip(line_numbers, found)]
+
+
+def find_first_command_line(data):
+    # Find the first line that is neither empty nor a comment
+    if data is None:
+        return None
+    match = FIRST_COMMAND_RE.search(data)
+    if match is None:
+        return None
+    return count_newlines(data, 0, match.start()) + 1
+
+
+def find_terms(input_file_path, terms, comments=None, ignore_case=True):
+    # Map the file and return {term: [line numbers]} for the terms that were found
+    with open(input_file_path, "rb") as input_file:
+        data = map_gcode_file(input_file)
+        if data is None:
+            return {}
+        with data:
+            term_lines = find_terms_in_map(data, terms, comments, ignore_case)
+            count_file_read(bytes_read=len(data))
+
+    return ordered_term_lines(term_lines, terms)
@@ -0,0 +1,272 @@
+import re
+import numpy as np
+from gcode_scanner import iter_blocks, map_gcode_file
+from profiler import count_file_read, profiled
+
+# Every line of a file parsed into a compact record, stored as one array per field (struct of arrays) so
+# lines can be selected with array filters instead of string searches. Needs NumPy.
+#
+# Per line (4 bytes):
+#   command_ids       uint8   index of the line's command in 'commands' (uint16 if a file has more than 256)
+#   comment_columns   uint16  column of the ";" starting the comment, NO_COMMENT if there is none
+#   word_counts       uint8   number of words after the command
+# Per word (5 bytes), in line order:
+#   word_codes        uint8   letter index (0 for "A") * 9 + digits after the point
+#   word_mantissas    int32   the value's digits as an integer, value = mantissa / 10 ** digits after the point
+# Per distinct command:
+#   commands          uint32  letter << 24 | number << 8 | subcode + 1 ("M620.1" has number 620 and subcode 1,
+#                             "G1" has no subcode), 0 for lines without a command
+
+NO_COMMENT = 0xFFFF
+MAX_COMMENT_COLUMN = NO_COMMENT - 1
+
+# Blocks are parsed one at a time, their temporary arrays take about a dozen times their size
+TOKENIZE_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Longest number parsed after a letter (digits, sign and decimal point), and after a command letter
+NUMBER_WIDTH = 20
+COMMAND_WIDTH = 8
+
+# Digits kept of every number, and of those, after the point. Digits past these are dropped, so numbers with
+# more than MAX_DIGITS digits before the point don't fit (G-code numbers never have that many)
+MAX_DIGITS = 9
+MAX_DECIMALS = 8
+DECIMAL_CODES = MAX_DECIMALS + 1
+
+MAX_COMMAND_NUMBER = 0xFFFF
+MAX_COMMAND_SUBCODE = 0xFE
+MAX_WORDS = 0xFF
+
+COMMAND_RE = re.compile(r"^([A-Za-z])(?:(\d+)(?:\.(\d+))?)?$")
+
+POINT_DIGIT = np.uint8((ord(".") - ord("0")) % 256)
+
+
+def parse_number_parts(characters, starts, width=NUMBER_WIDTH):
+    # Parse the numbers starting at each position of a uint8 array, one character column at a time for all of
+    # them at once. Returns whether each one is negative, its digits as an integer, the number of digits after
+    # the point, the number of digits and whether it has a point
+    negative = characters[starts] == ord("-")
+    positions = starts + negative
+    mantissa = np.zeros(len(starts), dtype=np.int32)
+    decimals = np.zeros(len(starts), dtype=np.uint8)
+    digit_count = np.zeros(len(starts), dtype=np.uint8)
+    seen_point = np.zeros(len(starts), dtype=bool)
+    reading = np.ones(len(starts), dtype=bool)
+
+    for _ in range(width):
+        # Characters minus "0", so digits are 0 to 9 and the point wraps around to 254
+        digits = characters[positions]
+        digits -= np.uint8(ord("0"))
+        positions += 1
+        digit = digits < 10
+        point = (digits == POINT_DIGIT) & ~seen_point
+        reading &= digit | point
+        if not reading.any():
+            break
+
+        taken = digit & reading & (digit_count < MAX_DIGITS)
+        mantissa *= 1 + 9 * taken.view(np.uint8)
+        mantissa += digits * taken
+        decimals += taken & seen_point
+        digit_count += taken
+        seen_point |= point & reading
+
+    too_precise = decimals > MAX_DECIMALS
+    mantissa[too_precise] //= 10
+    decimals[too_precise] = MAX_DECIMALS
+    return negative, mantissa, decimals, digit_count, seen_point
+
+
+def _uppercase(characters):
+    # Uppercase letters and whether each character is a letter at all
+    upper = characters & 0xDF
+    return upper, (upper >= ord("A")) & (upper <= ord("Z"))
+
+
+def _tokenize_block(block):
+    # Parse the lines of one block into the fields of GcodeTokens, with the command keys of the block's lines
+    # (not yet turned into ids) in place of command_ids
+    size = len(block)
+    # Padding lets every position look a whole number ahead without running off the end
+    characters = np.frombuffer(block + b"\0" * (NUMBER_WIDTH + 3), dtype=np.uint8)
+
+    # Newlines, blanks and semicolons are all found in one pass, and numbered by the line they are on
+    text = characters[:size]
+    marks = np.flatnonzero((text == ord("\n")) | (text == ord(" ")) | (text == ord("\t")) | (text == ord(";")))
+    kinds = characters[marks]
+    is_newline = kinds == ord("\n")
+    mark_lines = np.cumsum(is_newline) - is_newline
+    newlines = marks[is_newline]
+    line_starts = np.concatenate(([0], newlines + 1))
+    line_ends = np.concatenate((newlines, [size]))
+    if line_starts[-1] == size:
+        # The block ends with a newline, there is no line after it
+        line_starts = line_starts[:-1]
+        line_ends = line_ends[:-1]
+
+    # Comments run from the first ";" of a line to its end, the code before them
+    is_semicolon = kinds == ord(";")
+    semicolons, semicolon_lines = marks[is_semicolon], mark_lines[is_semicolon]
+    first_semicolons = np.ones(len(semicolons), dtype=bool)
+    first_semicolons[1:] = semicolon_lines[1:] != semicolon_lines[:-1]
+    code_ends = line_ends.copy()
+    code_ends[semicolon_lines[first_semicolons]] = semicolons[first_semicolons]
+    has_comment = code_ends < line_ends
+    comment_columns = np.where(has_comment, np.minimum(code_ends - line_starts, MAX_COMMENT_COLUMN),
+                               NO_COMMENT).astype(np.uint16)
+
+    # The command is the first letter after any indentation, followed by a number
+    firsts = line_starts.copy()
+    blank = np.flatnonzero(((characters[firsts] == ord(" ")) | (characters[firsts] == ord("\t"))) & (firsts < code_ends))
+    while len(blank):
+        firsts[blank] += 1
+        following = characters[firsts[blank]]
+        blank = blank[((following == ord(" ")) | (following == ord("\t"))) & (firsts[blank] < code_ends[blank])]
+    letters, is_letter = _uppercase(characters[firsts])
+    negative, mantissa, decimals, digit_count, seen_point = parse_number_parts(characters, firsts + 1, COMMAND_WIDTH)
+    has_command = is_letter & (firsts < code_ends) & (digit_count > decimals) & ~negative
+    scale = 10 ** decimals.astype(np.int32)
+    command_keys = ((letters.astype(np.uint32) << 24)
+                    | (np.minimum(mantissa // scale, MAX_COMMAND_NUMBER).astype(np.uint32) << 8)
+                    | np.where(seen_point, np.minimum(mantissa % scale, MAX_COMMAND_SUBCODE) + 1, 0).astype(np.uint32))
+    command_keys[~has_command] = 0
+
+    # Words are letters after a space or tab, between the command and the comment, followed by a number
+    is_blank = (kinds == ord(" ")) | (kinds == ord("\t"))
+    word_starts, word_line = marks[is_blank] + 1, mark_lines[is_blank]
+    word_letters, is_word_letter = _uppercase(characters[word_starts])
+    word_starts, word_line, word_letters = word_starts[is_word_letter], word_line[is_word_letter], word_letters[is_word_letter]
+    inside = has_command[word_line] & (word_starts < code_ends[word_line])
+
+    negative, mantissa, decimals, digit_count, _ = parse_number_parts(characters, word_starts[inside] + 1)
+    found = digit_count > 0
+    word_line = word_line[inside][found]
+    word_letters = word_letters[inside][found]
+    word_mantissas = np.where(negative[found], -mantissa[found], mantissa[found])
+    word_codes = (word_letters - ord("A")) * DECIMAL_CODES + decimals[found]
+
+    word_counts = np.bincount(word_line, minlength=len(line_starts))
+    if len(word_counts) and word_counts.max() > MAX_WORDS:
+        # Drop the words past the last one a line can have
+        first_words = np.cumsum(word_counts) - word_counts
+        kept = np.arange(len(word_line)) - first_words[word_line] < MAX_WORDS
+        word_codes, word_mantissas = word_codes[kept], word_mantissas[kept]
+        word_counts = np.minimum(word_counts, MAX_WORDS)
+    return command_keys, comment_columns, word_counts.astype(np.uint8), word_codes, word_mantissas
+
+
+def parse_command(command):
+    # Split a command such as "G1", "M620.1" or "T" into its letter, number and subcode key
+    # (None for a number that isn't given, matching any)
+    command_match = COMMAND_RE.match(command.strip())
+    if not command_match:
+        raise ValueError(f"Invalid G-code command '{command}'")
+    letter, number, subcode = command_match.groups()
+    return (ord(letter.upper()), None if number is None else int(number),
+            0 if subcode is None else int(subcode) + 1)
+
+
+def command_name(key):
+    # The text of a command key, e.g. "M620.1"
+    if key == 0:
+        return ""
+    subcode = key & 0xFF
+    return chr(key >> 24) + str((key >> 8) & 0xFFFF) + (f".{subcode - 1}" if subcode else "")
+
+
+class GcodeTokens:
+    def __init__(self, commands, command_ids, comment_columns, word_counts, word_codes, word_mantissas):
+        self.commands = commands
+        self.command_ids = command_ids
+        self.comment_columns = comment_columns
+        self.word_counts = word_counts
+        self.word_codes = word_codes
+        self.word_mantissas = word_mantissas
+        self._word_lines = None
+
+    @property
+    def line_count(self):
+        return len(self.command_ids)
+
+    def nbytes(self):
+        # Memory used by the records
+        return sum(array.nbytes for array in (self.commands, self.command_ids, self.comment_columns,
+                                              self.word_counts, self.word_codes, self.word_mantissas))
+
+    def command_names(self):
+        # The distinct commands of the file
+        return [command_name(int(key)) for key in self.commands if key]
+
+    def command_mask(self, command):
+        # Which lines have a command: "G1", "M620.1", or "T" for every T command
+        letter, number, subcode = parse_command(command)
+        matching = (self.commands >> 24) == letter
+        if number is not None:
+            matching &= (((self.commands >> 8) & 0xFFFF) == number) & ((self.commands & 0xFF) == subcode)
+        return matching[self.command_ids]
+
+    def command_lines(self, command):
+        # Line numbers (1-based) of every line with a command
+        return np.flatnonzero(self.command_mask(command)) + 1
+
+    def comment_lines(self):
+        # Line numbers of every line with a comment
+        return np.flatnonzero(self.comment_columns != NO_COMMENT) + 1
+
+    def word_lines(self):
+        # Index of the line of every word, built on first use (4 bytes per word)
+        if self._word_lines is None:
+            self._word_lines = np.repeat(np.arange(self.line_count, dtype=np.uint32), self.word_counts)
+        return self._word_lines
+
+    def word_values(self, letter, line_mask=None):
+        # Line numbers and values of the words with a letter, on the lines selected by 'line_mask' (all if None)
+        letter_index = ord(letter.upper()) - ord("A")
+        codes = self.word_codes
+        chosen = (codes >= letter_index * DECIMAL_CODES) & (codes < (letter_index + 1) * DECIMAL_CODES)
+        if line_mask is not None:
+            chosen &= line_mask[self.word_lines()]
+        decimals = codes[chosen] - letter_index * DECIMAL_CODES
+        return self.word_lines()[chosen] + 1, self.word_mantissas[chosen] / 10.0 ** decimals
+
+    def word_columns(self, letters, line_mask):
+        # One float column per letter over the lines selected by 'line_mask', NaN where the line doesn't have the
+        # word (if a word is repeated, the last one wins)
+        selected = np.flatnonzero(line_mask)
+        columns = {}
+        for letter in letters:
+            lines, values = self.word_values(letter, line_mask)
+            column = np.full(len(selected), np.nan)
+            column[np.searchsorted(selected, lines - 1)] = values
+            columns[letter] = column
+        return columns
+
+
+@profiled
+def tokenize(data):
+    # Parse every line of a buffer (bytes or a mapped file) into GcodeTokens
+    blocks = [_tokenize_block(block) for _, block in iter_blocks(data, TOKENIZE_BLOCK_SIZE)] if data is not None else []
+    if not blocks:
+        return GcodeTokens(np.zeros(0, np.uint32), np.zeros(0, np.uint8), np.zeros(0, np.uint16),
+                           np.zeros(0, np.uint8), np.zeros(0, np.uint8), np.zeros(0, np.int32))
+
+    # Number the distinct commands of all the blocks
+    block_commands = [np.unique(block[0]) for block in blocks]
+    commands = np.unique(np.concatenate(block_commands))
+    id_type = np.uint8 if len(commands) <= 256 else np.uint16
+    command_ids = np.concatenate([np.searchsorted(commands, block[0]).astype(id_type) for block in blocks])
+    return GcodeTokens(commands, command_ids, *(np.concatenate(field) for field in list(zip(*blocks))[1:]))
+
+
+def tokenize_file(input_file_path):
+    # Tokenize a whole G-code file
+    with open(input_file_path, "rb") as input_file:
+        data = map_gcode_file(input_file)
+        try:
+            tokens = tokenize(data)
+            count_file_read(bytes_read=len(data) if data is not None else 0, lines_scanned=tokens.line_count)
+            return tokens
+        finally:
+            if data is not None:
+                data.close()
@@ -0,0 +1,131 @@
+import os
+from profiler import count_file_read, profiled
+from progress import report_progress
+
+# Largest range handed to the kernel (or read into memory) in one call
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Set once a kernel copy call turns out not to work for these files
+_kernel_copy = {"copy_file_range": hasattr(os, "copy_file_range"), "sendfile": hasattr(os, "sendfile")}
+
+
+def _kernel_copy_range(input_fd, output_fd, start, count):
+    # Copy up to 'count' bytes inside the kernel, returning 0 if no kernel copy is possible
+    if _kernel_copy["copy_file_range"]:
+        try:
+            return os.copy_file_range(input_fd, output_fd, count, start)
+        except OSError:
+            _kernel_copy["copy_file_range"] = False
+    if _kernel_copy["sendfile"]:
+        try:
+            return os.sendfile(output_fd, input_fd, start, count)
+        except OSError:
+            _kernel_copy["sendfile"] = False
+    return 0
+
+
+def _write_all(output_fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(output_fd, view)
+        view = view[written:]
+
+
+def copy_byte_range(input_fd, output_fd, start, end):
+    # Copy input bytes [start, end) to the current position of the output file descriptor
+    while start < end:
+        copied = _kernel_copy_range(input_fd, output_fd, start, min(end - start, COPY_CHUNK_SIZE))
+        if copied == 0:
+            # Fall back to reading and writing through a small buffer
+            data = os.pread(input_fd, min(end - start, READ_CHUNK_SIZE), start)
+            if not data:
+                raise EOFError(f"Input ended at byte {start}, before byte {end}")
+            _write_all(output_fd, data)
+            copied = len(data)
+        start += copied
+
+
+@profiled
+def splice_segments(input_file_path, output_file_path, segments):
+    # Write the output file from a list of segments, each either a (start, end) byte range
+    # of the input file or bytes to insert. Ranges are copied without passing through Python.
+    # A partly written output file is removed if the copy fails or is cancelled
+    output_size = segments_size(segments)
+    written = 0
+    report_progress(written, output_size, f"Writing {os.path.basename(output_file_path)}")
+    with open(input_file_path, "rb", buffering=0) as input_file, open(output_file_path, "wb", buffering=0) as output_file:
+        count_file_read()
+        input_fd = input_file.fileno()
+        output_fd = output_file.fileno()
+        try:
+            for segment in segments:
+                if isinstance(segment, bytes):
+                    _write_all(output_fd, segment)
+                    written += len(segment)
+                    report_progress(written, output_size)
+                    continue
+
+                # Large ranges are copied a chunk at a time so progress keeps moving
+                for chunk_start in range(segment[0], segment[1], COPY_CHUNK_SIZE):
+                    chunk_end = min(chunk_start + COPY_CHUNK_SIZE, segment[1])
+                    copy_byte_range(input_fd, output_fd, chunk_start, chunk_end)
+                    count_file_read(opens=0, bytes_read=chunk_end - chunk_start)
+                    written += chunk_end - chunk_start
+                    report_progress(written, output_size)
+        except BaseException:
+            output_file.close()
+            os.remove(output_file_path)
+            raise
+
+
+def replacement_segments(file_size, replacements):
+    # Turn sorted, non-overlapping (start, end, segment) replacements of input byte ranges into
+    # segments that copy everything else unchanged
+    segments = []
+    position = 0
+    for start, end, segment in replacements:
+        if start > position:
+            segments.append((position, start))
+        segments.append(segment)
+        position = max(position, end)
+    if position < file_size:
+        segments.append((position, file_size))
+    return segments
+
+
+def insertion_segments(file_size, insertions):
+    # Turn sorted (offset, bytes) insertions into segments that copy everything else unchanged
+    return replacement_segments(file_size, [(offset, offset, data) for offset, data in insertions])
+
+
+def segments_size(segments):
+    return sum(len(segment) if isinstance(segment, bytes) else segment[1] - segment[0] for segment in segments)
+
+
+def iter_segment_blocks(input_file_path, segments, start=0, block_size=READ_CHUNK_SIZE):
+    # Yield the bytes splice_segments would write, from byte 'start' of the output on, in blocks of at most
+    # block_size bytes, for writers that aren't files (an upload)
+    with open(input_file_path, "rb", buffering=0) as input_file:
+        count_file_read()
+        input_fd = input_file.fileno()
+        position = 0
+        for segment in segments:
+            size = len(segment) if isinstance(segment, bytes) else segment[1] - segment[0]
+            if position + size <= start:
+                position += size
+                continue
+            skip = max(0, start - position)
+            position += size
+            if isinstance(segment, bytes):
+                for block_start in range(skip, size, block_size):
+                    yield segment[block_start:block_start + block_size]
+                continue
+            block_start = segment[0] + skip
+            while block_start < segment[1]:
+                data = os.pread(input_fd, min(segment[1] - block_start, block_size), block_start)
+                if not data:
+                    raise EOFError(f"Input ended at byte {block_start}, before byte {segment[1]}")
+                count_file_read(opens=0, bytes_read=len(data))
+                block_start += len(data)
+                yield data
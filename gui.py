@@ -1,21 +1,45 @@
+import os
+import threading
 import tkinter as tk
-from tkinter import filedialog
+from concurrent.futures import ThreadPoolExecutor
+from tkinter import filedialog, ttk
+import analysis_daemon
+import gcode_3mf
 import main  # Importing the main.py code as a module
+from profiler import profile_paths, run_profiled
+from progress import AnalysisCancelled
 
 def browse_file():
-    file_path = filedialog.askopenfilename(filetypes=[("Gcode Files", "*.gcode")])
+    file_path = filedialog.askopenfilename(filetypes=[("Gcode Files", "*.gcode"), ("Bambu Studio Projects", "*.gcode.3mf")])
     input_file_entry.delete(0, tk.END)
     input_file_entry.insert(0, file_path)
 
 def analyze_file():
-    input_file_path = input_file_entry.get()
-    t_commands = main.get_t_commands(input_file_path)
-    t_commands_listbox.delete(0, tk.END)  # Clear the listbox
-    for idx, t_command in enumerate(t_commands, start=1):
-        t_commands_listbox.insert(tk.END, f"{idx}. {t_command}")
+    input_file_path = os.path.abspath(input_file_entry.get())
+
+    def work():
+        # Projects are analyzed on their first plate
+        gcode_path = analysis("working_gcode_path", input_file_path)
+        return (analysis("get_t_commands", gcode_path), analysis("layer_filament_order", gcode_path),
+                analysis("estimate_purge_costs", gcode_path)["total"])
+
+    def done(result):
+        t_commands, t_command_order, total = result
+        t_commands_listbox.delete(0, tk.END)  # Clear the listbox
+        for idx, t_command in enumerate(t_commands, start=1):
+            t_commands_listbox.insert(tk.END, f"{idx}. {t_command}")
+
+        # The reorder entry starts from the current order of the layer 1 features
+        reorder_entry.delete(0, tk.END)
+        reorder_entry.insert(0, " ".join(t_command_order))
+
+        # Show the estimated purge and wipe cost of the whole print
+        purge_label.config(text=f"Purge and wipe estimate: {total['extruded_length']:.0f} mm filament ({total['extruded_volume'] / 1000:.1f} cm3), {total['duration'] / 60:.1f} min")
+
+    run_in_background(work, done)
 
 def generate_swap():
-    input_file_path = input_file_entry.get()
+    input_file_path = os.path.abspath(input_file_entry.get())
     selected_indices = t_commands_listbox.curselection()
     if len(selected_indices) != 2:
         swap_generated_label.config(text="Please select exactly two T commands.")
@@ -24,23 +48,192 @@ def generate_swap():
     t_command1_idx, t_command2_idx = selected_indices
     t_command1 = t_commands_listbox.get(t_command1_idx).split(". ")[1]
     t_command2 = t_commands_listbox.get(t_command2_idx).split(". ")[1]
-    main.generate_instructions(input_file_path, t_command1, t_command2)
-    main.copy_features(input_file_path, t_command1, t_command2)
-    swap_generated_label.config(text="Swap files generated successfully.")
+
+    def work():
+        if gcode_3mf.is_archive(input_file_path):
+            return analysis("swap_first_plate", input_file_path, t_command1, t_command2)
+        analysis("generate_instructions", input_file_path, t_command1, t_command2)
+        analysis("copy_features", input_file_path, t_command1, t_command2)
+        output_file_path = analysis("generate_swapped_gcode", input_file_path, t_command1, t_command2)
+        return output_file_path, print_time_change(input_file_path, output_file_path)
+
+    def done(result):
+        if isinstance(result, dict):
+            swap_generated_label.config(text=archive_result_text(result, ""))
+        elif result[0] is None:
+            swap_generated_label.config(text="Could not swap the T commands.")
+        else:
+            swap_generated_label.config(text="Swap files generated successfully." + result[1])
+
+    run_in_background(work, done)
+
+def generate_reorder():
+    input_file_path = os.path.abspath(input_file_entry.get())
+    t_command_order = reorder_entry.get().upper().replace(",", " ").split()
+
+    def work():
+        if gcode_3mf.is_archive(input_file_path):
+            return analysis("reorder_first_plate", input_file_path, t_command_order)
+        output_file_path = analysis("generate_reordered_gcode", input_file_path, t_command_order)
+        return output_file_path, print_time_change(input_file_path, output_file_path)
+
+    def done(result):
+        if isinstance(result, dict):
+            reorder_label.config(text=archive_result_text(result, ""))
+        elif result[0] is None:
+            reorder_label.config(text="Could not reorder the T commands.")
+        else:
+            reorder_label.config(text="Reordered file generated successfully." + result[1])
+
+    run_in_background(work, done)
 
 def modify_gcode():
-    input_file_path = input_file_entry.get()
-    start_line = main.gcode_start_locator(input_file_path)
-    calibration_start_line, calibration_end_line, calibration_extra_start, calibration_extra_end = main.turn_off_calibration(input_file_path, start_line)
-    main.modify_gcode_cal(input_file_path, calibration_start_line, calibration_end_line, calibration_extra_start, calibration_extra_end)
-    calibration_off_label.config(text="Calibration turned off successfully.")
+    input_file_path = os.path.abspath(input_file_entry.get())
+
+    def work():
+        if gcode_3mf.is_archive(input_file_path):
+            return analysis("process_archive", input_file_path, calibration_off=True)
+        return analysis("calibration_off", input_file_path)
+
+    def done(result):
+        if isinstance(result, dict):
+            calibration_off_label.config(text=archive_result_text(result, ""))
+        elif result is None:
+            calibration_off_label.config(text="Could not turn off the calibration.")
+        else:
+            calibration_off_label.config(text="Calibration turned off successfully.")
+
+    run_in_background(work, done)
 
 def debug_output():
-    input_file_path = input_file_entry.get()
+    input_file_path = os.path.abspath(input_file_entry.get())
     output_file_path_debug = input_file_path.replace(".gcode", "_debug.txt")
-    main.write_to_output_file_debug(output_file_path_debug, input_file_path)
-    debug_label.config(text="Debug file generated successfully.")
+    if gcode_3mf.is_archive(input_file_path):
+        output_file_path_debug = input_file_path[:-len(gcode_3mf.ARCHIVE_SUFFIX)] + "_debug.txt"
+    run_in_background(lambda: analysis("write_to_output_file_debug", output_file_path_debug, analysis("working_gcode_path", input_file_path)),
+                      lambda result: debug_label.config(text="Debug file generated successfully."))
+
+def optimize_order():
+    input_file_path = os.path.abspath(input_file_entry.get())
+
+    def done(plan):
+        if plan is None:
+            optimize_label.config(text="Could not optimize the filament order.")
+            return
+        optimize_label.config(text=f"Plan written. Estimated savings: {plan['grams_saved']:.1f} g, {plan['minutes_saved']:.1f} min.")
+
+    def work():
+        gcode_path = analysis("working_gcode_path", input_file_path)
+        plan = analysis("optimize_filament_order", gcode_path)
+        if plan is not None and gcode_path != input_file_path:
+            analysis("export_plate_file", input_file_path, os.path.splitext(gcode_path)[0] + "_filament_plan.txt")
+        return plan
+
+    run_in_background(work, done)
+
+def print_time_change(input_file_path, output_file_path):
+    # The layer 1 print time before and after a swap, to add to the label ("" without an output or NumPy)
+    if output_file_path is None:
+        return ""
+    comparison = analysis("compare_print_times", input_file_path, output_file_path)
+    if comparison is None:
+        return ""
+    return " " + main.print_time_text(comparison) + "."
+
+def analysis(name, *args, **kwargs):
+    # Run one of the analysis daemon's calls there when it is running, on the files it keeps in memory. A profiled
+    # task runs here, so the profile shows the work
+    if background_task["profile"] is not None:
+        return analysis_daemon.run_local(name, *args, **kwargs)
+    return analysis_daemon.call(name, *args, **kwargs)
+
+def archive_result_text(summary, success_text):
+    # Label text after a task, summary is the result of gcode_3mf.process_archive for projects (None otherwise)
+    if summary is None:
+        return success_text
+    if summary["output"] is None:
+        return "Failed: " + "; ".join(summary["failures"])
+    text = f"Written to '{os.path.basename(summary['output'])}'."
+    if summary["failures"]:
+        text += " Failed: " + "; ".join(summary["failures"])
+    return text
+
+def report_progress(phase, done, total):
+    # Called on the worker thread: only record the progress, poll_background shows it on the Tk event loop
+    if cancel_requested.is_set():
+        raise AnalysisCancelled()
+    background_progress.update(phase=phase, done=done, total=total)
+
+def run_in_background(work, on_done):
+    # Run work() on the worker thread and call on_done(result) on the Tk event loop when it finishes.
+    # Only one task runs at a time, the action buttons are disabled meanwhile
+    if background_task["future"] is not None:
+        return
+    cancel_requested.clear()
+    background_progress.update(phase="Starting", done=0, total=0)
+    for button in action_buttons:
+        button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.NORMAL)
 
+    # With "Profile" checked the task is profiled, and the profile written next to the input file
+    background_task["profile"] = None
+    if profile_enabled.get():
+        input_file_path = os.path.abspath(input_file_entry.get())
+        background_task["profile"] = profile_paths(input_file_path)[0]
+        profiled_work = work
+        work = lambda: run_profiled(input_file_path, profiled_work)
+
+    background_task["future"] = executor.submit(main.run_with_progress, work, progress=report_progress)
+    background_task["on_done"] = on_done
+    root.after(POLL_INTERVAL_MS, poll_background)
+
+def poll_background():
+    # Show the latest progress, and hand the result over once the task is finished
+    total = background_progress["total"]
+    progress_bar["value"] = 100 * background_progress["done"] / total if total else 0
+    progress_label.config(text=background_progress["phase"])
+
+    future = background_task["future"]
+    if not future.done():
+        root.after(POLL_INTERVAL_MS, poll_background)
+        return
+
+    background_task["future"] = None
+    for button in action_buttons:
+        button.config(state=tk.NORMAL)
+    cancel_button.config(state=tk.DISABLED)
+
+    try:
+        result = future.result()
+    except AnalysisCancelled:
+        progress_label.config(text="Cancelled.")
+        return
+    except Exception as error:
+        progress_label.config(text=f"Failed: {error}")
+        return
+
+    progress_bar["value"] = 100
+    progress_label.config(text="Done." if background_task["profile"] is None else f"Done. Profile written to '{background_task['profile']}'.")
+    background_task["on_done"](result)
+
+def cancel_background():
+    # The worker stops at its next progress report
+    cancel_requested.set()
+    progress_label.config(text="Cancelling...")
+
+def close_window():
+    # Stop a running task instead of waiting for it to finish
+    cancel_requested.set()
+    executor.shutdown(wait=False, cancel_futures=True)
+    root.destroy()
+
+
+# Analysis and file generation run on one worker thread so the window stays responsive
+executor = ThreadPoolExecutor(max_workers=1)
+cancel_requested = threading.Event()
+background_progress = {"phase": "", "done": 0, "total": 0}
+background_task = {"future": None, "on_done": None, "profile": None}
+POLL_INTERVAL_MS = 100
 
 # Create the main window
 root = tk.Tk()
@@ -63,6 +256,9 @@ analyze_button.grid(row=1, column=0, columnspan=3, padx=10, pady=5)
 t_commands_listbox = tk.Listbox(root, selectmode=tk.MULTIPLE, width=50, height=10)
 t_commands_listbox.grid(row=2, column=0, columnspan=3, padx=10, pady=5)
 
+purge_label = tk.Label(root, text="")
+purge_label.grid(row=15, column=0, columnspan=3, padx=10, pady=5)
+
 # Select T Commands
 select_t_commands_label = tk.Label(root, text="Select Two T Commands to Swap:")
 select_t_commands_label.grid(row=3, column=0, columnspan=3, padx=10, pady=5)
@@ -76,18 +272,53 @@ generate_swap_button.grid(row=5, column=0, columnspan=3, padx=10, pady=5)
 swap_generated_label = tk.Label(root, text="")
 swap_generated_label.grid(row=6, column=0, columnspan=3, padx=10, pady=5)
 
+# Reorder the Layer 1 Features
+reorder_entry = tk.Entry(root, width=50)
+reorder_entry.grid(row=7, column=0, columnspan=2, padx=10, pady=5)
+
+generate_reorder_button = tk.Button(root, text="Generate Reorder", command=generate_reorder)
+generate_reorder_button.grid(row=7, column=2, padx=5, pady=5)
+
+reorder_label = tk.Label(root, text="")
+reorder_label.grid(row=8, column=0, columnspan=3, padx=10, pady=5)
+
 # Turn Calibration Off
 calibration_off_button = tk.Button(root, text="Turn Calibration Off", command=modify_gcode)
-calibration_off_button.grid(row=7, column=0, columnspan=3, padx=10, pady=5)
+calibration_off_button.grid(row=9, column=0, columnspan=3, padx=10, pady=5)
 
 calibration_off_label = tk.Label(root, text="")
-calibration_off_label.grid(row=8, column=0, columnspan=3, padx=10, pady=5)
+calibration_off_label.grid(row=10, column=0, columnspan=3, padx=10, pady=5)
 
 # Debug Output
 debug_button = tk.Button(root, text="Debug", command=debug_output)
-debug_button.grid(row=9, column=0, columnspan=3, padx=10, pady=5)
+debug_button.grid(row=11, column=0, columnspan=3, padx=10, pady=5)
+
+profile_enabled = tk.BooleanVar(value=False)
+profile_checkbutton = tk.Checkbutton(root, text="Profile", variable=profile_enabled)
+profile_checkbutton.grid(row=11, column=2, padx=5, pady=5)
 
 debug_label = tk.Label(root, text="")
-debug_label.grid(row=10, column=0, columnspan=3, padx=10, pady=5)
+debug_label.grid(row=12, column=0, columnspan=3, padx=10, pady=5)
+
+# Optimize Filament Order
+optimize_button = tk.Button(root, text="Optimize Filament Order", command=optimize_order)
+optimize_button.grid(row=13, column=0, columnspan=3, padx=10, pady=5)
+
+optimize_label = tk.Label(root, text="")
+optimize_label.grid(row=14, column=0, columnspan=3, padx=10, pady=5)
+
+# Progress and Cancel
+progress_bar = ttk.Progressbar(root, orient=tk.HORIZONTAL, length=300, mode="determinate", maximum=100)
+progress_bar.grid(row=16, column=0, columnspan=2, padx=10, pady=5)
+
+cancel_button = tk.Button(root, text="Cancel", command=cancel_background, state=tk.DISABLED)
+cancel_button.grid(row=16, column=2, padx=5, pady=5)
+
+progress_label = tk.Label(root, text="")
+progress_label.grid(row=17, column=0, columnspan=3, padx=10, pady=5)
+
+root.protocol("WM_DELETE_WINDOW", close_window)
+
+action_buttons = [browse_button, analyze_button, generate_swap_button, generate_reorder_button, calibration_off_button, debug_button, optimize_button]
 
 root.mainloop()
@@ -1,80 +1,105 @@
+import ftplib
+import os
 import re
+from bisect import bisect_left, bisect_right
+from filament_optimizer import filament_plan
+from gcode_index import get_gcode_index
+from gcode_patch import PATCH_SUFFIX, apply_patches, make_patch, read_patch, write_patch
+from gcode_scanner import find_terms, line_range_bytes, line_start_offsets, map_gcode_file, ordered_term_lines
+from gcode_writer import insertion_segments, replacement_segments, splice_segments
+from printer_upload import FTP_USER, TLS_MODES, upload_gcode
+from profiler import count_file_read, profile_paths, profiled, run_profiled
+from progress import get_progress_callback, set_progress_callback
+from purge_estimator import COST_FIELDS, filament_cross_section, filament_diameters, span_costs
+
+# The print time estimate with acceleration needs NumPy
+try:
+    from print_time_estimator import move_times, range_seconds
+except ImportError:
+    move_times = None
 
 def is_comment(line):
     # Check if the line is a comment (assuming comments start with a semicolon)
     return line.strip().startswith(";")
 
+@profiled
 def gcode_start_locator(input_file_path):
-    # Read the input G-code file and find the first command
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # The first command (skipping empty lines and comments) is recorded by the index, None if there is none
+    return get_gcode_index(input_file_path).first_command_line
 
-        for i, line in enumerate(lines, start=1):
-            # Skip empty lines and comments before finding the first command
-            if not line.strip() or is_comment(line):
-                continue
-
-            # Find the first command and return its line number
-            return i
-
-    # Return None if no command is found
-    return None
+def indexed_line_numbers(indexed, terms_to_find):
+    # Build a locator result from the index, copying the lists so callers can't change the index
+    return {term: list(line_numbers) for term, line_numbers in ordered_term_lines(indexed, terms_to_find).items()}
 
+@profiled
 def gcode_command_locator(input_file_path, commands_to_find):
-    # Initialize an empty dictionary to store the line numbers for each command
-    command_line_numbers = {}
-
-    # Read the input G-code file and find the line numbers for each command
-    with open(input_file_path, "r") as input_file:
-        for i, line in enumerate(input_file, start=1):
-            # Skip lines that are comments
-            if is_comment(line):
-                continue
-
-            for command in commands_to_find:
-                if command.lower() in line.lower():  # Ignore case sensitivity
-                    if command not in command_line_numbers:
-                        command_line_numbers[command] = []
-                    command_line_numbers[command].append(i)
+    # Answer from the index when every command is one it records
+    index = get_gcode_index(input_file_path)
+    if all(command in index.commands for command in commands_to_find):
+        return indexed_line_numbers(index.commands, commands_to_find)
 
-    return command_line_numbers
+    # Otherwise scan the non-comment lines of the mapped file (ignoring case)
+    return find_terms(input_file_path, commands_to_find, comments=False)
 
+@profiled
 def gcode_comments_locator(input_file_path, comments_to_find):
-    # Initialize an empty dictionary to store the line numbers for each comment
-    comment_line_numbers = {}
-
-    # Read the input G-code file and find the line numbers for each comment
-    with open(input_file_path, "r") as input_file:
-        for i, line in enumerate(input_file, start=1):
-            # Skip lines that are not comments
-            if not is_comment(line):
-                continue
-
-            for comment in comments_to_find:
-                if comment.lower() in line.lower():  # Ignore case sensitivity
-                    if comment not in comment_line_numbers:
-                        comment_line_numbers[comment] = []
-                    comment_line_numbers[comment].append(i)
-
-    return comment_line_numbers
-
+    # Answer from the index when every comment is one it records
+    index = get_gcode_index(input_file_path)
+    if all(comment in index.comments for comment in comments_to_find):
+        return indexed_line_numbers(index.comments, comments_to_find)
+
+    # Otherwise scan the comment lines of the mapped file (ignoring case)
+    return find_terms(input_file_path, comments_to_find, comments=True)
+
+def line_number_after(line_numbers, line):
+    # Find the first line number greater than 'line' in a sorted list
+    i = bisect_right(line_numbers, line)
+    return line_numbers[i] if i < len(line_numbers) else None
+
+def line_number_before(line_numbers, line):
+    # Find the last line number smaller than 'line' in a sorted list
+    i = bisect_left(line_numbers, line)
+    return line_numbers[i - 1] if i > 0 else None
+
+def line_numbers_between(line_numbers, start_line, end_line):
+    # Get the line numbers strictly between 'start_line' and 'end_line' from a sorted list
+    return line_numbers[bisect_right(line_numbers, start_line):bisect_left(line_numbers, end_line)]
+
+def slicer_profile(input_file_path):
+    # Comments, markers and line offsets of the slicer version that wrote the file (see slicer_profiles)
+    return get_gcode_index(input_file_path).profile
+
+def layer_bounds(input_file_path, layer_number=1):
+    # Find the first and last line of a layer from the layer table, (None, None) if there is no such layer
+    return get_gcode_index(input_file_path).layer_bounds(layer_number)
+
+@profiled
+def get_layers(input_file_path):
+    # Describe every layer: Z height, line and byte range, and the lines of its T commands
+    index = get_gcode_index(input_file_path)
+    layers = []
+    for layer_number in range(1, index.layer_count() + 1):
+        layers.append({
+            "layer": layer_number,
+            "z": index.layer_z[layer_number - 1],
+            "start_line": index.layer_start_lines[layer_number - 1],
+            "end_line": index.layer_end_lines[layer_number - 1],
+            "start_offset": index.layer_start_offsets[layer_number - 1],
+            "end_offset": index.layer_end_offsets[layer_number - 1],
+            "t_command_lines": index.layer_tool_lines(layer_number)
+        })
+    return layers
+
+@profiled
 def first_layer_end(input_file_path):
-    # Find the line number for the comment "Z_HEIGHT: 0.4"
-    comment_line_numbers = gcode_comments_locator(input_file_path, ["Z_HEIGHT: 0.4"])
-    z_height_line = comment_line_numbers.get("Z_HEIGHT: 0.4", None)
-
-    if z_height_line is not None:
-        # Subtract 2 from the line number to get the "End of Layer 1 gcode" line number
-        end_of_layer_line = z_height_line[0] - 2
-        return end_of_layer_line
-
-    # Return None if the "Z_HEIGHT: 0.4" comment is not found
-    return None
+    # Layer 1 ends a few lines before the second layer comment ("Z_HEIGHT:"), whatever the first layer height is
+    # Return None if the file has no layers
+    return layer_bounds(input_file_path, 1)[1]
 
+@profiled
 def swap_finder(input_file_path):
-    # Read the input G-code file and get the lines
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # Get the filament numbers and T command lines from the index
+    index = get_gcode_index(input_file_path)
 
     # Find the line numbers for the specified G-code commands
     commands_to_find = ["M620", "M621", "T"]
@@ -85,24 +110,26 @@ def swap_finder(input_file_path):
     m621_swaps = {}
     t_swaps = {}
 
-    # Loop through the M620 commands and find associated M621 and T commands
-    t_commands = command_line_numbers.get("T", [])
+    # The locator returns each list in file order, so pairs are found by binary search
+    m620_commands = command_line_numbers.get("M620", [])
     m621_commands = command_line_numbers.get("M621", [])
+    t_commands = command_line_numbers.get("T", [])
 
-    for m620_line in command_line_numbers.get("M620", []):
-        m620_command = lines[m620_line - 1].strip()
-        filament_number_match = re.search(r"S(\d+)A", m620_command)
-        if filament_number_match:
-            filament_number = int(filament_number_match.group(1))
+    # The M620 lines that load a filament ("M620 S0A"), the locator also finds "M620.1" lines
+    m620_lines = sorted(index.m620_filaments)
 
+    # Loop through the M620 commands and find associated M621 and T commands
+    for m620_line in m620_commands:
+        filament_number = index.m620_filaments.get(m620_line)
+        if filament_number is not None:
             # Find the M621 command after the M620 command
-            m621_line = next((line_num for line_num in m621_commands if line_num > m620_line), None)
+            m621_line = line_number_after(m621_commands, m620_line)
 
             # Find the T command(s) between M620 and M621 commands
-            t_lines = [line_num for line_num in t_commands if m620_line < line_num < m621_line]
+            t_lines = line_numbers_between(t_commands, m620_line, m621_line) if m621_line is not None else []
 
             # Filter out T commands that are part of other commands (e.g., "T1" within "T10")
-            t_lines = [line_num for line_num in t_lines if lines[line_num - 1].strip() == f"T{filament_number}"]
+            t_lines = [line_num for line_num in t_lines if index.tool_commands.get(line_num) == f"T{filament_number}"]
 
             # Add the swap data to the appropriate dictionary
             if m620_line not in m620_swaps:
@@ -115,54 +142,49 @@ def swap_finder(input_file_path):
                 t_swaps[t_line] = {"start": [], "middle": [t_line], "end": []}
 
     # Loop through the M621 commands and find associated M620 commands
-    for m621_line in command_line_numbers.get("M621", []):
+    for m621_line in m621_commands:
         # Find the M620 command closest to the M621 command without exceeding it
-        m620_line = next((line_num for line_num in command_line_numbers.get("M620", []) if line_num < m621_line), None)
+        m620_line = line_number_before(m620_lines, m621_line)
 
         # Add the swap data to the m621_swaps dictionary
         m621_swaps[m621_line] = {"start": [m620_line], "middle": [], "end": [m621_line]}
 
     # Loop through the T commands and find associated M620 and M621 commands
-    for t_line in command_line_numbers.get("T", []):
+    for t_line in t_commands:
         # Find the M620 command before the T command
-        m620_line = next((line_num for line_num in command_line_numbers.get("M620", []) if line_num < t_line), None)
+        m620_line = line_number_before(m620_lines, t_line)
 
         # Find the M621 command after the T command
-        m621_line = next((line_num for line_num in command_line_numbers.get("M621", []) if line_num > t_line), None)
+        m621_line = line_number_after(m621_commands, t_line)
 
         # Add the swap data to the t_swaps dictionary
         t_swaps[t_line] = {"start": [m620_line], "middle": [t_line], "end": [m621_line]}
 
     return m620_swaps, m621_swaps, t_swaps
 
+@profiled
 def swap_finder_fixer(input_file_path, m620_swaps):
-    # Read the input G-code file and get the lines
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # Get the filament numbers and T references from the index
+    index = get_gcode_index(input_file_path)
 
     # Create a list to store the corrected filament swaps
     corrected_swaps_list = []
 
     for swap_line, swap_data in m620_swaps.items():
-        # Find the M620 command at the specified line
-        m620_command = lines[swap_line - 1].strip()
-
-        # Extract the filament number from the M620 command
-        filament_number_match = re.search(r"S(\d+)A", m620_command)
-        if filament_number_match:
-            filament_number = int(filament_number_match.group(1))
-
+        # Extract the filament number from the M620 command at the specified line
+        filament_number = index.m620_filaments.get(swap_line)
+        if filament_number is not None:
             # Find the M621 command after the M620 command
             m621_line = swap_data["end"][0] if swap_data["end"] else None
 
             # Find the T commands between M620 and M621 commands
             t_lines = []
             if m621_line:
-                for t_line in range(swap_line + 1, m621_line):
-                    t_command = lines[t_line - 1].strip()
-                    t_filament_number_match = re.search(r"T(\d+)", t_command)
-                    if t_filament_number_match and int(t_filament_number_match.group(1)) == filament_number:
-                        t_lines.append(t_line)
+                first = bisect_right(index.tool_reference_lines, swap_line)
+                last = bisect_left(index.tool_reference_lines, m621_line)
+                for i in range(first, last):
+                    if index.tool_reference_numbers[i] == filament_number:
+                        t_lines.append(index.tool_reference_lines[i])
 
             # Add the corrected swap data to the list
             corrected_swap_data = {
@@ -190,38 +212,47 @@ def filter_output(output_data, start_line, end_line):
 
     return filtered_output
 
+@profiled
 def feature_start_finder(input_file_path):
-    # Read the input G-code file and get the lines
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # Get the retraction markers of the file's slicer version from the index
+    index = get_gcode_index(input_file_path)
+    first_retract = index.profile["markers"]["first_feature_retract"]
+    retract = index.profile["markers"]["feature_retract"]
+    toolchange_end = index.profile["comments"]["toolchange_end"]
+    offsets = index.profile["offsets"]
 
     # Find the line numbers for the "CP TOOLCHANGE END" comment
-    toolchange_comments = gcode_comments_locator(input_file_path, ["CP TOOLCHANGE END"])
+    toolchange_comments = gcode_comments_locator(input_file_path, [toolchange_end])
 
     # Initialize a dictionary to store the feature start line for each toolchange
     feature_start_lines = {}
 
     # Find the first instance of "G1 E-.8 F1800" in the entire file
-    for i, line in enumerate(lines, start=1):
-        if "G1 E-.8 F1800" in line:
-            feature_start_lines["G1 E-.8 F1800"] = i + 1
-            break
+    for line_number in index.markers[first_retract]:
+        feature_start_lines[first_retract] = line_number + offsets["first_feature_start"]
+        break
 
     # Find the first instance of "G1 E-.04 F1800" after each "CP TOOLCHANGE END" comment
-    for toolchange_line in toolchange_comments.get("CP TOOLCHANGE END", []):
-        for i in range(toolchange_line + 1, len(lines)):
-            line = lines[i]
-            if "G1 E-.04 F1800" in line:
-                feature_start_lines[toolchange_line] = i + 4
-                break
+    # (the search starts two lines below the comment, the feature three lines below the retraction)
+    for toolchange_line in toolchange_comments.get(toolchange_end, []):
+        line_number = line_number_after(index.markers[retract], toolchange_line + 1)
+        if line_number is not None:
+            feature_start_lines[toolchange_line] = line_number + offsets["feature_start"]
 
     # Return only the feature start lines without the toolchange lines
     return list(feature_start_lines.values())
 
+def preceding_tool_command(index, line_number):
+    # Find the last "Ti" command at or before the line (line 1 is never considered)
+    tool_line = index.active_tool_line(line_number)
+    if tool_line is None or tool_line < 2:
+        return None
+    return index.tool_commands[tool_line]
+
+@profiled
 def feature_identifier(input_file_path):
-    # Read the input G-code file and get the lines
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # Get the "Ti" command lines from the index
+    index = get_gcode_index(input_file_path)
 
     # Find the feature start lines for each "CP TOOLCHANGE END" comment
     feature_start_lines = feature_start_finder(input_file_path)
@@ -231,79 +262,75 @@ def feature_identifier(input_file_path):
 
     # Find the first instance of a "Ti" command preceding each feature start line
     for feature_start_line in feature_start_lines:
-        # Search for the first instance of a "Ti" command before the feature start line
-        ti_command_line = None
-        for i in range(feature_start_line - 1, 0, -1):
-            line = lines[i].strip()
-            if line.startswith("T") and line[1:].isdigit():
-                ti_command_line = i + 1
-                break
-
-        # Add the identified Ti command to the dictionary
-        if ti_command_line:
-            ti_command = lines[ti_command_line - 1].strip()
-            ti_commands[feature_start_line] = ti_command
-        else:
-            ti_commands[feature_start_line] = None
+        # Add the identified Ti command to the dictionary, None if there is no preceding one
+        ti_commands[feature_start_line] = preceding_tool_command(index, feature_start_line)
 
     return ti_commands
 
+@profiled
 def find_wipe_start_end(input_file_path):
+    # Get the wipe markers from the index
+    index = get_gcode_index(input_file_path)
+    wipe_start = index.profile["markers"]["wipe_start"]
+    wipe_end = index.profile["markers"]["wipe_end"]
+    toolchange_start = index.profile["comments"]["toolchange_start"]
+
     # Find the line numbers for the "CP TOOLCHANGE START" comment
-    toolchange_start_comments = gcode_comments_locator(input_file_path, ["CP TOOLCHANGE START"])
+    toolchange_start_comments = gcode_comments_locator(input_file_path, [toolchange_start])
 
     # Initialize a dictionary to store the wipe start and end line for each toolchange
     wipe_start_end_lines = {}
 
     # Find the first instance of "WIPE_START" after each "CP TOOLCHANGE START" comment
-    for toolchange_line in toolchange_start_comments.get("CP TOOLCHANGE START", []):
-        with open(input_file_path, "r") as input_file:
-            lines = input_file.readlines()
-
-        for i in range(toolchange_line + 1, len(lines)):
-            line = lines[i]
-            if "WIPE_START" in line:
-                wipe_start_end_lines[toolchange_line] = {"wipe_start": i}
-                break
+    # (like the feature markers, wipe lines are recorded as the line before the marker)
+    for toolchange_line in toolchange_start_comments.get(toolchange_start, []):
+        line_number = line_number_after(index.markers[wipe_start], toolchange_line + 1)
+        if line_number is not None:
+            wipe_start_end_lines[toolchange_line] = {"wipe_start": line_number - 1}
 
     # Find the first instance of "WIPE_END" after each "WIPE_START" comment
     for toolchange_line, wipe_data in wipe_start_end_lines.items():
-        wipe_start_line = wipe_data["wipe_start"]
-        with open(input_file_path, "r") as input_file:
-            lines = input_file.readlines()
-
-        for i in range(wipe_start_line + 1, len(lines)):
-            line = lines[i]
-            if "WIPE_END" in line:
-                wipe_start_end_lines[toolchange_line]["wipe_end"] = i
-                break
-    
+        line_number = line_number_after(index.markers[wipe_end], wipe_data["wipe_start"] + 1)
+        if line_number is not None:
+            wipe_data["wipe_end"] = line_number - 1
+
     return wipe_start_end_lines
 
+def filter_wipe_start_end_lines(wipe_start_end_lines, start_line, end_line):
+    # Keep the complete wipes that start or end between start_line and end_line
+    filtered_wipe_start_end_lines = {}
+    for toolchange_line, wipe_data in wipe_start_end_lines.items():
+        wipe_start_line = wipe_data.get("wipe_start", None)
+        wipe_end_line = wipe_data.get("wipe_end", None)
+        if wipe_start_line is not None and wipe_end_line is not None:
+            if start_line <= wipe_start_line <= end_line or start_line <= wipe_end_line <= end_line:
+                filtered_wipe_start_end_lines[toolchange_line] = {"wipe_start": wipe_start_line, "wipe_end": wipe_end_line}
+    return filtered_wipe_start_end_lines
+
+@profiled
 def wipe_identifier(input_file_path, filtered_wipe_start_end_lines):
     # Initialize a dictionary to store the corresponding "T" command for each wipe start line
     wipe_ti_commands = {}
 
-    # Read the input G-code file and get the lines
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # Get the "Ti" command lines from the index
+    index = get_gcode_index(input_file_path)
+
+    # Fetch the corresponding "T" command for each wipe start line
+    for wipe_data in filtered_wipe_start_end_lines.values():
+        wipe_start_line = wipe_data.get("wipe_start", None)
+        if wipe_start_line:
+            ti_command = preceding_tool_command(index, wipe_start_line)
+            if ti_command is not None:
+                wipe_ti_commands[wipe_start_line] = ti_command
 
-        # Fetch the corresponding "T" command for each wipe start line from the G-code file content
-        for wipe_data in filtered_wipe_start_end_lines.values():
-            wipe_start_line = wipe_data.get("wipe_start", None)
-            if wipe_start_line:
-                for i in range(wipe_start_line - 1, 0, -1):
-                    line = lines[i].strip()
-                    if line.startswith("T") and line[1:].isdigit():
-                        wipe_ti_commands[wipe_start_line] = line
-                        break
-    
     return wipe_ti_commands
 
+@profiled
 def turn_off_calibration(input_file_path, start_line):
-    # Define the comments to find
-    calibration_start_comment = "extrinsic para cali paint"
-    calibration_end_comment = "turn off light and wait extrude temperature"
+    # Define the comments to find, as written by the file's slicer version
+    profile = slicer_profile(input_file_path)
+    calibration_start_comment = profile["comments"]["calibration_start"]
+    calibration_end_comment = profile["comments"]["calibration_end"]
 
     # Find the line numbers for the specified comments starting from 'start_line'
     comment_line_numbers = gcode_comments_locator(input_file_path, [calibration_start_comment, calibration_end_comment])
@@ -316,44 +343,74 @@ def turn_off_calibration(input_file_path, start_line):
 
     if calibration_start_line is not None and calibration_end_line is not None:
         # Calculate Calibration_extra_start and Calibration_extra_end
-        calibration_extra_start = calibration_end_line + 2
-        calibration_extra_end = calibration_extra_start + 5
+        calibration_extra_start = calibration_end_line + profile["offsets"]["calibration_extra_start"]
+        calibration_extra_end = calibration_extra_start + profile["offsets"]["calibration_extra_lines"]
 
         return calibration_start_line, calibration_end_line, calibration_extra_start, calibration_extra_end
     else:
         return None, None, None, None
     
-def modify_gcode_cal(input_file_path, calibration_start, calibration_end, calibration_extra_start, calibration_extra_end):
-    # Create the output file name by appending "_output" at the end of the input file name
-    output_file_name = input_file_path.split(".")[0] + "_cal_off_output.gcode"
-
-    # Read the content of the input file
-    with open(input_file_path, "r") as input_file:
-        gcode_lines = input_file.readlines()
+def write_output_patch(input_file_path, output_file_path, file_size, replacements):
+    # Write a patch of the changes instead of the output file, next to where the output would go (see gcode_patch)
+    patch_file_path = os.path.splitext(output_file_path)[0] + PATCH_SUFFIX
+    return write_patch(make_patch(input_file_path, output_file_path, file_size, replacements), patch_file_path)
 
-    # Modify the G-code lines based on the provided calibration ranges
-    for line_number in range(calibration_start, calibration_end + 1):
-        if line_number <= len(gcode_lines):  # Ensure line number is within the range
-            gcode_lines[line_number - 1] = ";" + gcode_lines[line_number - 1]
-
-    for line_number in range(calibration_extra_start, calibration_extra_end + 1):
-        if line_number <= len(gcode_lines):  # Ensure line number is within the range
-            gcode_lines[line_number - 1] = ";" + gcode_lines[line_number - 1]
-
-    # Write the modified G-code lines to the output file
-    with open(output_file_name, "w") as output_file:
-        output_file.writelines(gcode_lines)
+@profiled
+def modify_gcode_cal(input_file_path, calibration_start, calibration_end, calibration_extra_start, calibration_extra_end, patch=False):
+    # Create the output file name by appending "_output" at the end of the input file name
+    output_file_name = os.path.splitext(input_file_path)[0] + "_cal_off_output.gcode"
+
+    # Count how many ";" to put in front of each line in the calibration ranges
+    comment_prefixes = {}
+    for range_start, range_end in [(calibration_start, calibration_end), (calibration_extra_start, calibration_extra_end)]:
+        if range_start is None or range_end is None:
+            continue
+        for line_number in range(range_start, range_end + 1):
+            comment_prefixes[line_number] = comment_prefixes.get(line_number, 0) + 1
+
+    # Find where those lines start (lines past the end of the file are left alone)
+    with open(input_file_path, "rb") as input_file:
+        data = map_gcode_file(input_file)
+        file_size = len(data) if data is not None else 0
+        line_offsets = line_start_offsets(data, comment_prefixes)
+        count_file_read(bytes_read=max(line_offsets.values(), default=0))
+        if data is not None:
+            data.close()
+
+    # Stream the file to the output, only inserting the ";" characters
+    insertions = [(line_offsets[line_number], b";" * comment_prefixes[line_number]) for line_number in sorted(line_offsets)]
+    if patch:
+        return write_output_patch(input_file_path, output_file_name, file_size, [(offset, offset, data) for offset, data in insertions])
+    splice_segments(input_file_path, output_file_name, insertion_segments(file_size, insertions))
 
     # Print a console message indicating the output file name
     #print(f"Output G-code file written to '{output_file_name}'.")
+    return output_file_name
 
-def feature_locator_wformat(input_file_path):
+@profiled
+def calibration_off(input_file_path, patch=False):
+    # Comment out the calibration found after the first command, returning the output file name (or the name of
+    # its patch file, with patch=True)
+    start_line = gcode_start_locator(input_file_path)
+    if start_line is None:
+        print(f"No G-code commands found in '{input_file_path}'.")
+        return None
+    calibration_start_line, calibration_end_line, calibration_extra_start, calibration_extra_end = turn_off_calibration(input_file_path, start_line)
+    return modify_gcode_cal(input_file_path, calibration_start_line, calibration_end_line, calibration_extra_start, calibration_extra_end, patch)
+
+@profiled
+def feature_locator_wformat(input_file_path, layer_number=1):
     # Find the feature start lines for each "CP TOOLCHANGE END" comment
     feature_start_lines = feature_start_finder(input_file_path)
 
     # Find the associated T commands for each feature start line
     ti_commands = feature_identifier(input_file_path)
 
+    # Find the "CP TOOLCHANGE START" comments that close each feature
+    profile = slicer_profile(input_file_path)
+    toolchange_start = profile["comments"]["toolchange_start"]
+    toolchange_start_comments = gcode_comments_locator(input_file_path, [toolchange_start])
+
     # Initialize lists to store the feature information
     feature_info_list = []
 
@@ -363,8 +420,8 @@ def feature_locator_wformat(input_file_path):
         t_cmd = ti_commands.get(start_line, None)
 
         # Find the feature end line as the line before "CP TOOLCHANGE START" comment
-        toolchange_start_comments = gcode_comments_locator(input_file_path, ["CP TOOLCHANGE START"])
-        feature_end_line = next((line - 5 for line in toolchange_start_comments.get("CP TOOLCHANGE START", []) if line > start_line), None)
+        toolchange_start_line = line_number_after(toolchange_start_comments.get(toolchange_start, []), start_line)
+        feature_end_line = toolchange_start_line - profile["offsets"]["feature_end"] if toolchange_start_line is not None else None
 
         if t_cmd is not None and feature_end_line is not None:
             feature_info = {
@@ -374,12 +431,37 @@ def feature_locator_wformat(input_file_path):
             }
             feature_info_list.append(feature_info)
 
-    # Filter the feature_info_list based on the start_line
-    filtered_feature_info_list = [info for info in feature_info_list if info["start_line"] <= first_layer_end(input_file_path)]
-    filtered_feature_info_list_2 = [info for info in filtered_feature_info_list if info["end_line"] <= first_layer_end(input_file_path)]
+    # Filter the feature_info_list to the features inside the layer
+    start_line, end_line = layer_bounds(input_file_path, layer_number)
+    if start_line is None:
+        return []
+    filtered_feature_info_list = [info for info in feature_info_list if start_line <= info["start_line"] <= end_line]
+    filtered_feature_info_list_2 = [info for info in filtered_feature_info_list if info["end_line"] <= end_line]
 
     return filtered_feature_info_list_2
 
+def find_feature_lines(feature_info_list, t_command):
+    # Find the start_line and end_line of the first feature printed with the T command
+    for feature_info in feature_info_list:
+        if feature_info["t_command"] == t_command:
+            return feature_info["start_line"], feature_info["end_line"]
+    return None, None
+
+@profiled
+def find_wipe_commands(input_file_path, start_line, end_line):
+    # Find the wipe start and end lines for each "CP TOOLCHANGE START" comment
+    wipe_start_end_lines = find_wipe_start_end(input_file_path)
+
+    # Filter the wipe start and end lines based on start_line and end_line
+    filtered_wipe_start_end_lines = filter_wipe_start_end_lines(wipe_start_end_lines, start_line, end_line)
+
+    # Identify the "T" command for each wipe start line and key the wipes by T command
+    wipe_ti_commands = wipe_identifier(input_file_path, filtered_wipe_start_end_lines)
+    filtered_wipes = {value['wipe_start']: {'wipe_end': value['wipe_end']} for value in filtered_wipe_start_end_lines.values()}
+    wipe_commands_joined = {key: {'tool': value, 'wipe_end': filtered_wipes[key]['wipe_end']} for key, value in wipe_ti_commands.items()}
+    return {value['tool']: {'wipe_start': key, 'wipe_end': value['wipe_end']} for key, value in wipe_commands_joined.items()}
+
+@profiled
 def copy_features(input_file_path, t_command1, t_command2):
     # Create a new output file name
     output_file_path = input_file_path.replace(".gcode", "_features.gcode")
@@ -394,96 +476,376 @@ def copy_features(input_file_path, t_command1, t_command2):
     feature_info_list = feature_locator_wformat(input_file_path)
 
     # Find the corresponding start_line and end_line for the first T command
-    start_line_t1 = None
-    end_line_t1 = None
-    for feature_info in feature_info_list:
-        if feature_info["t_command"] == t_command1:
-            start_line_t1 = feature_info["start_line"]
-            end_line_t1 = feature_info["end_line"]
-            break
+    start_line_t1, end_line_t1 = find_feature_lines(feature_info_list, t_command1)
 
     if start_line_t1 is None or end_line_t1 is None:
         print(f"No features found for T command '{t_command1}'.")
         return
     
     # Find the corresponding start_line and end_line for the second T command
-    start_line_t2 = None
-    end_line_t2 = None
-    for feature_info in feature_info_list:
-        if feature_info["t_command"] == t_command2:
-            start_line_t2 = feature_info["start_line"]
-            end_line_t2 = feature_info["end_line"]
-            break
+    start_line_t2, end_line_t2 = find_feature_lines(feature_info_list, t_command2)
 
     if start_line_t2 is None or end_line_t2 is None:
         print(f"No features found for T command '{t_command2}'.")
         return
     
-     # Find the wipe start and end lines for each "CP TOOLCHANGE START" comment
-    wipe_start_end_lines = find_wipe_start_end(input_file_path)
-
-    # Filter the wipe start and end lines based on start_line and end_line
-    filtered_wipe_start_end_lines = {}
-    for toolchange_line, wipe_data in wipe_start_end_lines.items():
-        wipe_start_line = wipe_data.get("wipe_start", None)
-        wipe_end_line = wipe_data.get("wipe_end", None)
-        if wipe_start_line is not None and wipe_end_line is not None:
-            if start_line <= wipe_start_line <= end_line or start_line <= wipe_end_line <= end_line:
-                filtered_wipe_start_end_lines[toolchange_line] = {"wipe_start": wipe_start_line, "wipe_end": wipe_end_line}
-
-    # Identify the "T" command for each wipe start line
-    wipe_ti_commands = wipe_identifier(input_file_path, filtered_wipe_start_end_lines)
-    filtered_wipes = {value['wipe_start']: {'wipe_end': value['wipe_end']} for value in filtered_wipe_start_end_lines.values()}
-    wipe_commands_joined = {key: {'tool': value, 'wipe_end': filtered_wipes[key]['wipe_end']} for key, value in wipe_ti_commands.items()}
-    wipe_commands = {value['tool']: {'wipe_start': key, 'wipe_end': value['wipe_end']} for key, value in wipe_commands_joined.items()}
-
-
-    # Copy the lines for the first T command to the new output file
-    with open(input_file_path, "r") as input_file, open(output_file_path, "w") as output_file:
-        lines = input_file.readlines()
-        copying_t1 = False
-        for i, line in enumerate(lines, 1):
-            if i == start_line_t1:
-                output_file.write(f"; Start of Feature {t_command1}\n")
-                copying_t1 = True
-            if copying_t1:
-                output_file.write(line)
-            if i == end_line_t1:
-                output_file.write(f"; End of Feature {t_command1}\n")
-                break
-    
-    # Copy the lines for the T command wipe to the output file (append mode)
-    with open(output_file_path, "a") as output_file:
-        output_file.write(f"\n; Start of Wipe {t_command1}\n")
-        for i, line in enumerate(lines, 1):
-            if i >= wipe_commands[t_command1]['wipe_start'] + 1:
-                output_file.write(line)
-            if i == wipe_commands[t_command1]['wipe_end'] + 1:
-                output_file.write(f"; End of Wipe {t_command1}\n")
-                break
-
-    # Copy the lines for the second T command to the output file (append mode)
-    with open(output_file_path, "a") as output_file:
-        output_file.write(f"\n; Start of Feature {t_command2}\n")
-        for i, line in enumerate(lines, 1):
-            if i >= start_line_t2:
-                output_file.write(line)
-            if i == end_line_t2:
-                output_file.write(f"; End of Feature {t_command2}\n")
-                break
-
-    # Copy the lines for the T command wipe to the output file (append mode)
-    with open(output_file_path, "a") as output_file:
-        output_file.write(f"\n; Start of Wipe {t_command2}\n")
-        for i, line in enumerate(lines, 1):
-            if i >= wipe_commands[t_command2]['wipe_start'] + 1:
-                output_file.write(line)
-            if i == wipe_commands[t_command2]['wipe_end'] + 1:
-                output_file.write(f"; End of Wipe {t_command2}\n")
-                break
+    # Find the wipe start and end lines of each T command
+    wipe_commands = find_wipe_commands(input_file_path, start_line, end_line)
+
+    # Copy the features and wipes straight from the mapped file, finding their lines in the line table
+    table = get_gcode_index(input_file_path).line_table()
+    line_count = len(table) - 1
+    with open(input_file_path, "rb") as input_file, map_gcode_file(input_file) as data, open(output_file_path, "wb") as output_file:
+        count_file_read()
+
+        def copy_lines(first_line, last_line, end_comment):
+            # Copy the lines, then the end comment if the file reaches last_line
+            lines = line_range_bytes(data, table, first_line, last_line)
+            output_file.write(lines)
+            count_file_read(opens=0, bytes_read=len(lines))
+            if 1 <= last_line <= line_count:
+                output_file.write(end_comment.encode())
+
+        # Copy the lines for the first T command (the start comment only if the feature starts before it ends)
+        if start_line_t1 <= min(end_line_t1, line_count):
+            output_file.write(f"; Start of Feature {t_command1}\n".encode())
+        copy_lines(start_line_t1, end_line_t1, f"; End of Feature {t_command1}\n")
+
+        # Copy the lines for the T command wipe
+        output_file.write(f"\n; Start of Wipe {t_command1}\n".encode())
+        copy_lines(wipe_commands[t_command1]['wipe_start'] + 1, wipe_commands[t_command1]['wipe_end'] + 1, f"; End of Wipe {t_command1}\n")
+
+        # Copy the lines for the second T command
+        output_file.write(f"\n; Start of Feature {t_command2}\n".encode())
+        copy_lines(start_line_t2, end_line_t2, f"; End of Feature {t_command2}\n")
+
+        # Copy the lines for the T command wipe
+        output_file.write(f"\n; Start of Wipe {t_command2}\n".encode())
+        copy_lines(wipe_commands[t_command2]['wipe_start'] + 1, wipe_commands[t_command2]['wipe_end'] + 1, f"; End of Wipe {t_command2}\n")
     return(output_file_path)
     #print(f"Feature lines copied successfully to '{output_file_path}'")
 
+def renumber_filament_line(line, old_number, new_number):
+    # Change the filament number of a "M620 SiA", "Ti" or "M621 SiA" line
+    line = re.sub(rb"S%dA" % old_number, b"S%dA" % new_number, line, count=1)
+    return re.sub(rb"T%d(?!\d)" % old_number, b"T%d" % new_number, line, count=1)
+
+@profiled
+def generate_swapped_gcode(input_file_path, t_command1, t_command2, patch=False):
+    # Each of the two T commands takes the place of the other one on layer 1
+    return write_exchanged_filaments(input_file_path, {t_command1: t_command2, t_command2: t_command1}, patch=patch)
+
+def layer_filament_order(input_file_path, layer_number=1):
+    # The T commands of the features of a layer, in print order
+    return [info["t_command"] for info in feature_locator_wformat(input_file_path, layer_number)]
+
+@profiled
+def generate_reordered_gcode(input_file_path, t_command_order, layer_number=1, patch=False):
+    # Print the features of a layer in the order of t_command_order, a reordering of layer_filament_order,
+    # with a single analysis and a single write of the "_swapped.gcode" file
+    if layer_bounds(input_file_path, layer_number)[0] is None:
+        print(f"No layer {layer_number} found.")
+        return
+    current_order = layer_filament_order(input_file_path, layer_number)
+    if len(set(current_order)) != len(current_order):
+        print(f"Layer {layer_number} prints a T command more than once, cannot reorder it.")
+        return
+    if sorted(t_command_order) != sorted(current_order):
+        print(f"The new order must list each T command of layer {layer_number} once: {' '.join(current_order)}.")
+        return
+
+    # The feature printed at each position is the one of the T command that now comes there
+    new_t_commands = {old: new for old, new in zip(current_order, t_command_order) if old != new}
+    return write_exchanged_filaments(input_file_path, new_t_commands, layer_number, patch)
+
+def order_swaps(current_order, t_command_order):
+    # The (t_command1, t_command2) swaps that turn current_order into t_command_order, as a plan for apply_swap_plan
+    order = list(current_order)
+    swaps = []
+    for position, t_command in enumerate(t_command_order):
+        if order[position] != t_command:
+            other_position = order.index(t_command)
+            swaps.append((order[position], t_command))
+            order[position], order[other_position] = t_command, order[position]
+    return swaps
+
+def write_exchanged_filaments(input_file_path, new_t_commands, layer_number=1, patch=False):
+    # Write the "_swapped.gcode" file, where the feature, wipe and filament swaps of every T command in
+    # new_t_commands ({old T command: new T command}, the new ones a reordering of the old ones) on the layer
+    # are those of its new T command. With patch=True only a patch of the changes is written
+    output_file_path = input_file_path.replace(".gcode", "_swapped.gcode")
+
+    # Find the first and last line of the layer
+    start_line, end_line = layer_bounds(input_file_path, layer_number)
+    if start_line is None:
+        print(f"No layer {layer_number} found.")
+        return
+
+    # Find the feature lines of every T command
+    feature_info_list = feature_locator_wformat(input_file_path, layer_number)
+    feature_lines = {}
+    for t_command in new_t_commands:
+        feature_lines[t_command] = find_feature_lines(feature_info_list, t_command)
+        if feature_lines[t_command][0] is None:
+            print(f"No features found for T command '{t_command}'.")
+            return
+
+    # Only the first feature and wipe of a T command are exchanged, while every filament swap line on the layer is
+    # renumbered, so a T command that prints more than once would leave the output inconsistent
+    for old_t_command, new_t_command in new_t_commands.items():
+        if old_t_command != new_t_command and [info["t_command"] for info in feature_info_list].count(old_t_command) > 1:
+            print(f"Layer {layer_number} prints T command '{old_t_command}' more than once, cannot swap it.")
+            return
+
+    # Find the wipe lines of every T command (stored as the line before, like in copy_features)
+    wipe_commands = find_wipe_commands(input_file_path, start_line, end_line)
+    wipe_lines = {}
+    for t_command in new_t_commands:
+        if t_command not in wipe_commands:
+            print(f"No wipe found for T command '{t_command}'.")
+            return
+        wipe_lines[t_command] = (wipe_commands[t_command]['wipe_start'] + 1, wipe_commands[t_command]['wipe_end'] + 1)
+
+    # Each feature and wipe takes the place of the old T command's: (replaced lines, copied lines)
+    exchanged_line_ranges = []
+    for old_t_command, new_t_command in new_t_commands.items():
+        exchanged_line_ranges.append((feature_lines[old_t_command], feature_lines[new_t_command]))
+        exchanged_line_ranges.append((wipe_lines[old_t_command], wipe_lines[new_t_command]))
+
+    # Find the filament swap lines on the layer whose filament number changes
+    new_numbers = {int(old_t_command[1:]): int(new_t_command[1:]) for old_t_command, new_t_command in new_t_commands.items()}
+    m620_swaps, m621_swaps, t_swaps = swap_finder(input_file_path)
+    corrected_swaps_list = swap_finder_fixer(input_file_path, m620_swaps)
+    renumbered_lines = {}
+    for swap_data in corrected_swaps_list:
+        filament_number = swap_data["filament_number"]
+        if filament_number in new_numbers:
+            swap_lines = [line for line in swap_data["start_lines"] + swap_data["middle_lines"] + swap_data["end_lines"] if line is not None]
+            for line_number in filter_output(swap_lines, start_line, end_line):
+                renumbered_lines[line_number] = (filament_number, new_numbers[filament_number])
+
+    # Map the file to turn line numbers into byte ranges
+    with open(input_file_path, "rb") as input_file, map_gcode_file(input_file) as data:
+        file_size = len(data)
+        boundary_lines = set()
+        for line_range in [line_range for pair in exchanged_line_ranges for line_range in pair] + [(line, line) for line in renumbered_lines]:
+            boundary_lines.update((line_range[0], line_range[1] + 1))
+        line_offsets = line_start_offsets(data, boundary_lines)
+        count_file_read(bytes_read=max(line_offsets.values(), default=0))
+
+        def byte_range(line_range):
+            return line_offsets[line_range[0]], line_offsets.get(line_range[1] + 1, file_size)
+
+        # Exchanged sections are copied from the source, renumbered lines are rewritten
+        replacements = []
+        for replaced_lines, copied_lines in exchanged_line_ranges:
+            replacements.append(byte_range(replaced_lines) + (byte_range(copied_lines),))
+        for line_number, (old_number, new_number) in renumbered_lines.items():
+            line_start, line_stop = byte_range((line_number, line_number))
+            replacements.append((line_start, line_stop, renumber_filament_line(data[line_start:line_stop], old_number, new_number)))
+
+    # The sections must not overlap, or the output would repeat or lose lines
+    replacements.sort(key=lambda replacement: replacement[0])
+    for previous, current in zip(replacements, replacements[1:]):
+        if current[0] < previous[1]:
+            print(f"Features and wipes of {' and '.join(repr(t_command) for t_command in new_t_commands)} overlap, cannot swap them.")
+            return
+
+    # Write the swapped file by splicing the byte ranges of the input
+    if patch:
+        return write_output_patch(input_file_path, output_file_path, file_size, replacements)
+    splice_segments(input_file_path, output_file_path, replacement_segments(file_size, replacements))
+
+    return output_file_path
+
+@profiled
+def estimate_purge_costs(input_file_path):
+    # Get the toolchange comments, T commands, line offsets and config from the index
+    index = get_gcode_index(input_file_path)
+    toolchange_start_lines = index.comments[index.profile["comments"]["toolchange_start"]]
+    toolchange_end_lines = index.comments[index.profile["comments"]["toolchange_end"]]
+
+    # Find the wipe start and end lines for each "CP TOOLCHANGE START" comment
+    wipe_start_end_lines = find_wipe_start_end(input_file_path)
+
+    # Pair every toolchange with its "CP TOOLCHANGE END" comment and the wipe that follows it.
+    # Each span runs from the start of its first marker line to the start of its last one
+    toolchanges = []
+    purge_ranges = []
+    wipe_ranges = []
+    for i, toolchange_line in enumerate(toolchange_start_lines):
+        toolchange_end_line = line_number_after(toolchange_end_lines, toolchange_line)
+        if toolchange_end_line is None:
+            continue
+
+        # The filament loaded by the toolchange is the last "Ti" command inside it
+        tool_lines = line_numbers_between(index.tool_lines, toolchange_line, toolchange_end_line)
+        filament = int(index.tool_commands[tool_lines[-1]][1:]) if tool_lines else None
+
+        # A wipe only belongs to the toolchange if it ends before the next one
+        wipe_lines = None
+        wipe_data = wipe_start_end_lines.get(toolchange_line, {})
+        next_toolchange_line = toolchange_start_lines[i + 1] if i + 1 < len(toolchange_start_lines) else None
+        purge_start, purge_end = index.line_offsets[toolchange_line], index.line_offsets[toolchange_end_line]
+        if "wipe_end" in wipe_data and (next_toolchange_line is None or wipe_data["wipe_end"] < next_toolchange_line):
+            wipe_lines = (wipe_data["wipe_start"] + 1, wipe_data["wipe_end"] + 1)
+
+            # Only the parts of the wipe outside the purge are added, the rest is already counted with it
+            wipe_start, wipe_end = index.line_offsets[wipe_lines[0]], index.line_offsets[wipe_lines[1]]
+            for start, end in [(wipe_start, min(wipe_end, purge_start)), (max(wipe_start, purge_end), wipe_end)]:
+                if start < end:
+                    wipe_ranges.append((len(toolchanges), start, end))
+
+        purge_ranges.append((purge_start, purge_end))
+        toolchanges.append({
+            "line": toolchange_line,
+            "layer": index.layer_of_line(toolchange_line),
+            "t_command": f"T{filament}" if filament is not None else None,
+            "filament": filament,
+            "purge_lines": (toolchange_line, toolchange_end_line),
+            "wipe_lines": wipe_lines
+        })
+
+    # Parse the moves of all the purges and wipes straight from the mapped file
+    costs = {field: [] for field in COST_FIELDS}
+    with open(input_file_path, "rb") as input_file:
+        data = map_gcode_file(input_file)
+        if data is not None:
+            with data:
+                byte_ranges = purge_ranges + [(start, end) for _, start, end in wipe_ranges]
+                costs = span_costs(data, byte_ranges)
+                count_file_read(bytes_read=sum(end - start for start, end in byte_ranges))
+
+    # Add the wipes to their toolchanges
+    for wipe_span, (toolchange_number, _, _) in enumerate(wipe_ranges, start=len(toolchanges)):
+        for field in COST_FIELDS:
+            costs[field][toolchange_number] += costs[field][wipe_span]
+
+    # The extruded volume depends on the diameter of the filament loaded
+    diameters = filament_diameters(index.config)
+    costs["extruded_volume"] = [length * filament_cross_section(diameters, toolchange["filament"])
+                                for length, toolchange in zip(costs["extruded_length"], toolchanges)]
+    fields = COST_FIELDS + ["extruded_volume"]
+    for toolchange, values in zip(toolchanges, zip(*(costs[field] for field in fields))):
+        toolchange.update(zip(fields, values))
+
+    # Add up the totals per filament and for the whole print
+    filament_toolchanges = {}
+    for toolchange_number, toolchange in enumerate(toolchanges):
+        filament_toolchanges.setdefault(toolchange["t_command"], []).append(toolchange_number)
+    filaments = {t_command: {field: sum(costs[field][i] for i in toolchange_numbers) for field in fields}
+                 for t_command, toolchange_numbers in filament_toolchanges.items()}
+    total = {field: sum(costs[field][:len(toolchanges)]) for field in fields}
+
+    return {"toolchanges": toolchanges, "filaments": filaments, "total": total}
+
+def write_purge_costs(output_file, purge_costs, t_commands=None):
+    # Write the purge and wipe estimate, per filament and for the whole print ('t_commands' limits the filaments)
+    output_file.write("\nPurge and Wipe Estimate (whole print):\n")
+    for t_command, costs in sorted(purge_costs["filaments"].items(), key=lambda item: str(item[0])):
+        if t_commands is None or t_command in t_commands:
+            output_file.write(f"{t_command}: {costs['moves']:.0f} moves, {costs['extruded_length']:.1f} mm filament "
+                              f"({costs['extruded_volume']:.0f} mm3), {costs['travel_distance']:.0f} mm travel, "
+                              f"{costs['duration'] / 60:.1f} min\n")
+    total = purge_costs["total"]
+    output_file.write(f"Total: {len(purge_costs['toolchanges'])} toolchanges, {total['extruded_length']:.1f} mm filament "
+                      f"({total['extruded_volume']:.0f} mm3), {total['travel_distance']:.0f} mm travel, "
+                      f"{total['duration'] / 60:.1f} min\n")
+
+@profiled
+def estimate_print_time(input_file_path, last_layer=None):
+    # Estimate the time (s) of the print up to the end of 'last_layer' (the whole file if None) with the printer's
+    # accelerations and speed limits, as {"total": seconds, "layers": [seconds of every layer up to last_layer]}.
+    # Returns None if NumPy isn't installed
+    if move_times is None:
+        print("The print time estimate needs NumPy.")
+        return None
+
+    # Only the file up to the end of the last layer is read, layer 1 is near the start
+    index = get_gcode_index(input_file_path)
+    layer_count = index.layer_count() if last_layer is None else min(last_layer, index.layer_count())
+    with open(input_file_path, "rb") as input_file:
+        data = map_gcode_file(input_file)
+        if data is None:
+            return {"total": 0.0, "layers": []}
+        with data:
+            end_offset = len(data) if last_layer is None or layer_count == 0 else index.layer_end_offsets[layer_count - 1]
+            lines, seconds = move_times(data[:end_offset], index.config)
+            count_file_read(bytes_read=end_offset)
+
+    layer_ranges = list(zip(index.layer_start_lines[:layer_count], index.layer_end_lines[:layer_count]))
+    return {"total": float(seconds.sum()), "layers": range_seconds(lines, seconds, layer_ranges)}
+
+@profiled
+def compare_print_times(input_file_path, output_file_path, last_layer=1):
+    # Estimated time (s) of layers 1 to last_layer before and after a swap or reorder, which doesn't change the
+    # layers after them: {"before": seconds, "after": seconds, "saved": seconds}. None if NumPy isn't installed
+    before = estimate_print_time(input_file_path, last_layer)
+    after = estimate_print_time(output_file_path, last_layer)
+    if before is None or after is None:
+        return None
+    before_seconds, after_seconds = sum(before["layers"]), sum(after["layers"])
+    return {"before": before_seconds, "after": after_seconds, "saved": before_seconds - after_seconds}
+
+def print_time_text(comparison, last_layer=1):
+    # One line describing a compare_print_times result
+    layers = "Layer 1" if last_layer == 1 else f"Layers 1-{last_layer}"
+    change = f"{comparison['saved']:.0f} s saved" if comparison["saved"] >= 0 else f"{-comparison['saved']:.0f} s longer"
+    return f"{layers} print time: {comparison['before'] / 60:.1f} min -> {comparison['after'] / 60:.1f} min ({change})"
+
+@profiled
+def apply_swap_plan(input_file_path, swaps):
+    # Apply (t_command1, t_command2) swaps one after another, each on the result of the one before. The swaps are
+    # composed into one new order of layer 1, so the file is analyzed and written once.
+    # The result is written to the "_swapped.gcode" file, None if a swap can't be made
+    if not swaps:
+        return None
+    t_command_order = layer_filament_order(input_file_path)
+    for t_command1, t_command2 in swaps:
+        for t_command in (t_command1, t_command2):
+            if t_command not in t_command_order:
+                print(f"No features found for T command '{t_command}'.")
+                return None
+        position1, position2 = t_command_order.index(t_command1), t_command_order.index(t_command2)
+        t_command_order[position1], t_command_order[position2] = t_command2, t_command1
+    return generate_reordered_gcode(input_file_path, t_command_order)
+
+@profiled
+def apply_patch_files(input_file_path, patch_file_paths, output_file_path=None):
+    # Write the file the patches make of the input, each applying to the result of the one before, in one pass.
+    # The output goes next to the input under the name the last patch was made for, unless output_file_path is given
+    try:
+        patches = [read_patch(patch_file_path) for patch_file_path in patch_file_paths]
+    except (OSError, ValueError) as error:
+        print(f"Cannot read the patch: {error}")
+        return None
+    if output_file_path is None:
+        output_file_path = os.path.join(os.path.dirname(input_file_path), patches[-1]["output"]["name"])
+    if os.path.abspath(output_file_path) == os.path.abspath(input_file_path):
+        print(f"The patched file would replace '{input_file_path}', give another output file.")
+        return None
+    try:
+        apply_patches(input_file_path, patches, output_file_path)
+    except ValueError as error:
+        print(f"{error}.")
+        return None
+    print(f"Patched G-code written to '{output_file_path}'.")
+    return output_file_path
+
+@profiled
+def upload_to_printer(input_file_path, patch_file_paths, host, access_code, remote_dir="/", port=None, user=FTP_USER,
+                      tls="implicit", resume=False):
+    # Stream the file the patches make of the input (the input itself without patches) to the printer's SD card,
+    # without writing it here first. Returns the path on the printer, None if the upload failed
+    try:
+        remote_path = upload_gcode(input_file_path, host, access_code, patch_file_paths, remote_dir, port, user, tls, resume)
+    except (OSError, EOFError, ValueError, ftplib.Error) as error:
+        print(f"Upload to '{host}' failed: {error}")
+        return None
+    print(f"Uploaded to '{host}:{remote_path}'.")
+    return remote_path
+
+@profiled
 def write_to_output_file_debug(output_file_path, input_file_path):
     # Find the line number for the "Start of Layer 1 gcode"
     start_line = gcode_start_locator(input_file_path)
@@ -499,10 +861,12 @@ def write_to_output_file_debug(output_file_path, input_file_path):
                         "M621"]
     command_line_numbers = gcode_command_locator(input_file_path, commands_to_find)
 
-    # Find the line numbers for the specified comments
-    comments_to_find = ["extrinsic para cali paint", 
-                        "light and wait extrude temperature",
-                        "CP TOOLCHANGE START"]
+    # Find the line numbers for the specified comments, as written by the file's slicer version
+    profile = slicer_profile(input_file_path)
+    toolchange_start = profile["comments"]["toolchange_start"]
+    comments_to_find = [profile["comments"]["calibration_start"],
+                        profile["comments"]["calibration_light"],
+                        toolchange_start]
     comment_line_numbers = gcode_comments_locator(input_file_path, comments_to_find)
 
     # Filter the output data based on start_line and end_line
@@ -519,8 +883,8 @@ def write_to_output_file_debug(output_file_path, input_file_path):
     ti_commands = feature_identifier(input_file_path)
 
     # Find the "Feature End Lines" as the line before "CP TOOLCHANGE START" comment
-    toolchange_start_comments = gcode_comments_locator(input_file_path, ["CP TOOLCHANGE START"])
-    feature_end_lines = [line - 5 for line in toolchange_start_comments.get("CP TOOLCHANGE START", [])]
+    toolchange_start_comments = gcode_comments_locator(input_file_path, [toolchange_start])
+    feature_end_lines = [line - profile["offsets"]["feature_end"] for line in toolchange_start_comments.get(toolchange_start, [])]
 
     # Filter the feature end lines based on start_line and end_line
     filtered_feature_end_lines = [line for line in feature_end_lines if start_line <= line <= end_line]
@@ -532,13 +896,7 @@ def write_to_output_file_debug(output_file_path, input_file_path):
     wipe_start_end_lines = find_wipe_start_end(input_file_path)
 
     # Filter the wipe start and end lines based on start_line and end_line
-    filtered_wipe_start_end_lines = {}
-    for toolchange_line, wipe_data in wipe_start_end_lines.items():
-        wipe_start_line = wipe_data.get("wipe_start", None)
-        wipe_end_line = wipe_data.get("wipe_end", None)
-        if wipe_start_line is not None and wipe_end_line is not None:
-            if start_line <= wipe_start_line <= end_line or start_line <= wipe_end_line <= end_line:
-                filtered_wipe_start_end_lines[toolchange_line] = {"wipe_start": wipe_start_line, "wipe_end": wipe_end_line}
+    filtered_wipe_start_end_lines = filter_wipe_start_end_lines(wipe_start_end_lines, start_line, end_line)
 
     # Identify the "T" command for each wipe start line
     wipe_ti_commands = wipe_identifier(input_file_path, filtered_wipe_start_end_lines)
@@ -605,9 +963,13 @@ def write_to_output_file_debug(output_file_path, input_file_path):
                 ti_command = wipe_ti_commands.get(wipe_start_line, None)
                 output_file.write(f"{ti_command} Wipe starts at line {wipe_start_line} and ends at line {wipe_end_line}\n")
 
+        # Write the estimated purge and wipe cost of every filament
+        write_purge_costs(output_file, estimate_purge_costs(input_file_path))
+
+@profiled
 def generate_instructions(input_file_path, t_command1, t_command2):
     # Create the output file name
-    output_file_path = input_file_path.split(".")[0] + "_instructions.txt"
+    output_file_path = os.path.splitext(input_file_path)[0] + "_instructions.txt"
 
     # Extract the numeric part from t_command1 and t_command2
     t_command1_num = int(t_command1[1:])
@@ -624,8 +986,10 @@ def generate_instructions(input_file_path, t_command1, t_command2):
     filtered_feature_start_lines = filter_output(feature_start_lines, start_line, end_line)
 
     # Find the "Feature End Lines" as the line before "CP TOOLCHANGE START" comment
-    toolchange_start_comments = gcode_comments_locator(input_file_path, ["CP TOOLCHANGE START"])
-    feature_end_lines = [line - 5 for line in toolchange_start_comments.get("CP TOOLCHANGE START", [])]
+    profile = slicer_profile(input_file_path)
+    toolchange_start = profile["comments"]["toolchange_start"]
+    toolchange_start_comments = gcode_comments_locator(input_file_path, [toolchange_start])
+    feature_end_lines = [line - profile["offsets"]["feature_end"] for line in toolchange_start_comments.get(toolchange_start, [])]
     
     # Filter the feature end lines based on start_line and end_line
     filtered_feature_end_lines = [line for line in feature_end_lines if start_line <= line <= end_line]
@@ -641,13 +1005,7 @@ def generate_instructions(input_file_path, t_command1, t_command2):
     wipe_start_end_lines = find_wipe_start_end(input_file_path)
 
     # Filter the wipe start and end lines based on start_line and end_line
-    filtered_wipe_start_end_lines = {}
-    for toolchange_line, wipe_data in wipe_start_end_lines.items():
-        wipe_start_line = wipe_data.get("wipe_start", None)
-        wipe_end_line = wipe_data.get("wipe_end", None)
-        if wipe_start_line is not None and wipe_end_line is not None:
-            if start_line <= wipe_start_line <= end_line or start_line <= wipe_end_line <= end_line:
-                filtered_wipe_start_end_lines[toolchange_line] = {"wipe_start": wipe_start_line, "wipe_end": wipe_end_line}
+    filtered_wipe_start_end_lines = filter_wipe_start_end_lines(wipe_start_end_lines, start_line, end_line)
 
     # Identify the "T" command for each wipe start line
     wipe_ti_commands = wipe_identifier(input_file_path, filtered_wipe_start_end_lines)
@@ -725,10 +1083,13 @@ def generate_instructions(input_file_path, t_command1, t_command2):
                 if ti_command and (ti_command == t_command1 or ti_command == t_command2):
                     output_file.write(f"{ti_command} Wipe starts at line {wipe_start_line} and ends at line {wipe_end_line}\n")
 
+        # Write the estimated purge and wipe cost of the selected filaments
+        write_purge_costs(output_file, estimate_purge_costs(input_file_path), [t_command1, t_command2])
 
     #print(f"Instructions written to '{output_file_path}'.")
 
-def comment_feat_wipe(input_file_path, t_command1, t_command2):
+@profiled
+def comment_feat_wipe(input_file_path, t_command1, t_command2, patch=False):
     # Create the output file name
     output_file_path = input_file_path.replace(".gcode", "_feature_comments.gcode")
 
@@ -747,8 +1108,10 @@ def comment_feat_wipe(input_file_path, t_command1, t_command2):
     filtered_feature_start_lines = filter_output(feature_start_lines, start_line, end_line)
 
     # Find the "Feature End Lines" as the line before "CP TOOLCHANGE START" comment
-    toolchange_start_comments = gcode_comments_locator(input_file_path, ["CP TOOLCHANGE START"])
-    feature_end_lines = [line - 5 for line in toolchange_start_comments.get("CP TOOLCHANGE START", [])]
+    profile = slicer_profile(input_file_path)
+    toolchange_start = profile["comments"]["toolchange_start"]
+    toolchange_start_comments = gcode_comments_locator(input_file_path, [toolchange_start])
+    feature_end_lines = [line - profile["offsets"]["feature_end"] for line in toolchange_start_comments.get(toolchange_start, [])]
     
     # Filter the feature end lines based on start_line and end_line
     filtered_feature_end_lines = [line for line in feature_end_lines if start_line <= line <= end_line]
@@ -764,13 +1127,7 @@ def comment_feat_wipe(input_file_path, t_command1, t_command2):
     wipe_start_end_lines = find_wipe_start_end(input_file_path)
 
     # Filter the wipe start and end lines based on start_line and end_line
-    filtered_wipe_start_end_lines = {}
-    for toolchange_line, wipe_data in wipe_start_end_lines.items():
-        wipe_start_line = wipe_data.get("wipe_start", None)
-        wipe_end_line = wipe_data.get("wipe_end", None)
-        if wipe_start_line is not None and wipe_end_line is not None:
-            if start_line <= wipe_start_line <= end_line or start_line <= wipe_end_line <= end_line:
-                filtered_wipe_start_end_lines[toolchange_line] = {"wipe_start": wipe_start_line, "wipe_end": wipe_end_line}
+    filtered_wipe_start_end_lines = filter_wipe_start_end_lines(wipe_start_end_lines, start_line, end_line)
    
     # Identify the "T" command for each wipe start line
     wipe_ti_commands = wipe_identifier(input_file_path, filtered_wipe_start_end_lines)
@@ -811,50 +1168,63 @@ def comment_feat_wipe(input_file_path, t_command1, t_command2):
                 if ti_command and (ti_command == t_command1):
                     t_command1_wipe_lines.append((wipe_start_line, wipe_end_line))
 
-    # Read the content of the input gcode file
-    with open(input_file_path, "r") as input_file:
-        gcode_content = input_file.readlines()
-
-    # Add the comments
-        first_line = t_command1_feature_lines[0][0]
-        gcode_content[first_line - 1] = gcode_content[first_line - 1].rstrip() + f"; T{t_command1_num} FEATURE START\n"
-
-        second_line = t_command1_feature_lines[0][1]
-        gcode_content[second_line - 1] = gcode_content[second_line - 1].rstrip() + f"; T{t_command1_num} FEATURE END\n"
-
-        first_line_2 = t_command2_feature_lines[0][0]
-        gcode_content[first_line_2 - 1] = gcode_content[first_line_2 - 1].rstrip() + f"; T{t_command2_num} FEATURE START\n"
-
-        second_line_2 = t_command2_feature_lines[0][1]
-        gcode_content[second_line_2 - 1] = gcode_content[second_line_2 - 1].rstrip() + f"; T{t_command2_num} FEATURE END\n"
-    
-        first_line_wipe1 = t_command1_wipe_lines[0][0]
-        gcode_content[first_line_wipe1] = gcode_content[first_line_wipe1].rstrip() + f"; T{t_command1_num} FEATURE WIPE START\n"
-
-        second_line_wipe1 = t_command1_wipe_lines[0][1]
-        gcode_content[second_line_wipe1] = gcode_content[second_line_wipe1].rstrip() + f"; T{t_command1_num} FEATURE WIPE END\n"
-
-        first_line_wipe2 = t_command2_wipe_lines[0][0]
-        gcode_content[first_line_wipe2] = gcode_content[first_line_wipe2].rstrip() + f"; T{t_command2_num} FEATURE WIPE START\n"
-
-        second_line_wipe2 = t_command2_wipe_lines[0][1]
-        gcode_content[second_line_wipe2] = gcode_content[second_line_wipe2].rstrip() + f"; T{t_command2_num} FEATURE WIPE END\n"
-
-    # Write the updated content to the output file
-    with open(output_file_path, "w") as output_file:
-        output_file.writelines(gcode_content)
+    # The comments to add at the end of lines, in order (as indexes into the lines, counting from 0)
+    line_comments = [
+        (t_command1_feature_lines[0][0] - 1, f"; T{t_command1_num} FEATURE START"),
+        (t_command1_feature_lines[0][1] - 1, f"; T{t_command1_num} FEATURE END"),
+        (t_command2_feature_lines[0][0] - 1, f"; T{t_command2_num} FEATURE START"),
+        (t_command2_feature_lines[0][1] - 1, f"; T{t_command2_num} FEATURE END"),
+        (t_command1_wipe_lines[0][0], f"; T{t_command1_num} FEATURE WIPE START"),
+        (t_command1_wipe_lines[0][1], f"; T{t_command1_num} FEATURE WIPE END"),
+        (t_command2_wipe_lines[0][0], f"; T{t_command2_num} FEATURE WIPE START"),
+        (t_command2_wipe_lines[0][1], f"; T{t_command2_num} FEATURE WIPE END")
+    ]
+
+    # Read only the lines to comment, using the line table
+    table = get_gcode_index(input_file_path).line_table()
+    line_count = len(table) - 1
+    commented_lines = {}
+    with open(input_file_path, "rb") as input_file, map_gcode_file(input_file) as data:
+        count_file_read()
+        for line_index, comment in line_comments:
+            if not 0 <= line_index < line_count:
+                raise IndexError(f"Line {line_index + 1} is past the end of '{input_file_path}'")
+            if line_index not in commented_lines:
+                commented_lines[line_index] = data[table[line_index]:table[line_index + 1]].decode("utf-8", "surrogateescape")
+            commented_lines[line_index] = commented_lines[line_index].rstrip() + comment + "\n"
+
+    # Copy the file to the output, replacing only the commented lines
+    replacements = [(table[line_index], table[line_index + 1], commented_lines[line_index].encode("utf-8", "surrogateescape"))
+                    for line_index in sorted(commented_lines)]
+    if patch:
+        patch_file_path = write_output_patch(input_file_path, output_file_path, table[-1], replacements)
+        print(f"Commented Gcode patch written to '{patch_file_path}'.")
+        return
+    splice_segments(input_file_path, output_file_path, replacement_segments(table[-1], replacements))
 
     print(f"Commented Gcode written to '{output_file_path}'.")
 
+@profiled
 def get_gcode_commands_from_lines(input_file_path, line_numbers):
     gcode_commands = []
 
-    with open(input_file_path, "r") as input_file:
-        lines = input_file.readlines()
+    # Command lines recorded by the index don't need the file at all
+    index = get_gcode_index(input_file_path)
+    wanted_lines = {line_number for line_number in line_numbers
+                    if 1 <= line_number <= index.line_count and line_number not in index.command_text}
+
+    # Read only the remaining requested lines from the file, finding them in the line table
+    lines = {}
+    if wanted_lines:
+        table = index.line_table()
+        with open(input_file_path, "rb") as input_file, map_gcode_file(input_file) as data:
+            count_file_read()
+            for line_number in wanted_lines:
+                lines[line_number] = data[table[line_number - 1]:table[line_number]].decode("utf-8", "replace").strip()
 
     for line_number in line_numbers:
-        if 1 <= line_number <= len(lines):
-            line = lines[line_number - 1].strip()  # Adjust index to 0-based
+        if 1 <= line_number <= index.line_count:
+            line = index.command_text.get(line_number, lines.get(line_number))
             if line.startswith(";"):
                 # Skip comments or other non-G-code lines
                 continue
@@ -862,14 +1232,16 @@ def get_gcode_commands_from_lines(input_file_path, line_numbers):
 
     return gcode_commands
 
-def get_t_commands(input_file_path):
+@profiled
+def get_t_commands(input_file_path, layer_number=1):
     # Find the line numbers for the filament swaps "M620 SiA", "M621 SiA", and "T0-T7"
     m620_swaps, m621_swaps, t_swaps = swap_finder(input_file_path)
     # Fix the filament numbers and get the corrected swaps list
     corrected_swaps_list = swap_finder_fixer(input_file_path, m620_swaps)
     #print(corrected_swaps_list)
-    start_line = gcode_start_locator(input_file_path)
-    end_line = first_layer_end(input_file_path)
+    start_line, end_line = layer_bounds(input_file_path, layer_number)
+    if start_line is None:
+        return []
     
     start_line_numbers = []
     middle_line_numbers = []
@@ -892,26 +1264,236 @@ def get_t_commands(input_file_path):
     
     return (t_commands)
 
+@profiled
+def get_layer_filament_sequences(input_file_path):
+    # List the filaments each layer prints, in order. A layer starts with the filament left loaded
+    # by the previous one if it prints a feature before its first toolchange
+    index = get_gcode_index(input_file_path)
+    feature_lines = index.comments[index.profile["comments"]["feature"]]
+    toolchange_start_lines = index.comments[index.profile["comments"]["toolchange_start"]]
+
+    layer_sequences = []
+    loaded_filament = None
+    for layer_number in range(1, index.layer_count() + 1):
+        start_line, end_line = index.layer_bounds(layer_number)
+        sequence = [int(index.tool_commands[line][1:]) for line in index.layer_tool_lines(layer_number)]
+
+        if loaded_filament is not None:
+            first_toolchange = line_number_after(toolchange_start_lines, start_line - 1)
+            if first_toolchange is None or first_toolchange > end_line:
+                first_toolchange = end_line + 1
+            first_feature = line_number_after(feature_lines, start_line - 1)
+            if first_feature is not None and first_feature < first_toolchange:
+                sequence.insert(0, loaded_filament)
+
+        layer_sequences.append(sequence)
+        if sequence:
+            loaded_filament = sequence[-1]
+
+    return layer_sequences
+
+@profiled
+def optimize_filament_order(input_file_path):
+    # Create the output file name
+    output_file_path = input_file_path.replace(".gcode", "_filament_plan.txt")
+
+    # Find the filament order of every layer that needs the least flushing
+    layer_sequences = get_layer_filament_sequences(input_file_path)
+    try:
+        plan = filament_plan(layer_sequences, get_gcode_index(input_file_path).config)
+    except ValueError as error:
+        print(f"Cannot optimize the filament order: {error}")
+        return None
+
+    # Write the plan to the output file
+    with open(output_file_path, "w") as output_file:
+        output_file.write("Optimized filament order\n")
+        output_file.write(f"\nToolchanges: {plan['current_toolchanges']} -> {plan['optimized_toolchanges']}\n")
+        output_file.write(f"Flush volume: {plan['current_flush_volume']:.0f} mm3 -> {plan['optimized_flush_volume']:.0f} mm3\n")
+        output_file.write(f"Estimated savings: {plan['grams_saved']:.1f} g, {plan['minutes_saved']:.1f} min\n")
+
+        output_file.write("\nLayer 1 swaps (apply one after another with Generate Swap, the first and last filament can't be swapped yet):\n")
+        for t_command1, t_command2 in plan["first_layer_swaps"]:
+            output_file.write(f"{t_command1} <-> {t_command2}\n")
+
+        output_file.write("\nLayers:\n")
+        for layer in plan["layers"]:
+            if layer["current_order"] != layer["optimized_order"]:
+                output_file.write(f"Layer {layer['layer']}: {' '.join(layer['current_order'])} -> {' '.join(layer['optimized_order'])}\n")
+
+    return plan
+
+def run_with_progress(function, *args, progress=None):
+    # Call function(*args) with progress(phase, done, total) called as files are scanned, hashed and written.
+    # Raising progress.AnalysisCancelled from the callback stops the work
+    previous_progress = get_progress_callback()
+    set_progress_callback(progress)
+    try:
+        return function(*args)
+    finally:
+        set_progress_callback(previous_progress)
+
 if __name__ == "__main__":
+    import argparse
+    import json
     import sys
     sys.path.append(".")
 
-    # File paths
-    if len(sys.argv) > 1:
-        input_file_path = sys.argv[1]
-    else:
-        input_file_path = "example.gcode"
-
-    t_commands = get_t_commands(input_file_path)
+    parser = argparse.ArgumentParser(
+        usage="main.py | main.py input_file_path(.gcode or .gcode.3mf) [t_command1 t_command2 | calibration_off]\n"
+              "       main.py input_file_path.gcode --order T1 T2 ... [--layer N]\n"
+              "       main.py input_file_path.gcode --apply patch.gcpatch [...] [--output output.gcode]\n"
+              "       main.py input_file_path.gcode [t_command1 t_command2 | calibration_off | --order ... | --apply ...] --upload HOST --access-code CODE\n"
+              "       main.py --batch file_or_directory_or_glob [...] [--swap T1 T2]... [--calibration-off] [--workers N] [--summary summary.json]",
+        description="Without arguments the GUI is started.")
+    parser.add_argument("arguments", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("--batch", action="store_true", help="process every file, directory (its .gcode files) or glob given, in parallel")
+    parser.add_argument("--swap", nargs=2, action="append", default=[], metavar=("T1", "T2"),
+                        help="swap two filaments on layer 1, repeat to apply a swap plan in order (batch mode)")
+    parser.add_argument("--order", nargs="+", metavar="T",
+                        help="print the features of the layer in this order of T commands, in one pass")
+    parser.add_argument("--layer", type=int, default=1, help="layer reordered by --order (default: 1)")
+    parser.add_argument("--patch", action="store_true",
+                        help=f"write a patch of the changes ({PATCH_SUFFIX}) instead of the swapped, reordered or "
+                             f"calibration off G-code file (.gcode files)")
+    parser.add_argument("--apply", nargs="+", metavar="PATCH",
+                        help="write the file the patches make of the input, each applying to the result of the one before")
+    parser.add_argument("--output", help="file written by --apply (default: the name the last patch was made for)")
+    parser.add_argument("--upload", metavar="HOST",
+                        help="send the swapped, reordered, calibration off or patched file (or the input as it is) "
+                             "straight to the printer's SD card over FTPS, without writing it here (.gcode files)")
+    parser.add_argument("--access-code", default=os.environ.get("AMS_SWAPPER_ACCESS_CODE"),
+                        help="the printer's access code (default: AMS_SWAPPER_ACCESS_CODE)")
+    parser.add_argument("--remote-dir", default="/", help="directory on the printer (default: /)")
+    parser.add_argument("--ftp-port", type=int, help="FTP port (default: 990 for implicit FTPS, 21 otherwise)")
+    parser.add_argument("--ftp-user", default=FTP_USER, help=f"FTP user (default: {FTP_USER})")
+    parser.add_argument("--ftp-tls", choices=TLS_MODES, default="implicit",
+                        help="implicit FTPS (the printers), explicit FTPS (AUTH TLS) or plain FTP (default: implicit)")
+    parser.add_argument("--resume", action="store_true", help="continue an upload from where the printer's copy of the file ends")
+    parser.add_argument("--calibration-off", action="store_true", help="comment out the calibration (batch mode)")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes, one per CPU by default (batch mode and .gcode.3mf plates)")
+    parser.add_argument("--summary", help="write the JSON summary to this file instead of the console (batch mode)")
+    parser.add_argument("--profile", action="store_true",
+                        help="record the time, file reads and lines scanned of every step, written next to each input "
+                             "as _profile.json and as a Chrome/Perfetto trace (_trace.json)")
+    args = parser.parse_args()
+
+    # An upload sends the output straight from the input and a patch of the changes, so only the patch is written
+    if args.upload:
+        if args.access_code is None:
+            parser.error("--upload needs --access-code (or AMS_SWAPPER_ACCESS_CODE)")
+        args.patch = True
+
+    if args.batch:
+        import batch
+        input_file_paths = batch.expand_inputs(args.arguments)
+        if not input_file_paths:
+            parser.error("no .gcode files found")
+        if not args.swap and not args.calibration_off:
+            print("No --swap or --calibration-off given, only analyzing the files.", file=sys.stderr)
+
+        summary = batch.run_batch(input_file_paths, [tuple(swap) for swap in args.swap], args.calibration_off, args.workers,
+                                  args.profile)
+        if args.summary:
+            with open(args.summary, "w") as summary_file:
+                json.dump(summary, summary_file, indent=2)
+        else:
+            print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary["failed"] else 0)
+
+    # With the analysis daemon running (analysis_daemon.py), the work is done there, on the files it keeps in
+    # memory. It runs in its own directory, so it is given absolute paths. Profiling runs here, to profile the work
+    import analysis_daemon
+    use_daemon = len(args.arguments) > 0 and not args.profile and analysis_daemon.daemon_running()
+    resolve = os.path.abspath if use_daemon else lambda file_path: file_path
+
+    def run(name, *call_args):
+        if use_daemon:
+            return analysis_daemon.call(name, *call_args)
+        return analysis_daemon.run_local(name, *call_args)
+
+    def report_print_time(input_file_path, output_file_path, layer_number=1):
+        # How the swap or reorder changes the estimated print time of the layers up to the one it changed
+        # (a patch has no G-code to estimate)
+        if output_file_path is not None and not args.patch:
+            comparison = run("compare_print_times", input_file_path, output_file_path, layer_number)
+            if comparison is not None:
+                print(print_time_text(comparison, layer_number))
+
+    def upload(input_file_path, patch_file_paths):
+        return run("upload_to_printer", input_file_path, patch_file_paths, args.upload, args.access_code, args.remote_dir,
+                   args.ftp_port, args.ftp_user, args.ftp_tls, args.resume)
+
+    def upload_result(input_file_path, patch_file_path):
+        # With --upload, send the output of a swap, reorder or calibration off (written as a patch) to the printer
+        if args.upload and patch_file_path is not None:
+            upload(input_file_path, [patch_file_path])
+
+    def swap_files(input_file_path, t_command1, t_command2):
+        run("copy_features", input_file_path, t_command1, t_command2)
+        run("generate_instructions", input_file_path, t_command1, t_command2)
+        output_file_path = run("generate_swapped_gcode", input_file_path, t_command1, t_command2, args.patch)
+        report_print_time(input_file_path, output_file_path)
+        upload_result(input_file_path, output_file_path)
+
+    def reorder_file(input_file_path, t_command_order, layer_number):
+        output_file_path = run("generate_reordered_gcode", input_file_path, t_command_order, layer_number, args.patch)
+        report_print_time(input_file_path, output_file_path, layer_number)
+        upload_result(input_file_path, output_file_path)
 
     # Run the GUI or command-line operations based on the number of arguments
-    if len(sys.argv) == 1:
+    if len(args.arguments) == 0:
         import gui
-    elif len(sys.argv) == 3:
-        t_command1, t_command2 = sys.argv[1], sys.argv[2]
-        copy_features(input_file_path, t_command1, t_command2)
-        generate_instructions(input_file_path, t_command1, t_command2)
-    elif len(sys.argv) == 2 and sys.argv[1] == "calibration_off":
-        modify_gcode_cal(input_file_path)
+        sys.exit()
+
+    # Bambu Studio project archives: the plates are read from and written back to the archive
+    import gcode_3mf
+    if gcode_3mf.is_archive(args.arguments[0]):
+        archive_path = resolve(args.arguments[0])
+        if args.patch or args.apply:
+            parser.error("--patch, --apply and --upload only work on .gcode files")
+        if len(args.arguments) == 1 and args.order:
+            if args.layer != 1:
+                parser.error("--layer only works on .gcode files")
+            summary = run("reorder_first_plate", archive_path, args.order)
+        elif len(args.arguments) == 1:
+            for member, t_commands in run("archive_t_commands", archive_path).items():
+                print(f"{member}: {' '.join(t_commands)}")
+            sys.exit()
+        elif len(args.arguments) == 2 and args.arguments[1] == "calibration_off":
+            summary = run("process_archive", archive_path, [], True, args.workers)
+        elif len(args.arguments) == 3:
+            summary = run("process_archive", archive_path, [tuple(args.arguments[1:])], False, args.workers)
+        else:
+            parser.error("invalid arguments")
+        for failure in summary["failures"]:
+            print(f"Failed: {failure}", file=sys.stderr)
+        if summary["output"] is not None:
+            print(f"Output archive written to '{summary['output']}'.")
+        sys.exit(1 if summary["failures"] else 0)
+    elif len(args.arguments) == 1 and args.apply:
+        patch_file_paths = [resolve(patch_file_path) for patch_file_path in args.apply]
+        output_file_path = resolve(args.output) if args.output else None
+        if args.upload:
+            operation = lambda input_file_path: upload(input_file_path, patch_file_paths)
+        else:
+            operation = lambda input_file_path: run("apply_patch_files", input_file_path, patch_file_paths, output_file_path)
+    elif len(args.arguments) == 1 and args.order:
+        operation = lambda input_file_path: reorder_file(input_file_path, args.order, args.layer)
+    elif len(args.arguments) == 1 and args.upload:
+        operation = lambda input_file_path: upload(input_file_path, [])
+    elif len(args.arguments) == 1:
+        operation = lambda input_file_path: print(" ".join(run("get_t_commands", input_file_path)))
+    elif len(args.arguments) == 2 and args.arguments[1] == "calibration_off":
+        operation = lambda input_file_path: upload_result(input_file_path, run("calibration_off", input_file_path, args.patch))
+    elif len(args.arguments) == 3:
+        operation = lambda input_file_path: swap_files(input_file_path, *args.arguments[1:])
+    else:
+        parser.error("invalid arguments")
+
+    input_file_path = resolve(args.arguments[0])
+    if args.profile:
+        run_profiled(input_file_path, operation, input_file_path)
+        print("Profile written to '{}' and '{}'.".format(*profile_paths(input_file_path)), file=sys.stderr)
     else:
-        print("Invalid arguments. Usage: main.py [input_file_path] | [t_command1] [t_command2] | calibration_off")
+        operation(input_file_path)
@@ -0,0 +1,228 @@
+import numpy as np
+from filament_optimizer import config_floats
+from gcode_tokens import tokenize
+from profiler import profiled
+from purge_estimator import DEFAULT_FEEDRATE
+
+# Print time estimate with acceleration: every move speeds up from the speed it enters at, cruises and slows down
+# to the speed it leaves at (a trapezoid), within the printer's limits. The limits are read from the M201, M203,
+# M204 and M205 commands, or from the config block until the first of them. All the moves are computed at once
+# on arrays, so it needs NumPy.
+
+AXES = "XYZE"
+
+# Limits used when neither the commands nor the config block set them: maximum acceleration (mm/s2, M201),
+# maximum speed (mm/s, M203) and jerk (mm/s, M205) of every axis
+DEFAULT_MAX_ACCELERATION = {"X": 20000.0, "Y": 20000.0, "Z": 500.0, "E": 5000.0}
+DEFAULT_MAX_SPEED = {"X": 500.0, "Y": 500.0, "Z": 20.0, "E": 30.0}
+DEFAULT_JERK = {"X": 9.0, "Y": 9.0, "Z": 3.0, "E": 2.5}
+
+# Acceleration of printing, retraction and travel moves (mm/s2, M204 P, R and T)
+DEFAULT_ACCELERATION = {"P": 10000.0, "R": 5000.0, "T": 10000.0}
+
+# Config block settings of each limit. The first value is the one of the normal mode
+CONFIG_MAX_ACCELERATION = "machine_max_acceleration_{}"
+CONFIG_MAX_SPEED = "machine_max_speed_{}"
+CONFIG_JERK = "machine_max_jerk_{}"
+CONFIG_ACCELERATION = {"P": "machine_max_acceleration_extruding", "R": "machine_max_acceleration_retracting",
+                       "T": "machine_max_acceleration_travel"}
+
+# Commands the estimate follows. G2/G3 are arcs (with I and J centers), G4 waits (P ms or S s), G28 homes to 0,
+# G92 sets the position without moving, G90/G91 and M82/M83 switch between absolute and relative positions
+MOVE_COMMANDS = ["G0", "G1", "G2", "G3"]
+STATE_COMMANDS = ["G4", "G28", "G90", "G91", "G92", "M82", "M83", "M201", "M203", "M204", "M205"]
+WORD_LETTERS = "XYZEFIJPRST"
+
+# Moves shorter than this (mm) don't move
+MIN_DISTANCE = 1e-9
+
+
+def config_limit(config, setting, default):
+    # The first value of a config setting, or the default if it is missing or not positive
+    values = config_floats(config, setting)
+    return values[0] if values and values[0] > 0 else default
+
+
+def printer_limits(config):
+    # The limits the print starts with: {"max_acceleration": {axis: ...}, "max_speed": ..., "jerk": ...,
+    # "acceleration": {"P": ..., "R": ..., "T": ...}}
+    return {
+        "max_acceleration": {axis: config_limit(config, CONFIG_MAX_ACCELERATION.format(axis.lower()), value)
+                             for axis, value in DEFAULT_MAX_ACCELERATION.items()},
+        "max_speed": {axis: config_limit(config, CONFIG_MAX_SPEED.format(axis.lower()), value)
+                      for axis, value in DEFAULT_MAX_SPEED.items()},
+        "jerk": {axis: config_limit(config, CONFIG_JERK.format(axis.lower()), value)
+                 for axis, value in DEFAULT_JERK.items()},
+        "acceleration": {mode: config_limit(config, CONFIG_ACCELERATION[mode], value)
+                         for mode, value in DEFAULT_ACCELERATION.items()},
+    }
+
+
+def carry(values, known, initial):
+    # Carry each known value forward over the following entries (G-code settings are modal), 'initial' before the
+    # first known one
+    positions = np.flatnonzero(known)
+    segment_values = np.concatenate(([initial], values[positions]))
+    return np.repeat(segment_values, np.diff(positions, prepend=0, append=len(values)))
+
+
+def axis_positions(values, sets, relative):
+    # Position of an axis after every command: 'values' are the words of the axis (NaN where missing), 'sets'
+    # marks the commands setting the position to their word and 'relative' the moves adding their word to it
+    deltas = np.where(relative & ~np.isnan(values), values, 0.0)
+    cumulative = np.cumsum(deltas)
+    # Each position set becomes the base of the relative moves after it
+    bases = carry(values - cumulative, sets & ~np.isnan(values), 0.0)
+    return bases + cumulative
+
+
+def arc_lengths(start_x, start_y, end_x, end_y, center_i, center_j, clockwise):
+    # Length in the XY plane of G2 (clockwise) and G3 arcs around the center start + (I, J)
+    center_x = start_x + np.nan_to_num(center_i)
+    center_y = start_y + np.nan_to_num(center_j)
+    radius = np.hypot(start_x - center_x, start_y - center_y)
+    start_angle = np.arctan2(start_y - center_y, start_x - center_x)
+    end_angle = np.arctan2(end_y - center_y, end_x - center_x)
+    sweep = np.where(clockwise, start_angle - end_angle, end_angle - start_angle) % (2 * np.pi)
+    # An arc ending where it starts is a full circle
+    sweep = np.where(sweep < 1e-9, 2 * np.pi, sweep)
+    return radius * sweep
+
+
+def reachable_squared_speeds(caps, gains):
+    # Lower the squared junction speeds 'caps' (one more than the moves) so every move can get from its entry to
+    # its exit speed: speeds go up or down by at most gains = 2 * acceleration * distance over a move. Both passes
+    # of a motion planner are running minimums over the prefix sums of the gains:
+    # going back, w[k] = min(caps[j] + S[j] for j >= k) - S[k], going forward, w[k] = S[k] + min(w[j] - S[j] for j <= k)
+    sums = np.concatenate(([0.0], np.cumsum(gains)))
+    squared = np.minimum.accumulate((caps + sums)[::-1])[::-1] - sums
+    squared = np.minimum.accumulate(squared - sums) + sums
+    return np.maximum(squared, 0.0)
+
+
+def trapezoid_times(distance, entry_speed, exit_speed, cruise_speed, acceleration):
+    # Time of moves that accelerate from their entry speed to their cruise speed, and decelerate to their exit
+    # speed. Moves too short to reach the cruise speed peak in between
+    accelerating = (cruise_speed ** 2 - entry_speed ** 2) / (2 * acceleration)
+    decelerating = (cruise_speed ** 2 - exit_speed ** 2) / (2 * acceleration)
+    cruising = distance - accelerating - decelerating
+    peak_speed = np.minimum(np.sqrt((2 * acceleration * distance + entry_speed ** 2 + exit_speed ** 2) / 2), cruise_speed)
+    return np.where(cruising >= 0,
+                    (2 * cruise_speed - entry_speed - exit_speed) / acceleration + np.maximum(cruising, 0) / cruise_speed,
+                    (2 * peak_speed - entry_speed - exit_speed) / acceleration)
+
+
+@profiled
+def move_times(data, config):
+    # Estimated time (s) of the moves and waits of a buffer of G-code, as arrays of line numbers (1-based) and
+    # seconds. The print starts at rest at 0, 0, 0
+    tokens = tokenize(data)
+    masks = {command: tokens.command_mask(command) for command in MOVE_COMMANDS + STATE_COMMANDS}
+    selected = np.zeros(tokens.line_count, dtype=bool)
+    for mask in masks.values():
+        selected |= mask
+    lines = np.flatnonzero(selected) + 1
+    words = tokens.word_columns(WORD_LETTERS, selected)
+    commands = {command: mask[selected] for command, mask in masks.items()}
+    has_word = {letter: ~np.isnan(values) for letter, values in words.items()}
+
+    is_move = commands["G0"] | commands["G1"] | commands["G2"] | commands["G3"]
+    is_arc = commands["G2"] | commands["G3"]
+
+    # Absolute or relative positions: G90/G91 switch every axis, M82/M83 only E (the last command wins)
+    mode_set = commands["G90"] | commands["G91"]
+    relative = carry(commands["G91"], mode_set, False)
+    relative_e = carry(commands["G91"] | commands["M83"], mode_set | commands["M82"] | commands["M83"], False)
+
+    # Homing without axis words homes them all
+    homes_all = commands["G28"] & ~(has_word["X"] | has_word["Y"] | has_word["Z"])
+    positions = {}
+    for axis in AXES:
+        axis_relative = relative_e if axis == "E" else relative
+        values = words[axis].copy()
+        homed = commands["G28"] & (has_word[axis] | (homes_all if axis != "E" else False))
+        values[homed] = 0.0
+        sets = (is_move & ~axis_relative) | commands["G92"] | homed
+        positions[axis] = axis_positions(values, sets, is_move & axis_relative)
+
+    # Every command moves from where the one before ended
+    deltas = {axis: np.diff(positions[axis], prepend=0.0) for axis in AXES}
+    for axis in AXES:
+        deltas[axis][~is_move] = 0.0
+    xy_distance = np.hypot(deltas["X"], deltas["Y"])
+    if is_arc.any():
+        start_x, start_y = positions["X"] - deltas["X"], positions["Y"] - deltas["Y"]
+        arc_xy = arc_lengths(start_x, start_y, positions["X"], positions["Y"], words["I"], words["J"], commands["G2"])
+        xy_distance = np.where(is_arc, arc_xy, xy_distance)
+    distance = np.hypot(xy_distance, deltas["Z"])
+
+    # Moves without XYZ motion are as long as their extrusion or retraction
+    extruder_only = distance <= MIN_DISTANCE
+    distance = np.where(extruder_only, np.abs(deltas["E"]), distance)
+
+    # Modal settings: feedrate, acceleration per kind of move and the limits of every axis
+    feedrate = carry(words["F"], is_move & has_word["F"], DEFAULT_FEEDRATE) / 60
+    limits = printer_limits(config)
+    acceleration = {}
+    for mode in "PRT":
+        # "M204 S" sets the printing and travel accelerations
+        values = words[mode] if mode == "R" else np.where(has_word[mode], words[mode], words["S"])
+        acceleration[mode] = carry(values, commands["M204"] & ~np.isnan(values), limits["acceleration"][mode])
+    axis_limits = {}
+    for command, limit in (("M201", "max_acceleration"), ("M203", "max_speed"), ("M205", "jerk")):
+        axis_limits[limit] = {axis: carry(words[axis], commands[command] & has_word[axis], limits[limit][axis])
+                              for axis in AXES}
+
+    # Waits: "G4 P" in milliseconds, "G4 S" in seconds
+    waits = commands["G4"]
+    wait_lines = lines[waits]
+    wait_seconds = np.where(has_word["P"][waits], words["P"][waits] / 1000, np.nan_to_num(words["S"][waits]))
+
+    # Only the moves that move take time, the rest are dropped from here on
+    moving = is_move & (distance > MIN_DISTANCE)
+    move_lines = lines[moving]
+    if len(move_lines) == 0:
+        return wait_lines, wait_seconds
+    distance = distance[moving]
+    directions = {axis: np.abs(deltas[axis][moving]) / distance for axis in AXES}
+    directions["E"] = np.where(extruder_only[moving], 1.0, directions["E"])
+    signed_directions = {axis: np.sign(deltas[axis][moving]) * directions[axis] for axis in AXES}
+    extruding = deltas["E"][moving] > 0
+    retracting = extruder_only[moving]  # retractions and the moves undoing them
+
+    # Cruise speed and acceleration within the limits of every axis the move uses
+    cruise_speed = feedrate[moving]
+    move_acceleration = np.where(retracting, acceleration["R"][moving],
+                                 np.where(extruding, acceleration["P"][moving], acceleration["T"][moving]))
+    with np.errstate(divide="ignore"):
+        for axis in AXES:
+            cruise_speed = np.minimum(cruise_speed, axis_limits["max_speed"][axis][moving] / directions[axis])
+            move_acceleration = np.minimum(move_acceleration, axis_limits["max_acceleration"][axis][moving] / directions[axis])
+    cruise_speed = np.maximum(cruise_speed, MIN_DISTANCE)
+    move_acceleration = np.maximum(move_acceleration, MIN_DISTANCE)
+
+    # Junction speeds: at most the slower of the two moves, lowered until no axis changes speed by more than its
+    # jerk. The print starts and ends at rest, and so does every wait
+    junction_speed = np.minimum(cruise_speed[:-1], cruise_speed[1:])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for axis in AXES:
+            change = np.abs(signed_directions[axis][1:] - signed_directions[axis][:-1]) * junction_speed
+            jerk = axis_limits["jerk"][axis][moving][1:]
+            junction_speed = np.where(change > jerk, junction_speed * jerk / change, junction_speed)
+    waits_between = np.diff(np.searchsorted(wait_lines, move_lines)) > 0
+    junction_speed[waits_between] = 0.0
+    caps = np.concatenate(([0.0], junction_speed, [0.0])) ** 2
+    speeds = np.sqrt(reachable_squared_speeds(caps, 2 * move_acceleration * distance))
+
+    seconds = trapezoid_times(distance, speeds[:-1], speeds[1:], cruise_speed, move_acceleration)
+
+    timed_lines = np.concatenate((move_lines, wait_lines))
+    order = np.argsort(timed_lines, kind="stable")
+    return timed_lines[order], np.concatenate((seconds, wait_seconds))[order]
+
+
+def range_seconds(lines, seconds, line_ranges):
+    # Add up the seconds of the lines inside every (first line, last line) range
+    totals = np.concatenate(([0.0], np.cumsum(seconds)))
+    first_lines, last_lines = np.array(line_ranges, dtype=np.int64).reshape(-1, 2).T
+    return (totals[np.searchsorted(lines, last_lines, side="right")] - totals[np.searchsorted(lines, first_lines)]).tolist()
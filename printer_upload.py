@@ -0,0 +1,188 @@
+import ftplib
+import os
+import queue
+import ssl
+import threading
+from gcode_patch import patched_segments, read_patch
+from gcode_writer import iter_segment_blocks, segments_size
+from progress import report_progress
+
+# Bambu Lab printers take files on their SD card over implicit FTPS, as user "bblp" with the printer's access code
+FTPS_PORT = 990
+FTP_PORT = 21
+FTP_USER = "bblp"
+TLS_MODES = ["implicit", "explicit", "none"]
+
+# Blocks are read this far ahead of the upload, so at most UPLOAD_QUEUE_BLOCKS * UPLOAD_BLOCK_SIZE bytes are buffered
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+UPLOAD_QUEUE_BLOCKS = 8
+
+# An upload cut off by a network error is resumed where the printer's copy ends, this many times
+UPLOAD_RETRIES = 3
+UPLOAD_TIMEOUT = 30
+
+
+class _SessionReuseFTP_TLS(ftplib.FTP_TLS):
+    # The printers only accept data connections that reuse the TLS session of the control connection
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+        if self._prot_p:
+            conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+        return conn, size
+
+
+class _ImplicitFTP_TLS(_SessionReuseFTP_TLS):
+    # FTP_TLS starts TLS with AUTH TLS after connecting, implicit FTPS starts it as soon as the socket is connected
+    _sock = None
+
+    @property
+    def sock(self):
+        return self._sock
+
+    @sock.setter
+    def sock(self, value):
+        if value is not None and not isinstance(value, ssl.SSLSocket):
+            value = self.context.wrap_socket(value, server_hostname=self.host)
+        self._sock = value
+
+
+def printer_ssl_context():
+    # The printers have self-signed certificates, so there is nothing to verify them against
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def open_printer_ftp(host, access_code, port=None, user=FTP_USER, tls="implicit", timeout=UPLOAD_TIMEOUT):
+    # Log in to the printer (or any FTP server with tls="none") in binary mode, with the data connections encrypted
+    if tls == "implicit":
+        ftp = _ImplicitFTP_TLS(context=printer_ssl_context(), timeout=timeout)
+    elif tls == "explicit":
+        ftp = _SessionReuseFTP_TLS(context=printer_ssl_context(), timeout=timeout)
+    elif tls == "none":
+        ftp = ftplib.FTP(timeout=timeout)
+    else:
+        raise ValueError(f"Unknown TLS mode '{tls}', use one of {', '.join(TLS_MODES)}")
+    try:
+        ftp.connect(host, port or (FTPS_PORT if tls == "implicit" else FTP_PORT))
+        ftp.login(user, access_code)
+        if tls != "none":
+            ftp.prot_p()
+        ftp.voidcmd("TYPE I")
+    except BaseException:
+        ftp.close()
+        raise
+    return ftp
+
+
+def remote_size(ftp, remote_path):
+    # Size of a file on the server, 0 if there is none
+    try:
+        return ftp.size(remote_path) or 0
+    except ftplib.error_perm:
+        return 0
+
+
+class _ReadAhead:
+    # A file object for storbinary whose blocks are read by a thread into a bounded queue, so the input is read
+    # while the blocks before are being sent
+    def __init__(self, blocks):
+        self.queue = queue.Queue(maxsize=UPLOAD_QUEUE_BLOCKS)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._fill, args=(blocks,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Wait for room in the queue, giving up once the upload has stopped
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self, blocks):
+        try:
+            for block in blocks:
+                if not self._put(block):
+                    return
+            self._put(b"")
+        except BaseException as error:
+            self._put(error)
+        finally:
+            blocks.close()
+
+    def read(self, size=-1):
+        if self.finished:
+            return b""
+        item = self.queue.get()
+        if isinstance(item, BaseException):
+            raise item
+        self.finished = item == b""
+        return item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def upload_segments(input_file_path, segments, remote_path, connect, resume=False, retries=UPLOAD_RETRIES):
+    # Upload the bytes splice_segments would write to remote_path, reading them from the input as they are sent.
+    # connect() returns a logged in ftplib.FTP. After a network error the upload is continued (REST) from the size
+    # of the server's copy. With resume=True that is also done for a copy left by an earlier upload
+    total = segments_size(segments)
+    attempt = 0
+    while True:
+        ftp = None
+        try:
+            ftp = connect()
+            offset = remote_size(ftp, remote_path) if resume or attempt else 0
+            if offset > total:
+                offset = 0
+            if offset < total or total == 0:
+                sent = [offset]
+                report_progress(offset, total, f"Uploading {os.path.basename(remote_path)}")
+
+                def uploaded(block):
+                    sent[0] += len(block)
+                    report_progress(sent[0], total)
+
+                reader = _ReadAhead(iter_segment_blocks(input_file_path, segments, offset, UPLOAD_BLOCK_SIZE))
+                try:
+                    ftp.storbinary(f"STOR {remote_path}", reader, UPLOAD_BLOCK_SIZE, uploaded, rest=offset or None)
+                finally:
+                    reader.close()
+
+            # Make sure the server has all of it
+            uploaded_size = remote_size(ftp, remote_path)
+            if uploaded_size and uploaded_size != total:
+                raise ftplib.error_temp(f"451 The printer has {uploaded_size} of {total} bytes")
+            ftp.quit()
+            return remote_path
+        except (OSError, EOFError, ftplib.error_temp, ftplib.error_reply):
+            attempt += 1
+            if attempt > retries:
+                raise
+            resume = True
+        finally:
+            if ftp is not None:
+                ftp.close()
+
+
+def upload_gcode(input_file_path, host, access_code, patch_file_paths=(), remote_dir="/", port=None, user=FTP_USER,
+                 tls="implicit", resume=False):
+    # Upload the input file to the printer, with the patches applied on the way if there are any (see gcode_patch),
+    # without writing the patched file. Returns the path on the printer
+    if patch_file_paths:
+        patches = [read_patch(patch_file_path) for patch_file_path in patch_file_paths]
+        segments = patched_segments(input_file_path, patches)
+        remote_name = patches[-1]["output"]["name"]
+    else:
+        segments = [(0, os.path.getsize(input_file_path))]
+        remote_name = os.path.basename(input_file_path)
+    remote_path = remote_dir.rstrip("/") + "/" + remote_name
+    connect = lambda: open_printer_ftp(host, access_code, port, user, tls)
+    return upload_segments(input_file_path, segments, remote_path, connect, resume)
@@ -0,0 +1,119 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# Counters recorded for the whole run and for every profiled function call
+COUNTERS = ["file_opens", "bytes_read", "lines_scanned"]
+
+# Calls recorded while profiling is on: (name, thread id, start, duration, counter deltas)
+_profile = {"enabled": False, "start": 0.0, "calls": [], "counters": dict.fromkeys(COUNTERS, 0)}
+_lock = threading.Lock()
+
+
+def start_profiling():
+    # Forget what was recorded before and start recording
+    with _lock:
+        _profile.update(enabled=True, start=time.perf_counter(), calls=[], counters=dict.fromkeys(COUNTERS, 0))
+
+
+def stop_profiling():
+    _profile["enabled"] = False
+
+
+def profiling_enabled():
+    return _profile["enabled"]
+
+
+def count_file_read(opens=1, bytes_read=0, lines_scanned=0):
+    # Record a file being opened and how much of it was read or scanned. Does nothing unless profiling
+    if not _profile["enabled"]:
+        return
+    with _lock:
+        counters = _profile["counters"]
+        counters["file_opens"] += opens
+        counters["bytes_read"] += bytes_read
+        counters["lines_scanned"] += lines_scanned
+
+
+def profiled(function):
+    # Decorator recording the wall time and counters of every call while profiling is on
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _profile["enabled"]:
+            return function(*args, **kwargs)
+        counters_before = dict(_profile["counters"])
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            deltas = {counter: _profile["counters"][counter] - counters_before[counter] for counter in COUNTERS}
+            with _lock:
+                _profile["calls"].append((name, threading.get_ident(), start, duration, deltas))
+
+    return wrapper
+
+
+def profile_report():
+    # Calls, total wall time and counters of every profiled function (nested calls are included in their
+    # callers' totals), slowest first, and the counters of the whole run
+    functions = {}
+    for name, _, _, duration, deltas in _profile["calls"]:
+        totals = functions.setdefault(name, {"calls": 0, "seconds": 0.0, **dict.fromkeys(COUNTERS, 0)})
+        totals["calls"] += 1
+        totals["seconds"] += duration
+        for counter in COUNTERS:
+            totals[counter] += deltas[counter]
+    return {
+        "seconds": time.perf_counter() - _profile["start"],
+        "totals": dict(_profile["counters"]),
+        "functions": dict(sorted(functions.items(), key=lambda item: -item[1]["seconds"]))
+    }
+
+
+def chrome_trace():
+    # Every recorded call as a Chrome trace "complete" event (open it in chrome://tracing or ui.perfetto.dev)
+    process_id = os.getpid()
+    events = []
+    for name, thread_id, start, duration, deltas in _profile["calls"]:
+        events.append({
+            "name": name,
+            "cat": "ams_filament_swapper",
+            "ph": "X",
+            "ts": (start - _profile["start"]) * 1e6,
+            "dur": duration * 1e6,
+            "pid": process_id,
+            "tid": thread_id,
+            "args": deltas
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def profile_paths(input_file_path):
+    # The report and the trace are written next to the input file, like the _debug.txt file
+    base = os.path.splitext(input_file_path)[0]
+    return base + "_profile.json", base + "_trace.json"
+
+
+def write_profile(input_file_path):
+    # Write the report and the trace of the input file, returning their paths
+    report_path, trace_path = profile_paths(input_file_path)
+    with open(report_path, "w") as report_file:
+        json.dump(profile_report(), report_file, indent=2)
+    with open(trace_path, "w") as trace_file:
+        json.dump(chrome_trace(), trace_file)
+    return report_path, trace_path
+
+
+def run_profiled(input_file_path, function, *args):
+    # Call function(*args) with profiling on and write the profile of the input file, even if it fails
+    start_profiling()
+    try:
+        return function(*args)
+    finally:
+        stop_profiling()
+        write_profile(input_file_path)
@@ -0,0 +1,30 @@
+import threading
+
+# The progress callback of each thread, and the phase it is in
+_progress = threading.local()
+
+
+class AnalysisCancelled(Exception):
+    # Raised by a progress callback to stop the work at the next progress report
+    pass
+
+
+def set_progress_callback(callback):
+    # Set the callback(phase, done, total) of the current thread, None to stop reporting
+    _progress.callback = callback
+    _progress.phase = ""
+
+
+def get_progress_callback():
+    return getattr(_progress, "callback", None)
+
+
+def report_progress(done, total, phase=None):
+    # Report how many of 'total' bytes are processed, starting a new phase if one is given.
+    # Does nothing unless the current thread has a callback
+    callback = getattr(_progress, "callback", None)
+    if callback is None:
+        return
+    if phase is not None:
+        _progress.phase = phase
+    callback(_progress.phase, done, total)
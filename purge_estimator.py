@@ -0,0 +1,154 @@
+import math
+import re
+from profiler import profiled
+
+# NumPy is optional, without it the same estimate is computed move by move
+try:
+    import numpy as np
+    from gcode_tokens import tokenize
+except ImportError:
+    np = None
+
+# The X, Y, Z, E and F words of a G0/G1 move (the last one wins if a word is repeated).
+# Moves are found after a newline, which the regex engine searches for much faster than "^"
+NUMBER = rb"(-?(?:\d+\.?\d*|\.\d+))"
+MOVE_RE = re.compile(rb"(?i)\n[ \t]*G0*[01](?![\d.])(?:[ \t]+(?:X" + NUMBER + rb"|Y" + NUMBER + rb"|Z" + NUMBER
+                     + rb"|E" + NUMBER + rb"|F" + NUMBER + rb"|[^ \t\r\n;]+))*")
+
+# The same words, in the order of the tuples returned by MOVE_RE
+MOVE_WORDS = "XYZEF"
+
+# Used until a span sets its own feedrate (mm/min)
+DEFAULT_FEEDRATE = 3000.0
+DEFAULT_FILAMENT_DIAMETER = 1.75
+
+# Totals computed for every span
+COST_FIELDS = ["moves", "extruded_length", "retracted_length", "extrusion_distance", "travel_distance", "duration"]
+
+
+def read_span_moves(data, byte_ranges):
+    # Parse the moves of every (start, end) byte range of a mapped file into (x, y, z, e, f) tuples of bytes,
+    # b"" for a missing word. A range starts at its marker comment, so there is never a move on its first line to miss
+    return [MOVE_RE.findall(data, start, end) for start, end in byte_ranges]
+
+
+def _parse_array_moves(data, byte_ranges):
+    # Parse the moves of every byte range into arrays: the span of each move and its X, Y, Z, E and F words
+    # (NaN where missing), from the tokens of the spans joined together
+    spans = [data[start:end] for start, end in byte_ranges]
+    # Every span ends its last line, so none of them runs into the next
+    spans = [span if span.endswith(b"\n") or not span else span + b"\n" for span in spans]
+    tokens = tokenize(b"".join(spans))
+    span_lines = np.repeat(np.arange(len(spans)), [span.count(b"\n") for span in spans])
+
+    is_move = tokens.command_mask("G0") | tokens.command_mask("G1")
+    columns = tokens.word_columns(MOVE_WORDS, is_move)
+    return span_lines[is_move], [columns[letter] for letter in MOVE_WORDS]
+
+
+def _array_span_costs(data, byte_ranges):
+    # Compute the totals of all spans at once on flat arrays of moves
+    span_count = len(byte_ranges)
+    if span_count == 0:
+        return {field: [] for field in COST_FIELDS}
+
+    span_ids, (x, y, z, e, f) = _parse_array_moves(data, byte_ranges)
+    move_count = len(span_ids)
+    if move_count == 0:
+        return {field: [0.0] * span_count for field in COST_FIELDS}
+
+    positions = np.arange(move_count)
+    first_moves = np.ones(move_count, dtype=bool)
+    first_moves[1:] = span_ids[1:] != span_ids[:-1]
+
+    def modal(values):
+        # Carry each word forward to the following moves of the same span (G-code words are modal)
+        known = ~np.isnan(values) | first_moves
+        return values[np.maximum.accumulate(np.where(known, positions, 0))]
+
+    x, y, z, f = modal(x), modal(y), modal(z), modal(f)
+
+    # Distance from the previous move of the span (the first move has no known start position)
+    deltas = [np.diff(axis, prepend=np.nan) for axis in (x, y, z)]
+    for delta in deltas:
+        delta[np.isnan(delta) | first_moves] = 0.0
+    distance = np.sqrt(deltas[0] ** 2 + deltas[1] ** 2 + deltas[2] ** 2)
+
+    e = np.nan_to_num(e)
+    feedrate = np.where(np.isnan(f) | (f <= 0), DEFAULT_FEEDRATE, f)
+    extruding = e > 0
+
+    per_move = {
+        "moves": np.ones(move_count),
+        "extruded_length": np.where(extruding, e, 0.0),
+        "retracted_length": np.where(e < 0, -e, 0.0),
+        "extrusion_distance": np.where(extruding, distance, 0.0),
+        "travel_distance": np.where(extruding, 0.0, distance),
+        # Moves without XYZ motion take as long as their extrusion or retraction
+        "duration": np.where(distance > 0, distance, np.abs(e)) / (feedrate / 60),
+    }
+    return {field: np.bincount(span_ids, weights=values, minlength=span_count).tolist()
+            for field, values in per_move.items()}
+
+
+def _loop_span_costs(data, byte_ranges):
+    # Same totals as _array_span_costs, one move at a time
+    costs = {field: [] for field in COST_FIELDS}
+    for moves in read_span_moves(data, byte_ranges):
+        totals = dict.fromkeys(COST_FIELDS, 0.0)
+        position = [None, None, None]
+        feedrate = None
+        for words in moves:
+            axes = [float(word) if word else None for word in words[:3]]
+            e = float(words[3]) if words[3] else 0.0
+            if words[4]:
+                feedrate = float(words[4])
+
+            squared = 0.0
+            for i, value in enumerate(axes):
+                if value is not None:
+                    if position[i] is not None:
+                        squared += (value - position[i]) ** 2
+                    position[i] = value
+            distance = math.sqrt(squared)
+
+            speed = (feedrate if feedrate and feedrate > 0 else DEFAULT_FEEDRATE) / 60
+            totals["moves"] += 1
+            if e > 0:
+                totals["extruded_length"] += e
+                totals["extrusion_distance"] += distance
+            else:
+                totals["retracted_length"] += -e
+                totals["travel_distance"] += distance
+            totals["duration"] += (distance if distance > 0 else abs(e)) / speed
+
+        for field in COST_FIELDS:
+            costs[field].append(totals[field])
+    return costs
+
+
+@profiled
+def span_costs(data, byte_ranges):
+    # Extruded and retracted filament (mm), extrusion and travel distance (mm) and duration (s) of the moves in
+    # every (start, end) byte range of a mapped file, as {field: [value per range]}.
+    # Durations use the feedrates only, without acceleration
+    if np is not None:
+        return _array_span_costs(data, byte_ranges)
+    return _loop_span_costs(data, byte_ranges)
+
+
+def filament_diameters(config):
+    # Diameter (mm) of every filament, from filament_diameter in the config block
+    diameters = []
+    for item in config.get("filament_diameter", "").split(","):
+        try:
+            diameters.append(float(item))
+        except ValueError:
+            pass
+    return diameters
+
+
+def filament_cross_section(diameters, filament):
+    # Cross section (mm2) of a filament, using the default diameter if it isn't known
+    diameter = diameters[filament] if filament is not None and filament < len(diameters) else DEFAULT_FILAMENT_DIAMETER
+    return math.pi * (diameter / 2) ** 2
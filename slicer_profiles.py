@@ -0,0 +1,80 @@
+import re
+
+# The comments, markers and line offsets the parser relies on, for each slicer version it knows. A file's profile is
+# picked from the slicer name and version in its header, files from other slicers or versions use DEFAULT_PROFILE
+#   comments:  recorded on comment lines (case insensitive), keyed by what they mark
+#   markers:   recorded on any line (case sensitive)
+#   layer_comment: starts every layer and holds its Z height
+#   offsets:   lines between a marker and the line it stands for
+PROFILES = [
+    {
+        "name": "bambu-studio-1.7",
+        "slicer": "BambuStudio",
+        "versions": [(1, 7)],
+        "comments": {
+            "toolchange_start": "CP TOOLCHANGE START",
+            "toolchange_end": "CP TOOLCHANGE END",
+            "calibration_start": "extrinsic para cali paint",
+            "calibration_end": "turn off light and wait extrude temperature",
+            "calibration_light": "light and wait extrude temperature",
+            "feature": "FEATURE:",
+            "config_start": "CONFIG_BLOCK_START",
+            "config_end": "CONFIG_BLOCK_END",
+        },
+        "markers": {
+            "first_feature_retract": "G1 E-.8 F1800",
+            "feature_retract": "G1 E-.04 F1800",
+            "wipe_start": "WIPE_START",
+            "wipe_end": "WIPE_END",
+        },
+        "layer_comment": "Z_HEIGHT:",
+        "offsets": {
+            # The first feature starts the line after the first "first_feature_retract" marker, the others three
+            # lines after the "feature_retract" that follows their "toolchange_end" comment
+            "first_feature_start": 1,
+            "feature_start": 3,
+            # A feature ends five lines above the "toolchange_start" comment closing it
+            "feature_end": 5,
+            # The calibration left after "calibration_end" starts two lines below it and is six lines long
+            "calibration_extra_start": 2,
+            "calibration_extra_lines": 5,
+            # A layer ends two lines above the layer comment of the next one
+            "layer_end": 2,
+        },
+    },
+]
+DEFAULT_PROFILE = PROFILES[0]
+
+# The slicer name and version are on one of the first lines ("; BambuStudio 01.07.02.51" or
+# "; generated by BambuStudio 01.07.02.51")
+HEADER_SIZE = 4096
+SLICER_VERSION_RE = re.compile(rb"^;[ \t]*(?:generated by[ \t]+)?([A-Za-z][\w-]*)[ \t]+[vV]?(\d+(?:\.\d+)+)", re.MULTILINE)
+
+
+def get_profile(name):
+    # The profile with this name, DEFAULT_PROFILE if there is none
+    return next((profile for profile in PROFILES if profile["name"] == name), DEFAULT_PROFILE)
+
+
+def slicer_version(header):
+    # (slicer name, version numbers) from the first bytes of a file, (None, None) if they aren't there
+    version_match = SLICER_VERSION_RE.search(header)
+    if version_match is None:
+        return None, None
+    return version_match.group(1).decode("ascii"), tuple(int(number) for number in version_match.group(2).split(b"."))
+
+
+def detect_profile(header):
+    # The profile of the first version prefix matching the slicer version in the header
+    slicer, version = slicer_version(header)
+    if slicer is not None:
+        for profile in PROFILES:
+            if slicer.lower() == profile["slicer"].lower() and any(version[:len(prefix)] == prefix
+                                                                   for prefix in profile["versions"]):
+                return profile
+    return DEFAULT_PROFILE
+
+
+def file_profile(input_file_path):
+    with open(input_file_path, "rb") as input_file:
+        return detect_profile(input_file.read(HEADER_SIZE))